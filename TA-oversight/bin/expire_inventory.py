@@ -1,11 +1,10 @@
 # encoding = utf-8
 
-import csv
 import datetime
-import gzip
 import json
+import logging
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import import_declare_test
 import solnlib.log
@@ -14,7 +13,14 @@ import splunklib.client as client
 import splunklib.results as results
 from six import iteritems
 
-from oversight_utils import OversightScript, log_enter_exit
+from oversight_utils import (
+    KeySet,
+    OversightScript,
+    datetime_to_epoch,
+    log_enter_exit,
+    parse_timestring,
+    record_run_metrics,
+)
 
 
 class InventoryExpirator(OversightScript):
@@ -44,7 +50,8 @@ class InventoryExpirator(OversightScript):
             row.get('asset_group')
             self.app_settings.get(asset_group)
             row.get(self.app_settings['last_inventoried_field'])
-            row.get(self.app_settings['last_inventoried_field']) in format self.app_settings.get('time_format')
+            row.get(self.app_settings['last_inventoried_field']) in format self.app_settings.get('time_format'),
+              or its epoch field (see set_epoch_field()) is a number
         """
         if not row:
             return False
@@ -100,9 +107,14 @@ class InventoryExpirator(OversightScript):
             )
             return False
 
+        epoch = row.get(self.get_epoch_fieldname(self.LAST_INVENTORIED_FIELD))
+        if isinstance(epoch, (int, float)) and not isinstance(epoch, bool):
+            # compared instead of the formatted string, see get_epoch()
+            return True
+
         try:
             last_inventoried = row.get(self.LAST_INVENTORIED_FIELD)
-            last_inventoried_date = datetime.strptime(
+            last_inventoried_date = parse_timestring(
                 last_inventoried,
                 self.app_settings["additional_parameters"]["time_format"],
             )
@@ -128,46 +140,143 @@ class InventoryExpirator(OversightScript):
 
         return True
 
-    def is_expired(self, host_row, pre_expired_hosts):
+    def get_expiry_cutoff(self, asset_group, now):
+        """the most recent last_inventoried time which is expired for asset_group: records expire once
+        more than max_age whole days have passed since they were last inventoried
+
+        @param asset_group: string
+        @param now:         datetime
+        @returns            datetime
+        """
+        max_age = int(self.app_settings.get(asset_group) or 180)
+        return now - timedelta(days=max_age + 1)
+
+    def get_candidate_cutoff(self, now):
+        """the newest expiry cutoff of any asset group; records last inventoried after it can not expire by age
+
+        @param now: datetime
+        @returns    datetime
+        """
+        asset_groups = self.app_settings.get("asset_groups") or {}
+        names = [
+            value
+            for name, value in asset_groups.items()
+            if name.endswith("_name") and value
+        ]
+        # None: records of asset groups without a max age setting use the default
+        return max(self.get_expiry_cutoff(name, now) for name in names + [None])
+
+    def iter_expiry_candidates(self, expiration_expression_matched, now):
+        """stream only the aggregation records which may expire this run, instead of the whole collection.
+        Of the records not expired yet (as with the full scan in expire_inventory()):
+          * those last inventoried at or before get_candidate_cutoff(), or without the epoch field
+            (see set_epoch_field()) which is compared server-side
+          * those matching the expiration expression, or forced expired
+
+        @param expiration_expression_matched:   KeySet, set or list of record keys (self.VISIBLE_KEY_FIELD)
+        @param now:                             datetime
+        @returns                                generator of dicts, each record once
+        """
+        cutoff = self.get_candidate_cutoff(now)
+        query = {
+            self.EXPIRED_FIELD: "false",
+            # $not also matches records without the field
+            self.get_epoch_fieldname(self.LAST_INVENTORIED_FIELD): {
+                "$not": {"$gt": datetime_to_epoch(cutoff)}
+            },
+        }
+        seen = set()
+        for record in self.iter_kvstore_records(
+            self.AGGREGATED_COLLECTION_NAME, query=query
+        ):
+            seen.add(record.get("_key"))
+            yield record
+        aged_count = len(seen)
+
+        for record in self.iter_records_for_keys(
+            self.AGGREGATED_COLLECTION_NAME,
+            expiration_expression_matched,
+            field=self.VISIBLE_KEY_FIELD,
+        ):
+            if record.get(self.EXPIRED_FIELD) != "false":
+                continue
+            if record.get("_key") not in seen:
+                seen.add(record.get("_key"))
+                yield record
+
+        self.logger.info(
+            "run_id={} script={} method=iter_expiry_candidates status=exited cutoff={} aged_candidate_count={} candidate_count={}".format(
+                self.run_id,
+                self.SCRIPT_NAME,
+                cutoff.strftime(self.app_settings["additional_parameters"]["time_format"]),
+                str(aged_count),
+                str(len(seen)),
+            )
+        )
+
+    def load_mvkey_linked_records(self, expired_hosts, active_hosts):
+        """read the active records sharing an mv_key with expired_hosts which were not expiry candidates,
+        so strip_expiring_keys_from_mvkeys() can remove the expiring keys from them
+
+        @param expired_hosts:   dict of dicts, keyed by _key
+        @param active_hosts:    dict of dicts, keyed by _key; linked records are added
+        @returns                int, number of records added to active_hosts
+        """
+        keys = set()
+        for host_row in expired_hosts.values():
+            if self.is_multivalued_mvkey(host_row):
+                keys.update(host_row[self.VISIBLE_MVKEY_FIELD])
+        keys = [key for key in keys if key not in expired_hosts and key not in active_hosts]
+
+        added = 0
+        for record in self.iter_records_for_keys(self.AGGREGATED_COLLECTION_NAME, keys):
+            if record.get(self.EXPIRED_FIELD) != "false" or not self.is_valid_record(
+                record
+            ):
+                continue
+            active_hosts[record["_key"]] = record
+            added += 1
+        return added
+
+    def is_expired(self, host_row, pre_expired_hosts, now=None):
         """
         Determine if the record should be expired out of hosts_lookup by comparing
         row[self.LAST_INVENTORIED_FIELD] to
           app_settings["asset_groups"][asset_group_xxx_max_age]
 
         @param host_row:            dict, an individual record from the aggregation lookup
-        @param pre_expired_hosts:   list of strings, listing primary_id_field of each record matching
+        @param pre_expired_hosts:   set or list of strings, listing primary_id_field of each record matching
                                      the expiration clause.  These should automatically be marked expired
                                      even if max age has not passed.
+        @param now:                 datetime, time to compare against; defaults to datetime.today()
         @returns                    boolean, should host be expired or is it still active?
 
         """
         key = host_row["_key"]
         asset_group = host_row.get("asset_group") or "default"
-        max_age = int(self.app_settings.get(asset_group) or 180)
 
-        last_inventoried = host_row.get(self.LAST_INVENTORIED_FIELD)
-
-        last_inventoried_date = datetime.strptime(
-            last_inventoried,
+        last_inventoried_epoch = self.get_epoch(
+            host_row,
+            self.LAST_INVENTORIED_FIELD,
             self.app_settings["additional_parameters"]["time_format"],
         )
 
         ## should be adjusted for timezone but not possible with default python2.7
         ## TODO fix after update to splunk8
-        delta = datetime.today() - last_inventoried_date
-        self.logger.debug(
-            "run_id={} row={} delta={} max_age={}".format(
-                self.run_id, str(host_row), str(delta), str(max_age)
-            )
-        )
+        now = now or datetime.today()
 
         to_delete = False
-        if delta.days > max_age:
+        if last_inventoried_epoch <= datetime_to_epoch(
+            self.get_expiry_cutoff(asset_group, now)
+        ):
             # if delta is +10minutes from max_age, its still the same *day* and shouldn't be expired
             to_delete = True
             self.logger.info(
                 'run_id={} script={} method=is_expired key={} status=expired reason="Last Inventoried {} days ago"'.format(
-                    self.run_id, self.SCRIPT_NAME, str(key), str(delta)
+                    self.run_id,
+                    self.SCRIPT_NAME,
+                    str(key),
+                    str(timedelta(seconds=datetime_to_epoch(now) - last_inventoried_epoch)),
                 )
             )
         if host_row.get(self.VISIBLE_KEY_FIELD) in pre_expired_hosts:
@@ -313,17 +422,22 @@ class InventoryExpirator(OversightScript):
         )
         return expired_hosts, modified_hosts
 
+    def make_expiration_match_set(self):
+        """@returns KeySet, spilling to disk past EXPIRATION_MATCH_MAX_KEYS matches"""
+        return KeySet(max_memory_keys=self.EXPIRATION_MATCH_MAX_KEYS)
+
     @log_enter_exit()
     def get_expiration_expression_results(self):
         """if the global add-on setting 'expiration_expression' exists, run the expression against
-        the aggregation lookup table.  return a list of any keys with matching results.
+        the aggregation lookup table.  return the set of any keys with matching results.
 
-        @returns    list of string, ip (key) from any records that match the expiration_expression search and should
+        @returns    KeySet of string, ip (key) from any records that match the expiration_expression search and should
         be flagged expired regardless of age.
         """
 
-        output = []
+        output = self.make_expiration_match_set()
         search = None
+        debug = self.logger.isEnabledFor(logging.DEBUG)
 
         if self.EXPIRATION_EXPRESSION:
 
@@ -353,28 +467,32 @@ class InventoryExpirator(OversightScript):
                 if "result" in record:
                     key_match = record["result"].get(self.VISIBLE_KEY_FIELD)
                     if key_match:
-                        output.append(key_match)
-                    self.logger.debug(
-                        "expire_inventory matched for expiration record dict: {}".format(
-                            str(key_match)
+                        output.add(key_match)
+                    if debug:
+                        self.logger.debug(
+                            "expire_inventory matched for expiration record dict: {}".format(
+                                str(key_match)
+                            )
                         )
-                    )
 
                 if "lastrow" in record:
                     break
 
         self.logger.debug(
-            "run_id={} script={} method=get_expiration_expression_results status=executing expiration_search={} matching_records={}".format(
-                self.run_id, self.SCRIPT_NAME, str(search), str(output)
+            "run_id={} script={} method=get_expiration_expression_results status=executing expiration_search={} matching_records={} spilled={}".format(
+                self.run_id, self.SCRIPT_NAME, str(search), str(len(output)), str(output.spilled)
             )
         )
         return output
 
-    def categorize_host_records(self, valid, expiration_expression_matched):
-        """categorize records into active or expired dicts
-        @param valid:                           list of dicts
-        @param expiration_expression_matched:   list of record keys (self.VISIBLE_KEY_FIELD)
-        @returns                                list of dicts, list of dicts
+    def categorize_host_records(self, valid, expiration_expression_matched, now=None):
+        """categorize records into active or expired dicts, in a single pass against one `now`
+        and a precomputed expiry cutoff per asset group (see get_expiry_cutoff())
+
+        @param valid:                           iterable of dicts
+        @param expiration_expression_matched:   KeySet, set or list of record keys (self.VISIBLE_KEY_FIELD)
+        @param now:                             datetime, time to compare against; defaults to datetime.today()
+        @returns                                dict of dicts, dict of dicts; keyed by _key
 
         """
         self.logger.debug(
@@ -383,45 +501,65 @@ class InventoryExpirator(OversightScript):
                 self.SCRIPT_NAME,
             )
         )
-        expired = []
-        active = []
+        now = now or datetime.today()
+        now_epoch = datetime_to_epoch(now)
+        time_format = self.app_settings["additional_parameters"]["time_format"]
+        pre_expired = expiration_expression_matched
+        if isinstance(pre_expired, list):
+            pre_expired = set(pre_expired)
+        cutoffs = {}  # asset group => expiry cutoff, epoch seconds
+        expired_hosts = {}
+        active_hosts = {}
+        valid_count = 0
         for record in valid:
-            record_status = self.is_expired(record, expiration_expression_matched)
-            if record_status:
-                expired.append(record)
-            elif record_status == False:
-                active.append(record)
+            valid_count += 1
+            asset_group = record.get("asset_group") or "default"
+            cutoff = cutoffs.get(asset_group)
+            if cutoff is None:
+                cutoff = cutoffs[asset_group] = datetime_to_epoch(
+                    self.get_expiry_cutoff(asset_group, now)
+                )
+            last_inventoried_epoch = self.get_epoch(
+                record, self.LAST_INVENTORIED_FIELD, time_format
+            )
+            key = record.get("_key")
+
+            if last_inventoried_epoch <= cutoff:
+                expired_hosts[key] = record
+                self.logger.info(
+                    'run_id={} script={} method=is_expired key={} status=expired reason="Last Inventoried {} days ago"'.format(
+                        self.run_id,
+                        self.SCRIPT_NAME,
+                        str(key),
+                        str(timedelta(seconds=now_epoch - last_inventoried_epoch)),
+                    )
+                )
+            elif record.get(self.VISIBLE_KEY_FIELD) in pre_expired:
+                expired_hosts[key] = record
+                self.logger.info(
+                    'run_id={} script={} method=is_expired key={} stats=expired reason="matched expiration expression"'.format(
+                        self.run_id, self.SCRIPT_NAME, str(key)
+                    )
+                )
+            else:
+                active_hosts[key] = record
 
         self.logger.info(
-            "run_id={} script={} method=categorize_host_records status=executing matched_expiration_expression={} valid={} active={} expired={}".format(
+            "run_id={} script={} method=categorize_host_records status=executing matched_expiration_expression={} valid={} active={} expired={} asset_group_cutoffs={}".format(
                 self.run_id,
                 self.SCRIPT_NAME,
-                str(len(expiration_expression_matched)),
-                str(len(list(valid))),
-                str(len(list(active))),
-                str(len(list(expired))),
+                str(len(pre_expired)),
+                str(valid_count),
+                str(len(active_hosts)),
+                str(len(expired_hosts)),
+                str(
+                    {
+                        k: datetime.fromtimestamp(v).strftime(time_format)
+                        for k, v in cutoffs.items()
+                    }
+                ),
             )
         )
-
-        # convert list of dicts to dicts, with key of primary_id_field
-        active_hosts = {}
-        if active:
-            for item in active:
-                key_field = "_key" or self.app_settings.get(
-                    "additional_parameters"
-                ).get("primary_id_field")
-                key = item.get(key_field)
-                active_hosts[key] = item
-
-        expired_hosts = {}
-        if expired:
-            for item in expired:
-                key_field = "_key" or self.app_settings.get(
-                    "additional_parameters"
-                ).get("primary_id_field")
-                key = item.get(key_field)
-                expired_hosts[key] = item
-
         self.logger.info(
             "run_id={} script={} method=categorize_host_records status=exited expired_host_count={} active_host_count={}".format(
                 self.run_id,
@@ -432,6 +570,7 @@ class InventoryExpirator(OversightScript):
         )
         return expired_hosts, active_hosts
 
+    @record_run_metrics
     def expire_inventory(self, payload):
         """
         main method
@@ -441,6 +580,7 @@ class InventoryExpirator(OversightScript):
            * if asset only has 1 record, set expired appropriately
            * if asset has multiple (ip) records, don't expire them unless ALL are expired.
         finally, set any remaining in the expired group, | eval expired="true"
+        the run's metrics are emitted as one oversight:metrics event, see emit_run_metrics()
 
         """
 
@@ -448,8 +588,8 @@ class InventoryExpirator(OversightScript):
 
         token = payload.get("session_key")
         self.service = client.connect(token=token, app=self.APP_NAME, owner="Nobody")
-        self.app_settings = self.read_app_settings(token)
-        self.app_settings = self.normalize_global_settings(self.app_settings)
+        with self.metrics.phase("settings_load"):
+            self.app_settings = self.load_app_settings(token)
         super().setup(self.service, self.app_settings)
 
         if payload.get("configuration") and payload["configuration"].get("log_level"):
@@ -477,13 +617,6 @@ class InventoryExpirator(OversightScript):
             )
         )
         collection_svc = self.service.kvstore[self.AGGREGATED_COLLECTION_NAME]
-        collection_data = self.get_kvstore_records(self.AGGREGATED_COLLECTION_NAME)
-
-        self.logger.info(
-            "run_id={} examining count={} host records".format(
-                self.run_id, str(len(collection_data))
-            )
-        )
 
         force = False
         payload_config = {}
@@ -498,7 +631,7 @@ class InventoryExpirator(OversightScript):
                 force = False
 
         if force:
-            expiration_expression_matched = []
+            expiration_expression_matched = self.make_expiration_match_set()
             self.logger.debug(
                 "run_id:{} force expiration of all records passed".format(self.run_id)
             )
@@ -510,39 +643,75 @@ class InventoryExpirator(OversightScript):
                     )
                 )
                 sys.exit(1)
-            with gzip.open(results_file, "rt") as csv_file:
-                csvreader = csv.DictReader(csv_file)
-                for line in csvreader:
-                    if line:
-                        try:
-                            expiration_expression_matched.append(
-                                line[self.VISIBLE_KEY_FIELD]
-                            )
-                        except KeyError:
-                            self.logger.error(
-                                'run_id:{} status="failed to force expiration", field={} is not present in record={}'.format(
-                                    self.run_id, self.VISIBLE_KEY_FIELD, str(line)
-                                )
+            for line in self.iter_results_file(results_file, [self.VISIBLE_KEY_FIELD]):
+                if line:
+                    try:
+                        expiration_expression_matched.add(line[self.VISIBLE_KEY_FIELD])
+                    except KeyError:
+                        self.logger.error(
+                            'run_id:{} status="failed to force expiration", field={} is not present in record={}'.format(
+                                self.run_id, self.VISIBLE_KEY_FIELD, str(line)
                             )
+                        )
 
         else:
             self.logger.debug("run_id:{} NOT force mode".format(self.run_id))
-            expiration_expression_matched = self.get_expiration_expression_results()
+            with self.metrics.phase("expiration_expression"):
+                expiration_expression_matched = (
+                    self.get_expiration_expression_results()
+                )
         self.logger.info(
             "found {} expiration expression matches: ".format(
                 str(len(expiration_expression_matched))
             )
         )
 
-        valid = filter(lambda x: self.is_valid_record(x) == True, collection_data)
-        expired_hosts, active_hosts = self.categorize_host_records(
-            valid, expiration_expression_matched
+        now = datetime.today()
+        # records are streamed page by page from the kvstore, not held in a single list
+        candidates_only = (
+            len(expiration_expression_matched) < self.EXPIRY_FULL_SCAN_MIN_KEYS
+        )
+        if candidates_only:
+            collection_data = self.iter_expiry_candidates(
+                expiration_expression_matched, now
+            )
+        else:
+            # already expired records are left alone, as by iter_expiry_candidates()
+            collection_data = self.iter_kvstore_records(
+                self.AGGREGATED_COLLECTION_NAME, query={self.EXPIRED_FIELD: "false"}
+            )
+
+        self.logger.info(
+            "run_id={} examining host records from collection={} candidates_only={}".format(
+                self.run_id, self.AGGREGATED_COLLECTION_NAME, str(candidates_only)
+            )
         )
 
-        (
-            expired_hosts,
-            modified_hosts,
-        ) = self.strip_expiring_keys_from_mvkeys(expired_hosts, active_hosts)
+        valid = filter(lambda x: self.is_valid_record(x) == True, collection_data)
+        with self.metrics.phase("expiry_classification"):
+            expired_hosts, active_hosts = self.categorize_host_records(
+                valid, expiration_expression_matched, now
+            )
+            expiration_expression_matched.close()
+            if candidates_only:
+                self.load_mvkey_linked_records(expired_hosts, active_hosts)
+
+        # mv_keys as read, to keep the mv_key index in step with the changes below
+        mvkey_index_ready = self.is_mvkey_index_ready()
+        original_mvkeys = {}
+        if mvkey_index_ready:
+            for hosts in [expired_hosts, active_hosts]:
+                for key, host_row in iteritems(hosts):
+                    if self.is_multivalued_mvkey(host_row):
+                        original_mvkeys[key] = list(host_row[self.VISIBLE_MVKEY_FIELD])
+
+        with self.metrics.phase("mvkey_sync"):
+            (
+                expired_hosts,
+                modified_hosts,
+            ) = self.strip_expiring_keys_from_mvkeys(expired_hosts, active_hosts)
+        self.metrics.count("expired_records", len(expired_hosts))
+        self.metrics.count("modified_records", len(modified_hosts))
 
         self.logger.debug(
             'run_id={} expired_host_count={} active_host_count={} modified_host_count={} status="finished removing expired keys from mv_keys across all records"'.format(
@@ -553,6 +722,10 @@ class InventoryExpirator(OversightScript):
             )
         )
 
+        # records written before the epoch field was introduced get it only when their state changes
+        # below, or when update_inventory next writes them; until then they remain candidates
+        time_format = self.app_settings["additional_parameters"]["time_format"]
+
         ## write any needed record updates
         ## TODO should make this more atomic and make updates around the same mv_key changes all at the same time...
         ## but we should be reducing writes this way as well
@@ -575,9 +748,10 @@ class InventoryExpirator(OversightScript):
                 host_row[self.EXPIRED_FIELD] = datetime.today().strftime(
                     self.app_settings["additional_parameters"]["time_format"]
                 )
+                self.set_epoch_field(host_row, self.LAST_INVENTORIED_FIELD, time_format)
 
-                ## scan remaining lookup tables to purge host from
-                self.expire_all_records_for_key(host_row)
+            ## scan remaining lookup tables to purge hosts from, one batch of queries per source
+            self.expire_all_records_for_keys(expired_hosts.values())
 
             # now we write the expired records to the kvstore
             expired_records = [
@@ -600,6 +774,7 @@ class InventoryExpirator(OversightScript):
                         self.run_id, str(key), str(collection_svc.name)
                     )
                 )
+                self.set_epoch_field(host_row, self.LAST_INVENTORIED_FIELD, time_format)
                 payload = json.dumps(host_row)
 
                 # cache record for batch writing
@@ -619,6 +794,20 @@ class InventoryExpirator(OversightScript):
                 )
                 self.handle_cached_write(collection_name, force=True)
 
+        if mvkey_index_ready:
+            mvkey_changes = {}
+            for hosts in [expired_hosts, modified_hosts]:
+                for key, host_row in iteritems(hosts):
+                    mvkey = (
+                        host_row[self.VISIBLE_MVKEY_FIELD]
+                        if self.is_multivalued_mvkey(host_row)
+                        else None
+                    )
+                    if original_mvkeys.get(key) != mvkey:
+                        mvkey_changes[key] = (original_mvkeys.get(key), mvkey)
+            with self.metrics.phase("mvkey_index_update"):
+                self.update_mvkey_index(mvkey_changes)
+
         self.logger.info(
             "run_id={} status:completed expired_hosts_count={} modified_hosts_count={} with updated mvkey".format(
                 self.run_id, str(len(expired_hosts)), str(len(modified_hosts))
@@ -11,6 +11,11 @@ from solnlib.utils import is_true
 from splunktaucclib.rest_handler import admin_external
 
 from input_module_oversight import KNOWLEDGE_OBJECTS_WRITTEN
+from oversight_utils import (
+    get_http_handler,
+    get_settings_cache_path,
+    invalidate_settings_cache,
+)
 
 __all__ = [
     "OversightInputExternalHandler",
@@ -25,7 +30,9 @@ class OversightInputExternalHandler(admin_external.AdminExternalHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.service = splunklib.client.connect(
-            token=self.handler._session_key, app=import_declare_test.ta_name
+            token=self.handler._session_key,
+            app=import_declare_test.ta_name,
+            handler=get_http_handler(),
         )
         splunkhome = os.path.normpath(os.environ.get("SPLUNK_HOME", "/opt/splunk"))
         log.Logs.set_context(
@@ -35,6 +42,9 @@ class OversightInputExternalHandler(admin_external.AdminExternalHandler):
         log.Logs().set_level("DEBUG")
         self.logger = log.Logs().get_logger(self.SCRIPT_NAME)
         self.run_id = str(int(time.time()))
+        self.settings_cache_path = get_settings_cache_path(
+            splunkhome, import_declare_test.ta_name
+        )
 
         self.logger.info(
             "run_id={} script={} status=initializing namespace={}".format(
@@ -44,6 +54,9 @@ class OversightInputExternalHandler(admin_external.AdminExternalHandler):
 
     @admin_external.build_conf_info
     def handleEdit(self, confInfo):
+        # update_inventory alert actions must not keep using the previous input settings,
+        # invalidated again once written so a run caching them meanwhile is not kept either
+        invalidate_settings_cache(self.settings_cache_path)
         disabled = self.payload.get("disabled")
         if disabled is None:
             self.edit_hook(
@@ -52,7 +65,7 @@ class OversightInputExternalHandler(admin_external.AdminExternalHandler):
                 stanza_id=self.callerArgs.id,
                 payload=self.payload,
             )
-            return self.handler.update(
+            result = self.handler.update(
                 self.callerArgs.id,
                 self.payload,
             )
@@ -81,7 +94,7 @@ class OversightInputExternalHandler(admin_external.AdminExternalHandler):
                 )
                 self.service.saved_searches[non_inventory_saved_search_name].disable()
 
-            return self.handler.disable(self.callerArgs.id)
+            result = self.handler.disable(self.callerArgs.id)
 
         else:
             # enable savedsearch
@@ -107,10 +120,14 @@ class OversightInputExternalHandler(admin_external.AdminExternalHandler):
                 )
                 self.service.saved_searches[non_inventory_saved_search_name].enable()
 
-            return self.handler.enable(self.callerArgs.id)
+            result = self.handler.enable(self.callerArgs.id)
+
+        invalidate_settings_cache(self.settings_cache_path)
+        return result
 
     @admin_external.build_conf_info
     def handleRemove(self, confInfo):
+        invalidate_settings_cache(self.settings_cache_path)
         self.delete_hook(
             session_key=self.getSessionKey(),
             config_name=self._get_name(),
@@ -178,4 +195,6 @@ class OversightInputExternalHandler(admin_external.AdminExternalHandler):
 
         ## TODO remove "{}_last_inventoried".format(self.callerArgs.id) from aggregation_lookup and aggregation_lookup_all
         ## dont forget to use the app setting last_inventoried_fieldname
-        return self.handler.delete(self.callerArgs.id)
+        result = self.handler.delete(self.callerArgs.id)
+        invalidate_settings_cache(self.settings_cache_path)
+        return result
@@ -2,13 +2,19 @@
 
 import collections
 import copy
+import json
 import re
 
 from six import iteritems
 from solnlib import log
 from splunklib.client import HTTPError
 
-from oversight_utils import log_enter_exit, OversightScript
+from oversight_utils import (
+    OversightScript,
+    diff_conf_args,
+    log_enter_exit,
+    normalize_conf_value,
+)
 
 KNOWLEDGE_OBJECTS_WRITTEN = {
     "transforms": ["_lookup", "_lookup_all"],
@@ -50,8 +56,9 @@ class OversightBuilder(OversightScript):
     )
 
     SCRIPT_NAME = "input_module_oversight"
-    DEFAULT_ASSET_GROUP_NAME = "default"
-    DEFAULT_MAX_AGE = "30"
+    TIME_FORMAT_MACRO_NAME = "inventory_time_format"  # quoted app setting time_format, for strptime() in searches
+    RECONCILED_CONF_TYPES = ["collections", "transforms", "macros", "savedsearches"]  # in order applied
+    RECONCILE_DRY_RUN = False  # log the planned knowledge object changes instead of applying them
 
     def __init__(self):
         """note that the Splunk service object is not available at __init__ time per Splunk docs"""
@@ -72,6 +79,15 @@ class OversightBuilder(OversightScript):
             "enableSched": "1",
         }
 
+    def setup(self, service, app_settings):
+        super().setup(service, app_settings)
+        self.RECONCILE_DRY_RUN = (
+            normalize_conf_value(
+                app_settings["additional_parameters"].get("reconcile_dry_run")
+            )
+            == "1"
+        )
+
     @log_enter_exit()
     def normalize_input_parameters(self, input, arguments):
         """parse input parameters and apply necessary normalization
@@ -290,24 +306,30 @@ class OversightBuilder(OversightScript):
         """populate list of strings for the fields that need to be ensured are present in aggregation lookup transform
         These fields are those which this data source is adding (ie sourcename_last_inventoried),
         any fields listed in aggregated_fields, and also the general fields from app settings, which we don't have
-        any other place to add them in.
+        any other place to add them in.  Each timestamp field is listed with its epoch field (ie last_inventoried_epoch).
 
         @returns     list of strings comma seperated.
 
         """
-        necessary_fields = [
-            self.settings["primary_id_field"],
-            self.settings["primary_mv_id_field"],
+        timestamp_fields = [
             self.settings["last_inventoried_fieldname"],
             self.settings["first_inventoried_fieldname"],
         ]
-
         if self.params.get("inventory_source"):
-            necessary_fields.append(
+            timestamp_fields.append(
                 "{}_{}".format(
                     self.params["name"], self.settings["last_inventoried_fieldname"]
                 )
             )
+
+        necessary_fields = [
+            self.settings["primary_id_field"],
+            self.settings["primary_mv_id_field"],
+        ]
+        for field in timestamp_fields:
+            necessary_fields.extend([field, self.get_epoch_fieldname(field)])
+
+        if self.params.get("inventory_source"):
             if self.params["aggregation_fields"]:
                 necessary_fields.extend(self.params["aggregation_fields"])
 
@@ -343,49 +365,15 @@ class OversightBuilder(OversightScript):
         else:
             return existing_fields
 
-    @log_enter_exit("adding any missing fields to aggregation lookup")
-    def update_aggregation_transform(self, new_fields_list):
-        """examine the transform lookup definition for the aggregation lookup
-        add name_last_inventoried
-        add settings["aggregation_fields"]
-        do a create if transform doesnt already exist
-        only do a POST if data has changed
-
-        @param necessary_fields:    list of string
-        @returns                    None
-
-        """
-        if not new_fields_list:
-            return
-
-        aggregation_transform = self.service.confs["transforms"][
-            self.settings["aggregated_lookup_name"]
-        ]
-        aggregation_transform_all = self.service.confs["transforms"][
-            "{}_all".format(self.settings["aggregated_lookup_name"])
-        ]
-
-        self.logger.debug(
-            "run_id={} input={} script={} method=update_aggregation_transform status=executing type=transform name={} args={}".format(
-                self.run_id,
-                self.params["name"],
-                self.SCRIPT_NAME,
-                aggregation_transform.name,
-                str(new_fields_list),
-            )
-        )
-        aggregation_transform.update(fields_list=new_fields_list)
+    def flatten_app_settings(self, app_settings):
+        """the settings used by the builder from the app settings, as one flat dict
 
-        aggregation_transform_all.update(fields_list=new_fields_list)
-
-    def normalize_global_settings(self, app_settings):
-        """normalize app-wide global settings specified
-
-        @returns    dict
+        @param app_settings:    dict, see OversightScript.load_app_settings()
+        @returns                dict
 
         """
         self.logger.debug(
-            """run_id={} script={} method=normalize_global_settings status=entered args={}""".format(
+            """run_id={} script={} method=flatten_app_settings status=entered args={}""".format(
                 self.run_id, self.SCRIPT_NAME, str(app_settings)
             )
         )
@@ -433,7 +421,7 @@ class OversightBuilder(OversightScript):
         ]
         settings["loglevel"] = app_settings["logging"]["loglevel"]
         self.logger.debug(
-            "run_id={} script={} method=normalize_global_settings status=exited return={}".format(
+            "run_id={} script={} method=flatten_app_settings status=exited return={}".format(
                 self.run_id, self.SCRIPT_NAME, str(settings)
             )
         )
@@ -506,77 +494,361 @@ class OversightBuilder(OversightScript):
 
         return definition
 
-    @log_enter_exit()
-    def write_savedsearch_definition(
-        self, saved_search_name, saved_search_args, search_query
-    ):
-        """calculate savedsearch parameters
-        either update existing savedsearch, or create a new one if it does not yet exist
-        """
-        execution_error = False
-
-        # don't create new if search already exists, just update
-        searches = self.service.saved_searches
+    def get_collection_schema(self, aggregated=False):
+        """typed fields and accelerated fields (indexes) for the input's kvstore collection, or for the
+        aggregated collection, so lookup filters and kvstore queries on them are not collection scans.
+        The aggregated collection includes this input's <name>_last_inventoried epoch field if it is an
+        inventory source; source collections have no asset_group or epoch fields.
 
-        if saved_search_name in searches:
-
-            saved_search_args["search"] = search_query
-            try:
-
-                searches[saved_search_name].update(**saved_search_args).refresh()
-
-            except HTTPError as error:
-                execution_error = True
-                self.logger.error(
-                    'run_id={} input={} status="error updating savedsearch" type=savedsearch update args={} details={}'.format(
-                        self.run_id, self.name, str(saved_search_args), str(error)
-                    )
+        @param aggregated:  bool
+        @returns            dict, dict; field => type, acceleration name => index definition
+        """
+        last_inventoried = self.settings["last_inventoried_fieldname"]
+        if aggregated:
+            id_field = self.settings["primary_id_field"]
+            last_inventoried_epoch = self.get_epoch_fieldname(last_inventoried)
+            fields = {
+                self.EXPIRED_FIELD: "string",
+                "asset_group": "string",
+                id_field: "string",
+                last_inventoried_epoch: "number",
+                self.get_epoch_fieldname(
+                    self.settings["first_inventoried_fieldname"]
+                ): "number",
+            }
+            accelerated_fields = {
+                # see InventoryExpirator.iter_expiry_candidates()
+                "expiry_candidates": {
+                    self.EXPIRED_FIELD: 1,
+                    last_inventoried_epoch: 1,
+                },
+                "asset_group": {"asset_group": 1},
+                id_field: {id_field: 1},
+            }
+            if self.params.get("inventory_source"):
+                source_epoch = self.get_epoch_fieldname(
+                    "{}_{}".format(self.params["name"], last_inventoried)
                 )
+                fields[source_epoch] = "number"
+                accelerated_fields[source_epoch] = {source_epoch: 1}
         else:
-            try:
-
-                searches.create(saved_search_name, search_query, **saved_search_args)
+            id_field = self.params.get("id_field_rename") or self.params["id_field"]
+            fields = {
+                self.EXPIRED_FIELD: "string",
+                id_field: "string",
+                last_inventoried: "string",
+            }
+            accelerated_fields = {
+                # lookup transform filter = expired=false
+                self.EXPIRED_FIELD: {self.EXPIRED_FIELD: 1},
+                id_field: {id_field: 1},
+                last_inventoried: {last_inventoried: 1},
+            }
+        return fields, accelerated_fields
+
+    def get_collection_args(self, fields, accelerated_fields, **collection_args):
+        """flatten typed and accelerated fields into kvstore collection settings
+
+        @param fields:              dict, field => type
+        @param accelerated_fields:  dict, acceleration name => index definition
+        @param collection_args:     other collection settings, ie replicate
+        @returns                    dict, collection settings as posted to storage/collections/config
+        """
+        args = dict(collection_args)
+        for field, field_type in fields.items():
+            args["field.{}".format(field)] = field_type
+        for name, definition in accelerated_fields.items():
+            args["accelerated_fields.{}".format(name)] = json.dumps(
+                definition, sort_keys=True
+            )
+        return args
 
-            except HTTPError as error:
-                execution_error = True
-                self.logger.error(
-                    'run_id={} input={} status="error creating savedsearch" type=savedsearch create args={} details={}'.format(
-                        self.run_id, self.name, str(saved_search_args), str(error)
-                    )
-                )
-        return execution_error
+    def get_aggregation_transform_args(self, current):
+        """lookup transforms for the aggregated collection, copied from hosts_lookup, for when
+        ta_oversight_settings["additional_parameters"]["aggregated_lookup_name"] doesn't exist yet
 
-    @log_enter_exit()
-    def update_aggregation_transform_name(self, transform_name):
-        """if the ta_oversight_settings["additional_parameters]["aggregated_lookup_name]
-        doesn't exist; create it"""
-        name = copy.deepcopy(transform_name)
-        try:
-            existing_args = self.service.confs["transforms"]["hosts_lookup"].content()
-        except KeyError:
-            existing_args = {}
+        @param current:     dict, see load_knowledge_objects()
+        @returns            dict, transform name => args, for <name> and the unfiltered <name>_all
+        """
+        name = self.settings["aggregated_lookup_name"]
+        existing_args = self.get_current_content(current, "transforms", "hosts_lookup")
+        existing_args = existing_args or {}
         args = {
             "external_type": "kvstore",
             "collection": self.settings["aggregated_collection_name"],
             "fields_list": existing_args.get("fields_list"),
         }
+        all_args = dict(args)
         if "filter" in existing_args:
             args["filter"] = existing_args["filter"]
-        self.logger.debug(
-            "run_id={} script={} input={} method=update_aggregation_transform_name status=writing type=transform name={} args={}".format(
-                self.run_id, self.SCRIPT_NAME, self.name, str(name), str(args)
+        return {name: args, "{}_all".format(name): all_args}
+
+    @log_enter_exit("loading knowledge objects")
+    def load_knowledge_objects(self):
+        """read every kvstore collection, transform, macro and savedsearch visible to the app,
+        with one list request per knowledge object type
+
+        @returns    dict, conf_type => {name: splunklib.client.Entity}
+        """
+        current = {}
+        for conf_type in self.RECONCILED_CONF_TYPES:
+            current[conf_type] = {
+                entity.name: entity for entity in self.get_collection(conf_type).list()
+            }
+            self.logger.debug(
+                "run_id={} script={} method=load_knowledge_objects type={} count={}".format(
+                    self.run_id, self.SCRIPT_NAME, conf_type, len(current[conf_type])
+                )
             )
+        return current
+
+    def get_current_content(self, current, conf_type, name):
+        """@returns dict, settings of an existing knowledge object, or None if it does not exist"""
+        entity = current.get(conf_type, {}).get(name)
+        if entity is None:
+            return None
+        return entity.content
+
+    def add_desired_state(self, desired, conf_type, name, args):
+        """merge args into the desired settings of a knowledge object; settings without a value are not written
+
+        @param desired:     dict, conf_type => {name: args}; updated in place
+        @param conf_type:   string, one of RECONCILED_CONF_TYPES
+        @param name:        string, name of the knowledge object
+        @param args:        dict, settings
+        @returns            None
+        """
+        desired.setdefault(conf_type, {}).setdefault(name, {}).update(
+            {setting: value for setting, value in args.items() if value is not None}
         )
-        self.write_conf("transforms", name, args)
-        # write _all transform unfiltered
-        name = "{}_all".format(name)
-        del args["filter"]
-        self.logger.debug(
-            "run_id={} script={} input={} method=update_aggregation_transform_name status=writing type=transform name={} args={}".format(
-                self.run_id, self.SCRIPT_NAME, self.name, str(name), str(args)
+
+    @log_enter_exit()
+    def build_desired_state(self, current, desired):
+        """add the knowledge objects needed by this input (self.params) to desired.
+        Objects shared by every input, the aggregated collection and lookup and the eval_<last_inventoried>
+        macro, are merged, so desired describes all inputs once each has been added.
+
+        @param current:     dict, see load_knowledge_objects()
+        @param desired:     dict, conf_type => {name: args}; updated in place
+        @returns            dict, desired
+        """
+        ## aggregation collection and its typed and accelerated fields, and its mv_key index collection
+        self.add_desired_state(
+            desired,
+            "collections",
+            self.settings["aggregated_collection_name"],
+            self.get_collection_args(*self.get_collection_schema(aggregated=True)),
+        )
+        self.add_desired_state(desired, "collections", self.get_mvkey_index_name(), {})
+
+        ## aggregation lookup, if renamed
+        lookup_name = self.settings["aggregated_lookup_name"]
+        if lookup_name not in current["transforms"]:
+            for name, args in self.get_aggregation_transform_args(current).items():
+                if name not in desired.get("transforms", {}):
+                    self.add_desired_state(desired, "transforms", name, args)
+
+        ## `eval_last_inventoried`, if the time format or fieldname changed
+        existing_definition = (
+            self.get_current_content(current, "macros", "eval_last_inventoried") or {}
+        ).get("definition")
+        definition_update = self.update_last_inventoried_macro_definition(
+            self.settings["time_format"],
+            self.settings["last_inventoried_fieldname"],
+            existing_definition,
+        )
+        if definition_update:
+            self.add_desired_state(
+                desired,
+                "macros",
+                "eval_{}".format(self.settings["last_inventoried_fieldname"]),
+                {"definition": definition_update},
+            )
+
+        ## `inventory_time_format`, for searches parsing timestamps of records without epoch fields
+        self.add_desired_state(
+            desired,
+            "macros",
+            self.TIME_FORMAT_MACRO_NAME,
+            {"definition": '"{}"'.format(self.settings["time_format"])},
+        )
+
+        ## kvstore collection and lookup transforms
+        collection_name = self.name + "_collection"
+        transforms_name = self.name + "_lookup"
+        collection_args = {}
+        if self.params["replicate"]:
+            collection_args["replicate"] = "true"
+        self.add_desired_state(
+            desired,
+            "collections",
+            collection_name,
+            self.get_collection_args(*self.get_collection_schema(), **collection_args),
+        )
+
+        kv_lookup_fields = self.build_lookup_fieldlist()
+        transforms_args = {
+            "external_type": ["kvstore"],
+            "collection": [collection_name],
+            "case_sensitive_match": ["false"],
+            "fields_list": ",".join(kv_lookup_fields),
+        }
+        # transform without filter, but only needed if inventory_source
+        if self.params["inventory_source"]:
+            self.add_desired_state(
+                desired, "transforms", "{}_all".format(transforms_name), transforms_args
             )
+            transforms_args = dict(transforms_args, filter="expired=false")
+        self.add_desired_state(desired, "transforms", transforms_name, transforms_args)
+
+        ## macros
+        source_expression_macro_name = self.name + "_source"
+        source_definition = self.normalize_source_expression(
+            self.params["source_expression"]
         )
-        self.write_conf("transforms", name, args)
+        supported_generating_command = source_definition in SUPPORTED_GENERATING_COMMANDS
+        fields_macro_name = self.name + "_fields"
+        macros = {
+            source_expression_macro_name: source_definition,
+            fields_macro_name: ",".join(kv_lookup_fields),
+        }
+
+        enrichment_expression_macro_name = None
+        if self.params["enrichment_expression"]:
+            enrichment_expression_macro_name = self.name + "_enrichment_expression"
+            macros[enrichment_expression_macro_name] = self.params[
+                "enrichment_expression"
+            ]
+
+        source_filter_macro_name = None
+        if self.params["source_filter"]:
+            source_filter_macro_name = self.name + "_source_filter"
+            macros[source_filter_macro_name] = self.params["source_filter"]
+
+        # evaluated after | outputlookup and passed to exlcude events from update_inventory
+        inventory_filter_macro_name = None
+        if self.params["inventory_filter"]:
+            inventory_filter_macro_name = self.name + "_inventory_filter"
+            macros[inventory_filter_macro_name] = self.params["inventory_filter"]
+
+        for name, definition in macros.items():
+            self.add_desired_state(desired, "macros", name, {"definition": definition})
+
+        ## savedsearch; inventory sources run the update_inventory alert action
+        search_query = self.build_search_query(
+            source_expression_macro_name=source_expression_macro_name,
+            enrichment_expression_macro_name=enrichment_expression_macro_name,
+            original_id_field=self.params["id_field"],
+            id_field_rename=self.params["id_field_rename"],
+            source_filter_macro_name=source_filter_macro_name,
+            inventory_filter_macro_name=inventory_filter_macro_name,
+            fields_macro_name=fields_macro_name,
+            transforms_name=transforms_name,
+            last_inventoried_fieldname=self.settings["last_inventoried_fieldname"],
+            supported_generating_command=supported_generating_command,
+        )
+        saved_search_args = self.build_search_args()
+        saved_search_args["search"] = search_query
+        if self.params["inventory_source"]:
+            saved_search_args.update(self.alert_args)
+        self.add_desired_state(
+            desired, "savedsearches", self.build_search_name(), saved_search_args
+        )
+
+        ## extend the fieldlist of the aggregation transforms if necessary
+        if self.params["inventory_source"]:
+            lookup_args = desired.get("transforms", {}).get(
+                lookup_name
+            ) or self.get_current_content(current, "transforms", lookup_name)
+            updated_fieldlist = self.calculate_aggregation_transform_fieldlist(
+                self.get_aggregation_fieldlist(),
+                (lookup_args or {}).get("fields_list") or "",
+            )
+            if updated_fieldlist:
+                for name in [lookup_name, "{}_all".format(lookup_name)]:
+                    self.add_desired_state(
+                        desired, "transforms", name, {"fields_list": updated_fieldlist}
+                    )
+
+        return desired
+
+    def plan_reconciliation(self, current, desired):
+        """compare desired knowledge objects with current; only missing objects and changed settings are planned,
+        unchanged objects are counted in conf_write_counts["skipped"]
+
+        @param current:     dict, see load_knowledge_objects()
+        @param desired:     dict, see build_desired_state()
+        @returns            list of dicts with action (create or update), conf_type, name and args
+        """
+        plan = []
+        for conf_type in self.RECONCILED_CONF_TYPES:
+            for name, args in desired.get(conf_type, {}).items():
+                content = self.get_current_content(current, conf_type, name)
+                if content is None:
+                    action = "create"
+                else:
+                    action = "update"
+                    args = diff_conf_args(content, args)
+                    if not args:
+                        # counted as a skipped write, see write_conf()
+                        self.conf_write_counts["skipped"] += 1
+                        continue
+                plan.append(
+                    {"action": action, "conf_type": conf_type, "name": name, "args": args}
+                )
+        return plan
+
+    def format_plan(self, plan):
+        """@returns list of strings, one line per planned change"""
+        return [
+            "action={} type={} name={} args={}".format(
+                change["action"], change["conf_type"], change["name"], str(change["args"])
+            )
+            for change in plan
+        ]
+
+    @log_enter_exit()
+    def apply_plan(self, current, plan):
+        """create or update each knowledge object in plan; an error is logged and does not stop the rest
+
+        @param current:     dict, see load_knowledge_objects()
+        @param plan:        list, see plan_reconciliation()
+        @returns            int, count of changes which failed
+        """
+        errors = 0
+        for change in plan:
+            try:
+                self.write_conf(
+                    change["conf_type"],
+                    change["name"],
+                    change["args"],
+                    current[change["conf_type"]].get(change["name"]),
+                )
+            except HTTPError as error:
+                errors += 1
+                self.logger.error(
+                    'run_id={} script={} status="error applying change" action={} type={} name={} args={} details={}'.format(
+                        self.run_id,
+                        self.SCRIPT_NAME,
+                        change["action"],
+                        change["conf_type"],
+                        change["name"],
+                        str(change["args"]),
+                        str(error),
+                    )
+                )
+                continue
+            self.logger.debug(
+                "run_id={} script={} status=applied action={} type={} name={} args={}".format(
+                    self.run_id,
+                    self.SCRIPT_NAME,
+                    change["action"],
+                    change["conf_type"],
+                    change["name"],
+                    str(change["args"]),
+                )
+            )
+        return errors
 
     def normalize_source_expression(self, definition):
         """strip any leading '|' from definition.  It will need to be prepended to the search if
@@ -685,6 +957,9 @@ def stream_events(self, inputs, ew):
     """main method that executes when input parameter settings are saved in the UI and on interval
     (or splunkd restart if interval=-1)
 
+    The run's metrics are emitted as one oversight:metrics event, see OversightScript.emit_run_metrics(),
+    also when it fails.
+
     @param inputs:  Splunk InputDefinition
     @param ew:      splunk event writer
     @returns        None
@@ -695,296 +970,104 @@ def stream_events(self, inputs, ew):
             "stream_events service object is null, this should not happen."
         )
 
-    for input_name, input in iteritems(inputs.__dict__["inputs"]):
-        input["name"] = input_name
-        builder = OversightBuilder()
-        app_settings = builder.read_app_settings(self.service.token)
-        builder.logger.debug(
-            "run_id={} done reading app_settings".format(builder.run_id)
-        )
+    builder = OversightBuilder()
+    status = "failed"
+    counters = {}
+    error = None
+    try:
+        status, counters = reconcile_inputs(self, builder, inputs)
+    except BaseException as exception:
+        error = exception
+        raise
+    finally:
+        builder.emit_run_metrics(status, error=error, **counters)
 
-        builder.settings = builder.normalize_global_settings(app_settings)
-        builder.logger.debug(
-            "run_id={} done normalizing global settings".format(builder.run_id)
-        )
-        builder.setup(self.service, app_settings)
-        builder.logger.debug(
-            "run_id={} app global settings={}".format(
-                builder.run_id, str(builder.settings)
-            )
-        )
-        arguments = self.get_scheme().arguments
-        builder.logger.debug(
-            "run_id={} got scheme arguments={}".format(builder.run_id, str(arguments))
-        )
-        builder.params = builder.normalize_input_parameters(input, arguments)
-        builder.logger.debug(
-            "run_id={} normalized input parameters={}".format(
-                builder.run_id, str(builder.params)
-            )
-        )
-        builder.name = builder.params["name"]
-        if builder.settings.get("loglevel"):
-            log.Logs().set_level(builder.settings["loglevel"])
 
-        builder.logger.info(
-            'run_id={} input={} status="setup completed", args={} connected={}'.format(
-                builder.run_id,
-                builder.name,
-                str(builder.params),
-                "true" if builder.service else "false",
-            )
-        )
+def reconcile_inputs(self, builder, inputs):
+    """write the knowledge objects of every input, see stream_events()
 
-        ## create aggregation collection if needed
-        if (
-            builder.settings["aggregated_collection_name"]
-            not in builder.service.kvstore
-        ):
-            builder.service.kvstore.create(
-                builder.settings["aggregated_collection_name"]
-            )
-            builder.logger.debug(
-                "run_id={} input={} creating kvstore={}".format(
+    @param self:    the modular input, with service and get_scheme()
+    @param builder: OversightBuilder
+    @param inputs:  Splunk InputDefinition
+    @returns        tuple, run status and counters for OversightScript.emit_run_metrics()
+    """
+    ## app settings are loaded once for all inputs
+    with builder.metrics.phase("settings_load"):
+        app_settings = builder.load_app_settings(self.service.token)
+    builder.logger.debug("run_id={} done reading app_settings".format(builder.run_id))
+
+    builder.settings = builder.flatten_app_settings(app_settings)
+    builder.setup(self.service, app_settings)
+    builder.logger.debug(
+        "run_id={} app global settings={}".format(builder.run_id, str(builder.settings))
+    )
+    if builder.settings.get("loglevel"):
+        log.Logs().set_level(builder.settings["loglevel"])
+    arguments = self.get_scheme().arguments
+    builder.logger.debug(
+        "run_id={} got scheme arguments={}".format(builder.run_id, str(arguments))
+    )
+
+    ## load existing knowledge objects, build what every input needs, then write only the differences
+    with builder.metrics.phase("conf_load"):
+        current = builder.load_knowledge_objects()
+    desired = {}
+    input_names = []
+    with builder.metrics.phase("reconcile_plan"):
+        for input_name, input in iteritems(inputs.__dict__["inputs"]):
+            input["name"] = input_name
+            builder.params = builder.normalize_input_parameters(input, arguments)
+            builder.name = builder.params["name"]
+            builder.logger.info(
+                'run_id={} input={} status="setup completed", args={} connected={}'.format(
                     builder.run_id,
-                    builder.params["name"],
-                    builder.settings["aggregated_collection_name"],
+                    builder.name,
+                    str(builder.params),
+                    "true" if builder.service else "false",
                 )
             )
+            builder.build_desired_state(current, desired)
+            input_names.append(builder.name)
 
-        ## create aggregation lookup if needed or rename
-        target_transform_name = builder.settings["aggregated_lookup_name"]
-        if target_transform_name not in builder.service.confs["transforms"]:
-            builder.update_aggregation_transform_name(target_transform_name)
-
-        ## create or update `eval_last_inventoried` if needed
-
-        try:
-            eval_last_inventoried_macro = builder.service.confs["macros"][
-                "eval_last_inventoried"
-            ]
-        except KeyError:
-            eval_last_inventoried_macro = None
-            builder.logger.debug(
-                'run_id={} input={} status="could not get last inventoried macro"'.format(
-                    builder.run_id, builder.name
-                )
-            )
-        existing_definition = (
-            eval_last_inventoried_macro.content().definition
-            if eval_last_inventoried_macro
-            else None
-        )
-        builder.logger.debug(
-            'run_id={} input={} status="got last_inventoried macro definition"'.format(
-                builder.run_id, builder.name
-            )
-        )
-        definition_update = builder.update_last_inventoried_macro_definition(
-            builder.settings["time_format"],
-            builder.settings["last_inventoried_fieldname"],
-            existing_definition,
-        )
-        if definition_update:
-            new_macro_name = "eval_{}".format(
-                builder.settings["last_inventoried_fieldname"]
-            )
-            builder.logger.debug(
-                'run_id={} input={} status="writing updated last_inventoried macro definition"'.format(
-                    builder.run_id, builder.name
-                )
-            )
-            builder.write_macro(new_macro_name, definition_update)
-        else:
-            builder.logger.debug(
-                'run_id={} input={} status="no update to last_inventoried macro needed"'.format(
-                    builder.run_id, builder.name
+        plan = builder.plan_reconciliation(current, desired)
+    builder.source_name = ",".join(input_names)
+    if builder.RECONCILE_DRY_RUN:
+        for line in builder.format_plan(plan):
+            builder.logger.info(
+                "run_id={} script={} status=dry_run {}".format(
+                    builder.run_id, builder.SCRIPT_NAME, line
                 )
             )
-
-        ## create macros
-        source_expression_macro_name = None
-        enrichment_expression_macro_name = None
-        source_filter_macro_name = None
-        inventory_filter_macro_name = None
-        fields_macro_name = None
-        transforms_name = None
-        kv_lookup_fields = []
-
-        ## Create kvstore or update if already exists
-        collection_args = {}
-        collection_name = builder.name + "_collection"
-        transforms_name = builder.name + "_lookup"
-
-        if builder.params["replicate"]:
-            collection_args["replicate"] = "true"
-
-        builder.logger.debug(
-            "run_id={} input={} collection={} replicate={}".format(
+        builder.logger.info(
+            "run_id={} script={} status=dry_run inputs={} changes={} unchanged={}".format(
                 builder.run_id,
-                builder.name,
-                collection_name,
-                "true" if collection_args.get("replicate") else "false",
+                builder.SCRIPT_NAME,
+                ",".join(input_names),
+                len(plan),
+                builder.conf_write_counts["skipped"],
             )
         )
-        if collection_name in builder.service.kvstore:
-            builder.service.kvstore[collection_name].update(**collection_args)
-            builder.logger.debug(
-                "run_id={} input={} collection={} status=updated, args={}".format(
-                    builder.run_id, builder.name, collection_name, str(collection_args)
-                )
-            )
-        else:
-            builder.service.kvstore.create(name=collection_name, **collection_args)
-            builder.logger.debug(
-                "run_id={} input={} collection={} status=created, args={}".format(
-                    builder.run_id, builder.name, collection_name, str(collection_args)
-                )
-            )
-
-        kv_lookup_fields = builder.build_lookup_fieldlist()
-        builder.logger.debug('run_id={} input={} status="building transform fieldlist"')
-
-        ## Write lookup transforms
-        transforms_args = {
-            "external_type": ["kvstore"],
-            "collection": [collection_name],
-            "case_sensitive_match": ["false"],
-            "fields_list": ",".join(kv_lookup_fields),
+        return "dry_run", {
+            "planned_changes": len(plan),
+            "writes_skipped": builder.conf_write_counts["skipped"],
         }
-        if builder.params["inventory_source"]:
-            transforms_args.update({"filter": "expired=false"})
-
-        builder.logger.debug(
-            "run_id={} input={} writing type=transform name={} args={}".format(
-                builder.run_id, builder.name, str(transforms_name), str(transforms_args)
-            )
-        )
-        builder.write_conf("transforms", transforms_name, transforms_args)
-
-        ## Write transform without filter, but only needed if inventory_source
-        if builder.params["inventory_source"]:
-            transforms_all_name = "{}_all".format(transforms_name)
-            transforms_all_args = transforms_args
-            del transforms_all_args["filter"]
-
-            builder.logger.debug(
-                "run_id={} input={} writing type=transform name={} args={}".format(
-                    builder.run_id,
-                    builder.name,
-                    transforms_all_name,
-                    str(transforms_all_args),
-                )
-            )
-            builder.write_conf("transforms", transforms_all_name, transforms_all_args)
-
-        ## Define and Write macros
-        source_expression_macro_name = builder.name + "_source"
-        source_definition = builder.normalize_source_expression(
-            builder.params["source_expression"]
-        )
-        supported_generating_command = False
-        if source_definition in SUPPORTED_GENERATING_COMMANDS:
-            supported_generating_command = True
-
-        builder.write_macro(source_expression_macro_name, source_definition)
-
-        fields_macro_name = builder.name + "_fields"
-        builder.write_macro(fields_macro_name, ",".join(kv_lookup_fields))
-
-        if builder.params["enrichment_expression"]:
-            enrichment_expression_macro_name = builder.name + "_enrichment_expression"
-            builder.write_macro(
-                enrichment_expression_macro_name,
-                builder.params["enrichment_expression"],
-            )
-
-        if builder.params["source_filter"]:
-            source_filter_macro_name = builder.name + "_source_filter"
-            builder.write_macro(
-                source_filter_macro_name, builder.params["source_filter"]
-            )
-
-        # evaluated after | outputlookup and passed to exlcude events from update_inventory
-        if builder.params["inventory_filter"]:
-            inventory_filter_macro_name = builder.name + "_inventory_filter"
-            builder.write_macro(
-                inventory_filter_macro_name, builder.params["inventory_filter"]
-            )
-
-        ## Build search query for saved search
-        search_query = builder.build_search_query(
-            source_expression_macro_name=source_expression_macro_name,
-            enrichment_expression_macro_name=enrichment_expression_macro_name,
-            original_id_field=builder.params["id_field"],
-            id_field_rename=builder.params["id_field_rename"],
-            source_filter_macro_name=source_filter_macro_name,
-            inventory_filter_macro_name=inventory_filter_macro_name,
-            fields_macro_name=fields_macro_name,
-            transforms_name=transforms_name,
-            last_inventoried_fieldname=builder.settings["last_inventoried_fieldname"],
-            supported_generating_command=supported_generating_command,
-        )
-        saved_search_name = builder.build_search_name()
-        saved_search_args = builder.build_search_args()
 
-        builder.logger.debug(
-            "run_id={} input={} writing type=savedsearch, name={} search={} args={}".format(
-                builder.run_id,
-                builder.name,
-                saved_search_name,
-                str(search_query),
-                str(saved_search_args),
-            )
-        )
-        savedsearch_write_error = builder.write_savedsearch_definition(
-            saved_search_name, saved_search_args, search_query
+    with builder.metrics.phase("reconcile_apply"):
+        errors = builder.apply_plan(current, plan)
+    builder.logger.info(
+        "run_id={} script={} status={} inputs={} writes_applied={} writes_skipped={} errors={}".format(
+            builder.run_id,
+            builder.SCRIPT_NAME,
+            "completed" if not errors else '"completed with error"',
+            ",".join(input_names),
+            builder.conf_write_counts["applied"],
+            builder.conf_write_counts["skipped"],
+            errors,
         )
-
-        if builder.params["inventory_source"]:
-            """
-            If the input is an inventory source, set the alert action to run
-            when the savedsearch executes
-
-            Also extend the fieldlist of the aggregation transforms if necessary
-            """
-
-            savedsearch_stanza = builder.service.confs["savedsearches"][
-                saved_search_name
-            ]
-            savedsearch_stanza.submit(builder.alert_args)
-            savedsearch_stanza.refresh()
-
-            # get list of fields from this input which need to be aggregated
-            aggregating_fields = builder.get_aggregation_fieldlist()
-
-            aggregation_transform = builder.service.confs["transforms"][
-                "{}".format(builder.settings["aggregated_lookup_name"])
-            ]
-
-            existing_fields = aggregation_transform.fields_list
-
-            # calculate new fieldlist to write, if needed
-            updated_fieldlist = builder.calculate_aggregation_transform_fieldlist(
-                aggregating_fields, existing_fields
-            )
-            # write update fieldlist (if any) to confs['transforms']
-            builder.logger.debug(
-                "run_id={} input={} writing updated_field={} to aggregation transforms".format(
-                    builder.run_id, builder.name, str(updated_fieldlist)
-                )
-            )
-            builder.update_aggregation_transform(updated_fieldlist)
-
-        if not savedsearch_write_error:
-            builder.logger.info(
-                "run_id={} input={} status=completed, args={}".format(
-                    builder.run_id, builder.name, str(builder.params)
-                )
-            )
-        else:
-            builder.logger.info(
-                'run_id={} input={} status="completed with error", args={}'.format(
-                    builder.run_id, builder.name, str(builder.params)
-                )
-            )
+    )
+    return "completed" if not errors else "completed_with_errors", {
+        "planned_changes": len(plan),
+        "writes_applied": builder.conf_write_counts["applied"],
+        "writes_skipped": builder.conf_write_counts["skipped"],
+        "errors": errors,
+    }
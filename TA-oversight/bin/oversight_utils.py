@@ -1,24 +1,255 @@
 # encoding = utf-8
 
+import concurrent.futures
+import contextlib
 import copy
+import csv
+import functools
+import gzip
+import http.client
 import inspect
+import io
+import itertools
 import json
+import logging
+import logging.handlers
+import operator
 import os
+import select
+import sqlite3
+import ssl
+import sys
+import tempfile
+import threading
 import time
 from datetime import datetime, timedelta
 
 import import_declare_test
+import splunklib
 import splunklib.binding as binding
 from solnlib import conf_manager, log
 from splunklib.client import HTTPError, namespace
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+DEFAULT_TIME_FORMAT = "%Y-%m-%d %H:%M"  # default time_format in ta_oversight_settings.conf
+TIMESTRING_CACHE_SIZE = 65536
+HTTP_HANDLERS = {}  # pool size => PooledHTTPHandler, see get_http_handler()
+SETTINGS_CACHE_FILENAME = "settings_cache.json"
+APP_SETTINGS_SNAPSHOT_FILENAME = "app_settings_snapshot.json"
+APP_SETTINGS_SNAPSHOT = {}  # version, settings; see OversightScript.load_app_settings()
+METRICS_LOG_FILENAME = "ta_oversight_metrics.log"  # sourcetype oversight:metrics, see props.conf
+METRICS_LOG_MAX_BYTES = 10 * 2 ** 20
+METRICS_LOG_BACKUP_COUNT = 2
+
+
+@functools.lru_cache(maxsize=TIMESTRING_CACHE_SIZE)
+def parse_timestring(timestring, timeformat):
+    """memoized datetime.strptime(timestring, timeformat).
+    Inventory timestamps are usually minute granularity, so a run sees a few thousand distinct
+    values many times over; each (timestring, timeformat) pair is only parsed once.
+    The default time format is parsed by slicing instead of strptime.
+
+    @param timestring:  string
+    @param timeformat:  string, strptime format
+    @returns            datetime.datetime, raises ValueError if timestring does not match timeformat
+    """
+    if (
+        timeformat == DEFAULT_TIME_FORMAT
+        and len(timestring) == 16
+        and timestring[4] == "-"
+        and timestring[7] == "-"
+        and timestring[10] == " "
+        and timestring[13] == ":"
+    ):
+        digits = (
+            timestring[0:4]
+            + timestring[5:7]
+            + timestring[8:10]
+            + timestring[11:13]
+            + timestring[14:16]
+        )
+        if digits.isascii() and digits.isdigit():
+            try:
+                return datetime(
+                    int(digits[0:4]),
+                    int(digits[4:6]),
+                    int(digits[6:8]),
+                    int(digits[8:10]),
+                    int(digits[10:12]),
+                )
+            except ValueError:
+                # out of range values, let strptime raise the usual error
+                pass
+    return datetime.strptime(timestring, timeformat)
+
+
+def copy_record(record):
+    """copy a kvstore record so it can be modified without changing the original.
+    Records are flat dicts of strings and lists of strings, so a new dict with new lists is
+    an independent copy without the cost of copy.deepcopy.
+
+    @param record:  dict
+    @returns        dict
+    """
+    return {
+        key: list(value) if isinstance(value, list) else value
+        for key, value in record.items()
+    }
+
+
+def dedupe_documents_by_key(documents):
+    """keep only the last document written for each _key, in the order those last writes were
+    made. batch_save replaces whole documents, so earlier writes to the same _key are superseded.
+    Documents without a _key (new records keyed by the kvstore) are always kept.
+
+    @param documents:   list of dicts or json strings
+    @returns            list
+    """
+    output = []
+    seen = set()
+    for document in reversed(documents):
+        record = json.loads(document) if isinstance(document, str) else document
+        key = record.get("_key") if isinstance(record, dict) else None
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        output.append(document)
+    output.reverse()
+    return output
+
+
+def datetime_to_epoch(value):
+    """@param value:    datetime.datetime, naive local time as parsed by parse_timestring()
+    @returns            int, seconds since the epoch"""
+    return int(time.mktime(value.timetuple()))
+
+
+def make_key_query(keys, field="_key"):
+    """kvstore query matching any of keys by _key, or by another field
+
+    @param keys:    list of strings
+    @param field:   string
+    @returns        dict
+    """
+    if len(keys) == 1:
+        return {field: keys[0]}
+    return {"$or": [{field: key} for key in keys]}
+
+
+def normalize_conf_value(value):
+    """normalize a conf setting for comparison: splunk returns booleans as "0"/"1" or "true"/"false",
+    lists as comma separated strings, and unset settings as empty strings"""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (list, tuple)):
+        value = ",".join(str(i) for i in value)
+    value = str(value).strip() if value is not None else ""
+    if value and value.lower() in ["true", "t", "yes", "1"]:
+        return "1"
+    if value and value.lower() in ["false", "f", "no", "0"]:
+        return "0"
+    return value
+
+
+def diff_conf_args(current, desired):
+    """settings in desired which differ from current; accelerated_fields are compared as json
+
+    @param current:     dict, existing settings of a knowledge object
+    @param desired:     dict, settings to write
+    @returns            dict, the settings of desired which need to be written
+    """
+    changed = {}
+    for setting, value in desired.items():
+        current_value = current.get(setting)
+        if setting.startswith("accelerated_fields."):
+            if isinstance(current_value, str):
+                try:
+                    current_value = json.loads(current_value)
+                except ValueError:
+                    pass
+            unchanged = current_value == (
+                json.loads(value) if isinstance(value, str) else value
+            )
+        else:
+            unchanged = normalize_conf_value(current_value) == normalize_conf_value(
+                value
+            )
+        if not unchanged:
+            changed[setting] = value
+    return changed
+
 
-def log_enter_exit(msg="entered"):
-    """logging decorator, example from solnlib.log"""
+def get_settings_cache_path(splunkhome, app_name):
+    """@returns string, path of the settings cache shared by the app's processes, see OversightScript.get_input_settings()"""
+    return os.path.join(splunkhome, "var", "run", app_name, SETTINGS_CACHE_FILENAME)
+
+
+def write_json_atomic(path, value):
+    """write value as json to a temporary file which then replaces path, so concurrent readers
+    see either the old or the new file, never a partial one"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=".{}.".format(os.path.basename(path))
+    )
+    try:
+        with os.fdopen(temp_fd, "w") as temp_file:
+            json.dump(value, temp_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def invalidate_settings_cache(path):
+    """remove the settings cache, so the next reader fetches current settings"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def format_log_payload(value, max_length=None):
+    """str() a value for logging, truncated to max_length characters when set"""
+    output = str(value)
+    if max_length and len(output) > max_length:
+        output = "{}...(truncated {} chars)".format(
+            output[:max_length], str(len(output) - max_length)
+        )
+    return output
+
+
+def log_enter_exit(msg="entered", max_length=None, sample_rate=None):
+    """logging decorator, example from solnlib.log
+
+    The signature of the decorated method is inspected once, and arguments and return values
+    are only formatted when the logger is enabled for DEBUG, so instrumented hot paths cost a
+    single level check in production.  Payloads are truncated to max_length characters and
+    only one in every sample_rate calls is logged; both default to the instance's
+    LOG_PAYLOAD_MAX_LENGTH and LOG_PAYLOAD_SAMPLE_RATE.
+    """
 
     def log_decorator(func):
+        signature = inspect.signature(func)
+        call_counter = itertools.count()
+
+        @functools.wraps(func)
         def wrapper(self=None, *args, **kwargs):
-            bound = inspect.signature(func).bind(self, *args, **kwargs)
+            if not self.logger.isEnabledFor(logging.DEBUG):
+                return func(self, *args, **kwargs)
+
+            rate = sample_rate or getattr(self, "LOG_PAYLOAD_SAMPLE_RATE", 1) or 1
+            if next(call_counter) % int(rate) != 0:
+                return func(self, *args, **kwargs)
+
+            length = max_length or getattr(self, "LOG_PAYLOAD_MAX_LENGTH", None)
+            bound = signature.bind(self, *args, **kwargs)
             self.logger.debug(
                 'run_id={} script={} input={} method={} status="{}" args={}'.format(
                     self.run_id,
@@ -26,7 +257,10 @@ def log_enter_exit(msg="entered"):
                     str(self.params.get("name")),
                     func.__name__,
                     str(msg),
-                    str([{k: v} for k, v in bound.arguments.items() if k != "self"]),
+                    format_log_payload(
+                        [{k: v} for k, v in bound.arguments.items() if k != "self"],
+                        length,
+                    ),
                 )
             )
             if self:
@@ -41,7 +275,7 @@ def log_enter_exit(msg="entered"):
                         self.SCRIPT_NAME,
                         str(self.params.get("name")),
                         func.__name__,
-                        str(result),
+                        format_log_payload(result, length),
                     )
                 )
             else:
@@ -60,6 +294,474 @@ def log_enter_exit(msg="entered"):
     return log_decorator
 
 
+class MvKeyIndex:
+    """disjoint-set (union-find) index over multi-value key values.
+    Every value of a record's mv_key is linked to the others, so values which are linked through any
+    chain of records (A~B in one record, B~C in another) end up in one connected component.
+    find() uses path halving and union() links by size, so building the index is near-linear.
+
+    >>> index = MvKeyIndex()
+    >>> index.add(["1.1.1.1", "2.2.2.2"])
+    >>> index.add(["3.3.3.3", "2.2.2.2"])
+    >>> index.get_mvkey("1.1.1.1")
+    ['1.1.1.1', '2.2.2.2', '3.3.3.3']
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+        self._components = None  # root => sorted members, built on demand
+
+    def __contains__(self, value):
+        return value in self.parent
+
+    def __len__(self):
+        return len(self.parent)
+
+    def find(self, value):
+        """return the root value of the component containing value, adding value if unseen"""
+        parent = self.parent
+        if value not in parent:
+            parent[value] = value
+            self.size[value] = 1
+            self._components = None
+            return value
+        while parent[value] != value:
+            parent[value] = parent[parent[value]]
+            value = parent[value]
+        return value
+
+    def union(self, first, second):
+        """merge the components containing first and second; returns the new root"""
+        first = self.find(first)
+        second = self.find(second)
+        if first == second:
+            return first
+        if self.size[first] < self.size[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.size[first] += self.size.pop(second)
+        self._components = None
+        return first
+
+    def add(self, values):
+        """link every value of one mv_key together
+
+        @param values:  list of strings, or a single string
+        """
+        if not values:
+            return
+        if isinstance(values, str):
+            values = [values]
+        first = values[0]
+        self.find(first)
+        for value in values[1:]:
+            first = self.union(first, value)
+
+    def components(self):
+        """@returns dict, root value => sorted list of the values in its component, for components
+        with more than one value"""
+        if self._components is None:
+            members = {}
+            for value in self.parent:
+                root = self.find(value)
+                if self.size[root] > 1:
+                    members.setdefault(root, []).append(value)
+            for values in members.values():
+                values.sort()
+            self._components = members
+        return self._components
+
+    def get_mvkey(self, value):
+        """the canonical mv_key for value: the sorted values of its component, or None if value is
+        not linked to any other value"""
+        if value not in self.parent:
+            return None
+        return self.components().get(self.find(value))
+
+
+class KeySet:
+    """set of string keys, held in memory up to max_memory_keys and spilled beyond that to a private
+    temporary sqlite database (deleted by sqlite when closed), so a large number of matched keys does not
+    have to fit in memory.  Supports add(), update(), `in`, len() and iteration like a set.
+
+    >>> keys = KeySet(max_memory_keys=2)
+    >>> keys.update(["a", "b", "c", "a"])
+    >>> len(keys), "c" in keys, keys.spilled
+    (3, True, True)
+    """
+
+    def __init__(self, max_memory_keys=None):
+        self.max_memory_keys = max_memory_keys  # None = never spill
+        self.keys = set()  # in memory keys, not yet spilled
+        self.db = None
+
+    @property
+    def spilled(self):
+        return self.db is not None
+
+    def add(self, key):
+        self.keys.add(key)
+        if self.max_memory_keys and len(self.keys) >= self.max_memory_keys:
+            self.spill()
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def spill(self):
+        """move the in memory keys to the sqlite database"""
+        if self.db is None:
+            self.db = sqlite3.connect("")
+            self.db.execute("CREATE TABLE keys (key TEXT PRIMARY KEY) WITHOUT ROWID")
+        if self.keys:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO keys VALUES (?)", ((key,) for key in self.keys)
+            )
+            self.keys = set()
+
+    def __contains__(self, key):
+        if key in self.keys:
+            return True
+        if self.db is None:
+            return False
+        return (
+            self.db.execute("SELECT 1 FROM keys WHERE key = ?", (key,)).fetchone()
+            is not None
+        )
+
+    def __len__(self):
+        if self.db is None:
+            return len(self.keys)
+        self.spill()
+        return self.db.execute("SELECT COUNT(*) FROM keys").fetchone()[0]
+
+    def __iter__(self):
+        if self.db is None:
+            return iter(list(self.keys))
+        self.spill()
+        return (row[0] for row in self.db.execute("SELECT key FROM keys"))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        self.keys = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SessionReuseHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPSConnection which resumes the TLS session of an earlier connection to the same host, so a new
+    connection skips the full handshake.  tls_sessions is shared by the connections of a PooledHTTPHandler."""
+
+    def __init__(self, host, port, tls_sessions, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.tls_sessions = tls_sessions
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(
+            self.sock,
+            server_hostname=self.host,
+            session=self.tls_sessions.get((self.host, self.port)),
+        )
+        self.save_tls_session()
+
+    def save_tls_session(self):
+        # with TLS 1.3 the session ticket is only received after the handshake, so this is repeated per response
+        if self.sock is not None and getattr(self.sock, "session", None) is not None:
+            self.tls_sessions[(self.host, self.port)] = self.sock.session
+
+
+class PooledHTTPHandler:
+    """splunklib.binding HTTP request handler which keeps connections to splunkd open (keep-alive) and reuses
+    them, with their TLS sessions, instead of connecting for every REST call like splunklib.binding.handler().
+    Up to pool_size idle connections are kept per host; it is safe to share between threads and services.
+    Response bodies are read before the connection is returned to the pool.
+    Idle connections splunkd has closed meanwhile are replaced before use.  A request failing on a reused
+    connection is sent again on a new one only if it was not sent, or if its method is idempotent:
+    a POST (ie batch_save or a conf update) which may have reached splunkd is never repeated.
+
+    >>> service = client.connect(token=token, handler=get_http_handler())
+    """
+
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, pool_size=4, timeout=None, verify=False, context=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        if context is None:
+            context = (
+                ssl.create_default_context()
+                if verify
+                else ssl._create_unverified_context()  # nosemgrep, as splunklib.binding.handler()
+            )
+        self.context = context
+        self.idle = {}  # (scheme, host, port) => list of idle connections
+        self.tls_sessions = {}  # (host, port) => ssl.SSLSession
+        self.lock = threading.Lock()
+        self.connections_opened = 0
+        self.requests = 0
+        self.bytes_sent = 0  # request bodies
+
+    def new_connection(self, scheme, host, port):
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs["timeout"] = self.timeout
+        with self.lock:
+            self.connections_opened += 1
+        if scheme == "http":
+            return http.client.HTTPConnection(host, port, **kwargs)
+        if scheme == "https":
+            return SessionReuseHTTPSConnection(
+                host, port, self.tls_sessions, context=self.context, **kwargs
+            )
+        raise ValueError("unsupported scheme: {}".format(scheme))
+
+    def acquire(self, scheme, host, port):
+        """@returns (connection, bool), an idle connection if there is one, and whether it was reused"""
+        while True:
+            with self.lock:
+                idle = self.idle.get((scheme, host, port))
+                connection = idle.pop() if idle else None
+            if connection is None:
+                return self.new_connection(scheme, host, port), False
+            if not is_connection_dropped(connection):
+                return connection, True
+            connection.close()
+
+    def release(self, scheme, host, port, connection):
+        """keep connection for reuse, or close it if pool_size connections are already idle"""
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host, port), [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """close all idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def __call__(self, url, message, **kwargs):
+        scheme, host, port, path = binding._spliturl(url)
+        body = message.get("body", "")
+        head = {
+            "Content-Length": str(len(body)),
+            "Host": host,
+            "User-Agent": "splunk-sdk-python/{}".format(splunklib.__version__),
+            "Accept": "*/*",
+            "Connection": "Keep-Alive",
+        }
+        for key, value in message["headers"]:
+            head[key] = value
+        method = message.get("method", "GET")
+
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += len(body)
+        connection, reused = self.acquire(scheme, host, port)
+        while True:
+            sent = False
+            try:
+                connection.request(method, path, body, head)
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if not reused or (sent and method not in self.IDEMPOTENT_METHODS):
+                    raise
+                # splunkd closed the idle connection; retry once on a new one
+                connection, reused = self.new_connection(scheme, host, port), False
+            except Exception:
+                connection.close()
+                raise
+
+        if isinstance(connection, SessionReuseHTTPSConnection):
+            connection.save_tls_session()
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(scheme, host, port, connection)
+
+        return {
+            "status": response.status,
+            "reason": response.reason,
+            "headers": response.getheaders(),
+            "body": binding.ResponseReader(io.BytesIO(data)),
+        }
+
+
+def is_connection_dropped(connection):
+    """True if the peer closed an idle connection: its socket is readable (EOF) though no request is pending"""
+    if connection.sock is None:
+        # not connected yet, http.client connects on the next request
+        return False
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+def get_http_handler(pool_size=4):
+    """@returns PooledHTTPHandler keeping pool_size idle connections, shared by every splunklib service of this
+    process using that size; the size of a handler never changes, so callers can't resize each other's pool"""
+    handler = HTTP_HANDLERS.get(pool_size)
+    if handler is None:
+        handler = HTTP_HANDLERS.setdefault(pool_size, PooledHTTPHandler(pool_size))
+    return handler
+
+
+def get_http_counters():
+    """@returns dict, REST calls made and request body bytes sent so far by the shared PooledHTTPHandlers"""
+    counters = {"rest_calls": 0, "bytes_sent": 0}
+    for handler in list(HTTP_HANDLERS.values()):
+        with handler.lock:
+            counters["rest_calls"] += handler.requests
+            counters["bytes_sent"] += handler.bytes_sent
+    return counters
+
+
+def get_peak_rss_bytes():
+    """@returns int, peak resident set size of this process, or None where it can't be read"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunMetrics:
+    """phase timings and counters of one script run, reported as a single JSON event by get_event().
+
+    Phases may nest, ie a flush during aggregation: seconds includes the nested phases and self_seconds
+    does not, so the self_seconds of all phases add up to the time covered by phases.  Phases are meant
+    to be timed from the script's main thread; counters may be updated from any thread.
+
+    >>> with metrics.phase("aggregation"):
+    ...     metrics.count("rows_read")
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.phases = {}  # name => count, seconds, self_seconds, max_seconds
+        self.counters = {}
+        self.nested_seconds = []  # seconds of phases nested in each open phase
+        self.lock = threading.Lock()
+        self.http_start = get_http_counters()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """time the enclosed block as one occurrence of phase name"""
+        self.nested_seconds.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            nested = self.nested_seconds.pop()
+            self.add_phase(name, seconds, seconds - nested)
+
+    def add_phase(self, name, seconds, self_seconds=None):
+        """record one occurrence of phase name, for time measured piecewise, ie while a generator runs
+
+        @param name:            string, phase name
+        @param seconds:         float, time spent in the phase
+        @param self_seconds:    float or None, time not spent in nested phases; default seconds
+        """
+        if self_seconds is None:
+            self_seconds = seconds
+        with self.lock:
+            if self.nested_seconds:
+                self.nested_seconds[-1] += seconds
+            phase = self.phases.setdefault(
+                name, {"count": 0, "seconds": 0.0, "self_seconds": 0.0, "max_seconds": 0.0}
+            )
+            phase["count"] += 1
+            phase["seconds"] += seconds
+            phase["self_seconds"] += self_seconds
+            phase["max_seconds"] = max(phase["max_seconds"], seconds)
+
+    def count(self, name, value=1):
+        """add value to counter name"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_event(self, **fields):
+        """@param fields:   identify the run, ie run_id, script and status
+        @returns            dict, the metrics event; fields first, then duration, phases, counters and peak RSS
+        """
+        http_counters = get_http_counters()
+        with self.lock:
+            counters = dict(self.counters)
+            phases = {
+                name: {
+                    key: round(value, 6) if isinstance(value, float) else value
+                    for key, value in phase.items()
+                }
+                for name, phase in self.phases.items()
+            }
+        for name, value in http_counters.items():
+            counters[name] = counters.get(name, 0) + value - self.http_start[name]
+
+        event = {"time": round(time.time(), 3), "started": round(self.started, 3)}
+        event.update(fields)
+        event.update(
+            duration_seconds=round(time.perf_counter() - self.start, 6),
+            phases=phases,
+            counters=counters,
+            peak_rss_bytes=get_peak_rss_bytes(),
+        )
+        return event
+
+
+def write_metrics_event(path, event):
+    """append event as one line of JSON to the metrics log at path, rotated like the solnlib script logs"""
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=METRICS_LOG_MAX_BYTES, backupCount=METRICS_LOG_BACKUP_COUNT
+    )
+    try:
+        handler.emit(logging.makeLogRecord({"msg": json.dumps(event)}))
+    finally:
+        handler.close()
+
+
+def record_run_metrics(func):
+    """decorator for a script's main method: emits the run's metrics event when it returns, exits or raises,
+    with status=completed if it returned a true value and status=failed otherwise, and the error raised"""
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        status = "failed"
+        error = None
+        try:
+            result = func(self, *args, **kwargs)
+            if result:
+                status = "completed"
+            return result
+        except BaseException as exception:
+            # sys.exit() included
+            error = exception
+            raise
+        finally:
+            self.emit_run_metrics(status, error=error)
+
+    return wrapper
+
+
 class MissingAppSetting(Exception):
     """This exception indicates that a required setting is missing"""
 
@@ -91,6 +793,25 @@ class OversightScript:
     AGGREGATED_COLLECTION_NAME = "hosts_collection"
     MODINPUT_KIND = "oversight"  # name of modular input definition in inputs.conf.spec
     EXPIRED_FIELD = "expired"  # "false" = not expired, otherwise date marked as expired
+    LOG_PAYLOAD_MAX_LENGTH = 2048  # characters of args/return logged by @log_enter_exit
+    LOG_PAYLOAD_SAMPLE_RATE = 1  # log 1 of every N calls to a @log_enter_exit method
+    KVSTORE_RETRY_STATUSES = (429, 503)  # throttled or busy, safe to retry batch_save
+    KVSTORE_MAX_RETRIES = 5
+    KVSTORE_BACKOFF_SECONDS = 0.5  # doubled on each retry
+    KVSTORE_MAX_BACKOFF_SECONDS = 30
+    KVSTORE_FLUSH_PARALLELISM = 1  # concurrent batch_save requests per flush, 1 = sequential
+    EXPIRY_QUERY_CHUNK_SIZE = 500  # keys per $or query when expiring source records in bulk
+    EXPIRY_FULL_SCAN_MIN_KEYS = 20000  # scan the whole source collection instead of querying keys
+    MVKEY_INDEX_SUFFIX = "_mvkey_index"  # sidecar collection: mv_key value => owning record keys
+    MVKEY_INDEX_OWNERS_FIELD = "record_keys"
+    MVKEY_INDEX_READY_KEY = "__mvkey_index_ready__"  # present once the index has been fully built
+    MVKEY_INDEX_MAX_AGE = 86400  # seconds an index build is trusted before it is rebuilt from the aggregated collection
+    EXPIRATION_MATCH_MAX_KEYS = 100000  # expiration matches held in memory before spilling to disk
+    EPOCH_FIELD_SUFFIX = "_epoch"  # sortable copy of a timestamp field, see set_epoch_field()
+    DEFAULT_ASSET_GROUP_NAME = "default"
+    DEFAULT_MAX_AGE = "30"
+    HTTP_POOL_SIZE = 4  # idle keep-alive connections to splunkd kept for reuse, see PooledHTTPHandler
+    SETTINGS_CACHE_TTL = 60  # seconds input and app settings are reused across processes, 0 = never cached
 
     def __init__(self):
         self.run_id = str(int(time.time()))
@@ -110,7 +831,11 @@ class OversightScript:
         self.params = {}
         self.app_settings = {}
         self.aggregation_cache = {}  # local copy of kvstore data
+        self.modified_cache_keys = set()  # aggregation_cache records no longer as read from kvstore
+        self.purge_queue = {}  # dict of lists; source record keys to delete, see queue_purge_for_key()
         self.source_name = "None"
+        self.conf_write_counts = {"applied": 0, "skipped": 0}  # see write_conf()
+        self.metrics = RunMetrics()  # see emit_run_metrics()
 
     def setup(self, service, app_settings):
         """perform actions which require splunklib.client.service, which is not available during __init__()
@@ -127,7 +852,21 @@ class OversightScript:
             raise ValueError(
                 "setup failed, no valid splunklib.client.service received, aborting."
             )
+        if app_settings["additional_parameters"].get("settings_cache_ttl") not in [
+            None,
+            "",
+        ]:
+            self.SETTINGS_CACHE_TTL = max(
+                int(app_settings["additional_parameters"]["settings_cache_ttl"]), 0
+            )
+        if app_settings["additional_parameters"].get("http_pool_size"):
+            self.HTTP_POOL_SIZE = max(
+                int(app_settings["additional_parameters"]["http_pool_size"]), 1
+            )
         service.namespace = self.SERVICE_CONTEXT
+        if isinstance(service, binding.Context):
+            # reuse connections for every REST call of this service
+            service.http.handler = get_http_handler(self.HTTP_POOL_SIZE)
         self.service = service
         self.logger.debug(
             "run_id={} script={} getting kvstore max batch".format(
@@ -141,6 +880,13 @@ class OversightScript:
         except:
             self.kvstore_max_batch = 1000
 
+        try:
+            self.kvstore_max_rows = int(
+                self.service.confs["limits"]["kvstore"]["max_rows_per_query"]
+            )
+        except:
+            self.kvstore_max_rows = 50000
+
         self.VISIBLE_KEY_FIELD = app_settings["additional_parameters"][
             "primary_id_field"
         ]
@@ -164,15 +910,70 @@ class OversightScript:
         self.EXPIRATION_EXPRESSION = app_settings["additional_parameters"].get(
             "expiration_expression"
         )
+        logging_settings = app_settings.get("logging") or {}
+        if logging_settings.get("debug_payload_max_length"):
+            self.LOG_PAYLOAD_MAX_LENGTH = int(
+                logging_settings["debug_payload_max_length"]
+            )
+        if logging_settings.get("debug_payload_sample_rate"):
+            self.LOG_PAYLOAD_SAMPLE_RATE = int(
+                logging_settings["debug_payload_sample_rate"]
+            )
+        if app_settings["additional_parameters"].get("kvstore_flush_parallelism"):
+            self.KVSTORE_FLUSH_PARALLELISM = max(
+                int(app_settings["additional_parameters"]["kvstore_flush_parallelism"]),
+                1,
+            )
+        if app_settings["additional_parameters"].get("expiration_match_max_keys"):
+            self.EXPIRATION_MATCH_MAX_KEYS = max(
+                int(app_settings["additional_parameters"]["expiration_match_max_keys"]),
+                1,
+            )
+
+    def emit_run_metrics(self, status, error=None, **counters):
+        """write the metrics of this run as one JSON event to $SPLUNK_HOME/var/log/splunk/ta_oversight_metrics.log,
+        indexed as sourcetype oversight:metrics.  A failure to write is logged, and never fails the run.
+
+        @param status:      string, ie completed or failed
+        @param error:       exception the run failed with, or None; added as the event's error field
+        @param counters:    ints, added to the run's counters
+        @returns            dict, the event
+        """
+        for name, value in counters.items():
+            self.metrics.count(name, value)
+        fields = {
+            "run_id": self.run_id,
+            "script": self.SCRIPT_NAME,
+            "input": self.source_name,
+            "status": status,
+        }
+        if error is not None:
+            fields["error"] = format_log_payload(
+                "{}: {}".format(type(error).__name__, str(error)),
+                self.LOG_PAYLOAD_MAX_LENGTH,
+            )
+        event = self.metrics.get_event(**fields)
+        path = os.path.join(
+            self.get_splunkhome_env(), "var", "log", "splunk", METRICS_LOG_FILENAME
+        )
+        try:
+            write_metrics_event(path, event)
+        except OSError as error:
+            self.logger.warning(
+                "run_id={} script={} method=emit_run_metrics status=\"metrics not written\" path={} error={}".format(
+                    self.run_id, self.SCRIPT_NAME, path, str(error)
+                )
+            )
+        return event
 
     def get_splunkhome_env(self):
         """modified from solnlib.splunkenv::_splunk_home()"""
         return os.path.normpath(os.environ.get("SPLUNK_HOME", "/opt/splunk"))
 
     def read_app_settings(self, token, stanza="all"):
-        """read custom conf file with app settings written
+        """read custom conf file with app settings written, see load_app_settings()
         @param token - string of session key
-        @param obj - the script class caller
+        @param stanza - string, stanza to read or "all"
         @returns - dict of settings
         """
 
@@ -199,8 +1000,158 @@ class OversightScript:
         )
         return settings
 
+    def get_app_settings_version(self):
+        """@returns list, [modification time (ns), size] of the default and local app settings conf files,
+        None for a file which does not exist; any edit of the app settings changes it"""
+        version = []
+        for conf_dir in ["default", "local"]:
+            path = os.path.join(
+                self.get_splunkhome_env(),
+                "etc",
+                "apps",
+                self.APP_NAME,
+                conf_dir,
+                "{}.conf".format(self.APP_SETTINGS_FILENAME),
+            )
+            try:
+                stat = os.stat(path)
+            except OSError:
+                version.append(None)
+            else:
+                version.append([stat.st_mtime_ns, stat.st_size])
+        return version
+
+    def load_app_settings(self, token):
+        """app settings read and normalized once per process, shared by every script.
+        The normalized settings are also kept in a snapshot under $SPLUNK_HOME/var/run with the version of
+        the conf files they were read from, so other processes only read them over REST after an edit.
+        Each call returns its own copy, callers may modify it without changing the shared snapshot.
+
+        @param token:   string, session key
+        @returns        dict, see normalize_global_settings()
+        """
+        version = self.get_app_settings_version()
+        if APP_SETTINGS_SNAPSHOT.get("version") == version:
+            return copy.deepcopy(APP_SETTINGS_SNAPSHOT["settings"])
+
+        path = os.path.join(
+            os.path.dirname(
+                get_settings_cache_path(self.get_splunkhome_env(), self.APP_NAME)
+            ),
+            APP_SETTINGS_SNAPSHOT_FILENAME,
+        )
+        # without the conf files changes can't be detected, so the snapshot is not used
+        versioned = any(version)
+        settings = None
+        if versioned:
+            try:
+                with open(path) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+                if snapshot["version"] == version:
+                    settings = snapshot["settings"]
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+
+        if settings is None:
+            settings = self.normalize_global_settings(self.read_app_settings(token))
+            if versioned:
+                try:
+                    write_json_atomic(path, {"version": version, "settings": settings})
+                except (OSError, TypeError, ValueError) as error:
+                    self.logger.warning(
+                        "run_id={} script={} method=load_app_settings status=\"snapshot not written\" path={} error={}".format(
+                            self.run_id, self.SCRIPT_NAME, path, str(error)
+                        )
+                    )
+        else:
+            self.logger.debug(
+                "run_id={} script={} method=load_app_settings status=snapshot version={}".format(
+                    self.run_id, self.SCRIPT_NAME, str(version)
+                )
+            )
+
+        APP_SETTINGS_SNAPSHOT.update(version=version, settings=settings)
+        return copy.deepcopy(settings)
+
+    def get_input_settings(self, source_name):
+        """settings of the oversight input named source_name, from the settings cache or else with a single
+        namespaced request for that input stanza
+
+        @param source_name: string, name of the input
+        @returns            dict, or None if there is no such input
+        """
+        settings = self.read_settings_cache("inputs", source_name)
+        if settings is not None:
+            return settings
+        try:
+            # with the kind given, splunklib requests data/inputs/oversight/<name> directly
+            # rather than searching every input kind, which needs admin access to data/inputs
+            settings = dict(self.service.inputs[source_name, self.MODINPUT_KIND].content)
+        except KeyError:
+            return None
+        self.write_settings_cache("inputs", source_name, settings)
+        return settings
+
+    def read_settings_cache(self, section, name):
+        """@returns the cached value, or None if missing, older than SETTINGS_CACHE_TTL or unreadable"""
+        if self.SETTINGS_CACHE_TTL <= 0:
+            return None
+        path = get_settings_cache_path(self.get_splunkhome_env(), self.APP_NAME)
+        try:
+            with open(path) as cache_file:
+                entry = json.load(cache_file)[section][name]
+            age = time.time() - entry["cached"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if not 0 <= age < self.SETTINGS_CACHE_TTL:
+            return None
+        self.logger.debug(
+            "run_id={} script={} method=read_settings_cache status=hit section={} name={} age={:.1f}".format(
+                self.run_id, self.SCRIPT_NAME, section, name, age
+            )
+        )
+        return entry["value"]
+
+    def write_settings_cache(self, section, name, value):
+        """add value to the settings cache; expired entries are dropped.
+        A failure to write is logged, the cache is only an optimization.
+
+        @param section: string, ie inputs or app_settings
+        @param name:    string
+        @param value:   json serializable
+        @returns        None
+        """
+        if self.SETTINGS_CACHE_TTL <= 0 or value is None:
+            return
+        path = get_settings_cache_path(self.get_splunkhome_env(), self.APP_NAME)
+        now = time.time()
+        try:
+            with open(path) as cache_file:
+                cache = json.load(cache_file)
+            cache = {
+                cached_section: {
+                    cached_name: entry
+                    for cached_name, entry in entries.items()
+                    if 0 <= now - entry["cached"] < self.SETTINGS_CACHE_TTL
+                }
+                for cached_section, entries in cache.items()
+            }
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            cache = {}
+        cache.setdefault(section, {})[name] = {"cached": now, "value": value}
+
+        try:
+            write_json_atomic(path, cache)
+        except (OSError, TypeError, ValueError) as error:
+            self.logger.warning(
+                "run_id={} script={} method=write_settings_cache status=failed path={} error={}".format(
+                    self.run_id, self.SCRIPT_NAME, path, str(error)
+                )
+            )
+
     def normalize_global_settings(self, settings):
-        """normalize global app-wide settings
+        """normalize global app-wide settings: each asset group name => max age in days.
+        Shared by every script through load_app_settings()
         @param settings: dict of custom conf stanza kv pairs
         @returns         dict, normalized and validated
 
@@ -209,9 +1160,10 @@ class OversightScript:
             "run_id={} starting normalize_global_settings".format(self.run_id)
         )
 
-        settings[settings["asset_groups"]["asset_group_1_name"]] = int(
-            settings["asset_groups"]["asset_group_1_max_age"]
-        )
+        asset_groups = settings.setdefault("asset_groups", {})
+        settings[
+            asset_groups.get("asset_group_1_name") or self.DEFAULT_ASSET_GROUP_NAME
+        ] = int(asset_groups.get("asset_group_1_max_age") or self.DEFAULT_MAX_AGE)
 
         if settings["asset_groups"].get("asset_group_2_name"):
             settings[settings["asset_groups"]["asset_group_2_name"]] = int(
@@ -240,12 +1192,12 @@ class OversightScript:
         return settings
 
     def convert_timestring_to_epoch(self, timestring, timeformat):
-        """convert timesting to epoch using timeformat"""
+        """convert timesting to datetime using timeformat, see parse_timestring()"""
         if not timestring or not timeformat:
             return None
 
         try:
-            output = datetime.strptime(timestring, timeformat)
+            output = parse_timestring(timestring, timeformat)
         except ValueError as error:
             self.logger.error(
                 'run_id={} script={} method=convert_timestring_to_epoch status="invalid event with incorrect time format" value={} does not match format_string={} error={}'.format(
@@ -259,6 +1211,47 @@ class OversightScript:
             output = None
         return output
 
+    def get_epoch_fieldname(self, fieldname):
+        """@returns string, name of the field holding the epoch seconds of timestamp field fieldname"""
+        return "{}{}".format(fieldname, self.EPOCH_FIELD_SUFFIX)
+
+    def get_epoch(self, record, fieldname, timeformat):
+        """epoch seconds of timestamp field fieldname: the numeric epoch field when present (see set_epoch_field()),
+        otherwise parsed from the formatted string
+
+        @param record:      dict
+        @param fieldname:   string, timestamp field
+        @param timeformat:  string, strptime format of the timestamp field
+        @returns            int/float, or None if the timestamp is missing or can not be parsed
+        """
+        epoch = record.get(self.get_epoch_fieldname(fieldname))
+        if isinstance(epoch, (int, float)) and not isinstance(epoch, bool):
+            return epoch
+        timestamp = self.convert_timestring_to_epoch(record.get(fieldname), timeformat)
+        if timestamp is None:
+            return None
+        return datetime_to_epoch(timestamp)
+
+    def set_epoch_field(self, record, fieldname, timeformat):
+        """store the timestamp record[fieldname] as epoch seconds alongside the formatted string, so kvstore
+        queries can compare timestamps (ie last_inventoried => last_inventoried_epoch).
+        The epoch field is removed if the timestamp is missing or can not be parsed.
+
+        @param record:      dict, aggregation record; modified in place
+        @param fieldname:   string, timestamp field
+        @param timeformat:  string, strptime format of the timestamp field
+        @returns            bool, True if record was changed
+        """
+        epoch_fieldname = self.get_epoch_fieldname(fieldname)
+        timestamp = self.convert_timestring_to_epoch(record.get(fieldname), timeformat)
+        if timestamp is None:
+            return record.pop(epoch_fieldname, None) is not None
+        epoch = datetime_to_epoch(timestamp)
+        if record.get(epoch_fieldname) == epoch:
+            return False
+        record[epoch_fieldname] = epoch
+        return True
+
     def get_collection(self, conf_type):
         """return sdk collection object for the knowledge object type specified
 
@@ -279,53 +1272,123 @@ class OversightScript:
             % str(conf_type)
         )
 
-    def write_conf(self, conf_type, name, args):
+    def write_conf(self, conf_type, name, args, existing=None):
         """write a knowledge object configuration to disk.
         owner=nobody for kvstore access fyi.
-        wrapper for post() to ensure that name is included or not included as required
+        wrapper for post() to ensure that name is included or not included as required.
+        An existing object is only posted the settings which differ from its content; if none differ
+        nothing is posted, since every update rewrites the conf file and replicates across a search head cluster.
 
         @param conf_type:   string, splunk knowledge object type to write
         @param name:        string, name of splunk knowledge object
         @param args:        dict, arguments to write
-        @returns            None
+        @param existing:    splunklib.client.Entity or None, the object if it has already been read
+        @returns            bool, True if anything was written
         """
         # path = get_uri_path(conf_type)
         collection = self.get_collection(conf_type)
 
-        if name not in collection:
-            collection.create(name, **args)
+        if existing is None:
+            try:
+                existing = collection[name]
+            except KeyError:
+                existing = None
 
+        if existing is None:
+            collection.create(name, **args)
         else:
-            collection[name].update(**args)
+            args = diff_conf_args(existing.content, args)
+            if not args:
+                self.conf_write_counts["skipped"] += 1
+                self.logger.debug(
+                    "run_id={} script={} method=write_conf status=unchanged type={} name={}".format(
+                        self.run_id, self.SCRIPT_NAME, conf_type, name
+                    )
+                )
+                return False
+            existing.update(**args)
+
+        self.conf_write_counts["applied"] += 1
+        return True
 
     @log_enter_exit()
-    def write_macro(self, name, definition):
+    def write_macro(self, name, definition, existing=None):
         """wrapper for write_conf used when the args are in string form,
         and not a dict, like macros.
         @param name:        string, name of splunk knowledge object to write
         @param definition:  string, representing the macro definition
-        @returns            None
+        @param existing:    splunklib.client.Entity or None, the macro if it has already been read
+        @returns            bool, True if the macro was written
         """
 
         args = {"definition": definition}
-        self.write_conf("macros", name, args)
-
-    def get_kvstore_records(self, collection_name):
-        try:
-            cache = self.service.kvstore[collection_name].data.query()
-        except KeyError as error:
-            self.logger.critical(
-                "run_id={} Unable to examine kvstore={} for expiry job, error={} skipping data source.".format(
-                    self.run_id, str(collection_name), str(error)
+        return self.write_conf("macros", name, args, existing)
+
+    def iter_kvstore_records(
+        self, collection_name, fields=None, query=None, page_size=None
+    ):
+        """generator yielding every record of a kvstore collection, one page at a time.
+        Pages are requested with skip/limit so results are never truncated at the server's
+        limits.conf [kvstore] max_rows_per_query, and only one page is held in memory.
+        A collection which can't be read raises rather than yielding a partial view of it.
+
+        @param collection_name: string, name of kvstore collection to read
+        @param fields:          list of strings or None, fields to return (projection)
+        @param query:           dict or None, kvstore query to filter records server-side
+        @param page_size:       int or None, records per request; at most, and by default,
+                                  max_rows_per_query
+        @returns                generator of dicts
+        """
+        # a page larger than the server returns would look like the last page
+        max_rows = int(getattr(self, "kvstore_max_rows", 50000))
+        page_size = min(int(page_size or max_rows), max_rows)
+        query_args = {"limit": page_size, "sort": self.HIDDEN_KEY_FIELD}
+        if fields:
+            query_args["fields"] = ",".join(fields)
+        if query:
+            query_args["query"] = json.dumps(query)
+
+        skip = 0
+        collection_data = None
+        while True:
+            start = time.perf_counter()
+            try:
+                if collection_data is None:
+                    collection_data = self.service.kvstore[collection_name].data
+                page = collection_data.query(skip=skip, **query_args)
+            except Exception as error:
+                self.logger.critical(
+                    "run_id={} script={} method=iter_kvstore_records status=failed collection={} skip={} error={}".format(
+                        self.run_id,
+                        self.SCRIPT_NAME,
+                        str(collection_name),
+                        str(skip),
+                        str(error),
+                    )
                 )
-            )
-        except Exception as error:
-            self.logger.critical(
-                "run_id={} Unable to examine kvstore={} for expiry job, error={} skipping data source.".format(
-                    self.run_id, str(collection_name), str(error)
+                raise
+            self.metrics.add_phase("kvstore_load", time.perf_counter() - start)
+            self.metrics.count("kvstore_records_read", len(page))
+            self.logger.debug(
+                "run_id={} script={} method=iter_kvstore_records collection={} skip={} page_size={}".format(
+                    self.run_id,
+                    self.SCRIPT_NAME,
+                    str(collection_name),
+                    str(skip),
+                    str(len(page)),
                 )
             )
-        return cache
+            for record in page:
+                yield record
+
+            if len(page) < page_size:
+                return
+            skip += len(page)
+
+    def get_kvstore_records(self, collection_name, fields=None, query=None):
+        """return all records of a kvstore collection as a list; see iter_kvstore_records()
+        to stream large collections instead of holding them in memory"""
+        return list(self.iter_kvstore_records(collection_name, fields, query))
 
     def get_dict_from_records(self, key_fieldname, cache):
         """
@@ -339,12 +1402,66 @@ class OversightScript:
             output[key] = item
         return output
 
+    def iter_results_file(self, results_file, fieldnames=None):
+        """stream the rows of a gzipped alert action results file as dicts, like csv.DictReader, but
+        only with the columns named in fieldnames.  Columns are looked up by their position in the
+        header once, so the unused fields of wide results are never copied into each row.
+        The rows read and the time spent reading them are recorded as rows_read and phase csv_parse.
+
+        @param results_file:    string, path of the gzip csv results file
+        @param fieldnames:      iterable of strings, or None for all columns; names missing from
+                                  the header are skipped
+        @returns                generator of dicts
+        """
+        with gzip.open(results_file, "rt", newline="") as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader, None)
+            if not header:
+                return
+            if fieldnames is None:
+                columns = list(dict.fromkeys(header))
+            else:
+                columns = [name for name in dict.fromkeys(fieldnames) if name in header]
+            if not columns:
+                self.logger.warning(
+                    "run_id={} script={} input={} method=iter_results_file status=\"no requested columns in results\" fieldnames={}".format(
+                        self.run_id, self.SCRIPT_NAME, self.source_name, str(fieldnames)
+                    )
+                )
+                return
+            width = len(header)
+            get_values = operator.itemgetter(*[header.index(name) for name in columns])
+            if len(columns) == 1:
+                # itemgetter with a single index returns the value rather than a tuple
+                single_value = get_values
+                get_values = lambda row: (single_value(row),)
+
+            rows_read = 0
+            parse_seconds = 0.0
+            try:
+                start = time.perf_counter()
+                for row in reader:
+                    if not row:
+                        continue
+                    if len(row) < width:
+                        # short rows are padded like csv.DictReader restval
+                        row = row + [None] * (width - len(row))
+                    output = dict(zip(columns, get_values(row)))
+                    rows_read += 1
+                    # time spent by the caller between rows is not parsing
+                    parse_seconds += time.perf_counter() - start
+                    yield output
+                    start = time.perf_counter()
+            finally:
+                self.metrics.add_phase("csv_parse", parse_seconds)
+                self.metrics.count("rows_read", rows_read)
+
     def get_cached_record(self, record_key):
-        """perform a copy.deepcopy of record, so it can be assigned literally instead of by reference
+        """copy the record with copy_record(), so it can be assigned literally instead of by reference
         return cached and reformatted data from the aggregation kvstore"""
 
         if record_key in self.aggregation_cache:
-            return copy.deepcopy(self.aggregation_cache[record_key])
+            return copy_record(self.aggregation_cache[record_key])
         else:
             return None
 
@@ -352,12 +1469,54 @@ class OversightScript:
         """safe update to locally cached kvstore records"""
 
         if record_key in self.aggregation_cache:
-            self.aggregation_cache[record_key].update(copy.deepcopy(kwargs))
+            self.aggregation_cache[record_key].update(copy_record(kwargs))
+            self.modified_cache_keys.add(record_key)
+
+    def is_cached_record_unchanged(self, record_key, record):
+        """True if record is identical to the aggregation kvstore record for record_key as it was read,
+        in which case writing it back would be a no-op
+
+        @param record_key:  string, self.HIDDEN_KEY_FIELD of the record
+        @param record:      dict, the record to be written
+        @returns            bool
+        """
+        if record_key in self.modified_cache_keys:
+            return False
+        cached = self.aggregation_cache.get(record_key)
+        return cached is not None and cached == record
+
+    def get_retry_delay(self, error, attempt):
+        """seconds to wait before retrying a throttled kvstore request: the server's Retry-After
+        header when present, otherwise exponential backoff from KVSTORE_BACKOFF_SECONDS
+
+        @param error:   splunklib.binding.HTTPError
+        @param attempt: int, number of retries already made
+        @returns        float
+        """
+        for header, value in getattr(error, "headers", None) or []:
+            if header.lower() == "retry-after":
+                try:
+                    return min(float(value), self.KVSTORE_MAX_BACKOFF_SECONDS)
+                except ValueError:
+                    break
+        return min(
+            self.KVSTORE_BACKOFF_SECONDS * (2 ** attempt),
+            self.KVSTORE_MAX_BACKOFF_SECONDS,
+        )
 
     def write_kvstore_batch(self, collection_name, documents=None):
         """Write cached records in self.write_cache to kvstore
         NOTE: documents overwrite the previous document completely, not just the fields specified
-        see https://docs.splunk.com/DocumentationStatic/PythonSDK/1.6.16/client.html#splunklib.client.KVStoreCollectionData"""
+        see https://docs.splunk.com/DocumentationStatic/PythonSDK/1.6.16/client.html#splunklib.client.KVStoreCollectionData
+
+        Requests rejected with one of KVSTORE_RETRY_STATUSES (server busy or throttled) are retried
+        with backoff, up to KVSTORE_MAX_RETRIES times; any other error is raised.
+
+        @param collection_name: string, name of kvstore collection to write to
+        @param documents:       list or None, documents to save; if None, save and clear
+                                  self.write_cache[collection_name]
+        @returns                float, seconds taken by the successful batch_save request
+        """
 
         self.logger.debug(
             "run_id={} input={} method=write_kvstore_batch status=enter write_catch_size={} collection_name={}".format(
@@ -367,39 +1526,207 @@ class OversightScript:
                 str(collection_name),
             )
         )
-        try:
-            if not documents:
-                self.service.kvstore[collection_name].data.batch_save(
-                    *self.write_cache[collection_name]
+        clear_cache = not documents
+        if clear_cache:
+            documents = self.write_cache[collection_name]
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                self.service.kvstore[collection_name].data.batch_save(*documents)
+                latency = time.perf_counter() - start
+                break
+
+            except HTTPError as error:
+                if (
+                    getattr(error, "status", None) in self.KVSTORE_RETRY_STATUSES
+                    and attempt < self.KVSTORE_MAX_RETRIES
+                ):
+                    delay = self.get_retry_delay(error, attempt)
+                    attempt += 1
+                    self.logger.warning(
+                        'run_id={} input={} method=write_kvstore_batch status="kvstore busy, retrying" collection_name={} http_status={} attempt={} delay={}'.format(
+                            self.run_id,
+                            self.source_name,
+                            str(collection_name),
+                            str(error.status),
+                            str(attempt),
+                            str(delay),
+                        )
+                    )
+                    time.sleep(delay)
+                    continue
+
+                self.logger.error(
+                    'run_id={} input={} error={} status="ERROR writing cache to={}"'.format(
+                        self.run_id,
+                        self.source_name,
+                        str(error),
+                        collection_name,
+                    )
+                )
+                raise ValueError(
+                    'run_id={} input={} status="ERROR writing cached records:{}"'.format(
+                        self.run_id, self.source_name, str(error)
+                    )
+                )
+
+        if clear_cache:
+            self.write_cache[collection_name] = []
+        self.logger.debug(
+            "run_id={} input={} method=write_kvstore_batch status=exit collection_name={} document_count={} latency_ms={} retries={} write_cache_size={}".format(
+                self.run_id,
+                self.source_name,
+                str(collection_name),
+                str(len(documents)),
+                str(round(latency * 1000, 1)),
+                str(attempt),
+                str(len(self.write_cache[collection_name])),
+            )
+        )
+        return latency
+
+    def flush_cached_writes(self, collection_name, force=False):
+        """write self.write_cache[collection_name] to the kvstore in chunks of at most
+        self.kvstore_max_batch (limits.conf max_documents_per_batch_save) documents.
+        Without force, a partial chunk smaller than the batch size is left cached for later.
+
+        With KVSTORE_FLUSH_PARALLELISM > 1 the chunks are sent concurrently, see
+        write_kvstore_chunks_concurrently().  Each flush is timed as phase flush.<collection_name>.
+
+        @param collection_name: string, name of kvstore to write to
+        @param force:           bool, if True write everything including a partial chunk
+        @returns                int, number of documents written
+        """
+        cache = self.write_cache[collection_name]
+        batch_size = max(int(self.kvstore_max_batch), 1)
+        flush_count = len(cache) if force else len(cache) - len(cache) % batch_size
+        if flush_count <= 0:
+            return 0
+
+        with self.metrics.phase("flush.{}".format(collection_name)):
+            if self.KVSTORE_FLUSH_PARALLELISM > 1 and flush_count > batch_size:
+                written = self.write_kvstore_chunks_concurrently(
+                    collection_name, flush_count, batch_size
                 )
-                self.write_cache[collection_name] = []
             else:
-                self.service.kvstore[collection_name].data.batch_save(*documents)
+                written = self.write_kvstore_chunks(
+                    collection_name, flush_count, batch_size
+                )
+        self.metrics.count("records_written", written)
+        return written
+
+    def write_kvstore_chunks(self, collection_name, flush_count, batch_size):
+        """write the first flush_count documents of self.write_cache[collection_name], one batch_save
+        request at a time.  Written documents are dropped from the cache; on error the remainder stays cached.
 
-        except HTTPError as error:
+        @param collection_name: string, name of kvstore to write to
+        @param flush_count:     int, number of cached documents to write
+        @param batch_size:      int, maximum documents per batch_save request
+        @returns                int, number of documents written
+        """
+        cache = self.write_cache[collection_name]
+        latencies = []
+        offset = 0
+        try:
+            while offset < flush_count:
+                chunk = cache[offset : offset + batch_size]
+                latencies.append(
+                    self.write_kvstore_batch(collection_name, documents=chunk)
+                )
+                offset += len(chunk)
+        finally:
+            # drop only what was written; on error the remainder stays cached
+            del cache[:offset]
+
+        self.log_flush_summary(collection_name, offset, latencies)
+        return offset
+
+    def write_kvstore_chunks_concurrently(self, collection_name, flush_count, batch_size):
+        """write the first flush_count documents of self.write_cache[collection_name] with up to
+        KVSTORE_FLUSH_PARALLELISM batch_save requests in flight.
+
+        Requests in flight may complete in any order, so only the last cached write for each _key
+        is sent (see dedupe_documents_by_key()); every request has completed before this returns,
+        so later flushes cannot overtake it. Failed chunks stay cached, and all failures are
+        reported together in a single ValueError.
+
+        @param collection_name: string, name of kvstore to write to
+        @param flush_count:     int, number of cached documents to write
+        @param batch_size:      int, maximum documents per batch_save request
+        @returns                int, number of documents written
+        """
+        cache = self.write_cache[collection_name]
+        documents = dedupe_documents_by_key(cache[:flush_count])
+        chunks = [
+            documents[offset : offset + batch_size]
+            for offset in range(0, len(documents), batch_size)
+        ]
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.KVSTORE_FLUSH_PARALLELISM, len(chunks))
+        ) as executor:
+            futures = [
+                executor.submit(
+                    self.write_kvstore_batch, collection_name, documents=chunk
+                )
+                for chunk in chunks
+            ]
+
+        latencies = []
+        failed_documents = []
+        errors = []
+        for chunk, future in zip(chunks, futures):
+            try:
+                latencies.append(future.result())
+            except Exception as error:
+                failed_documents.extend(chunk)
+                errors.append(str(error))
+        # keep failed chunks cached in their original order, ahead of anything not yet flushed
+        cache[:flush_count] = failed_documents
+
+        written = len(documents) - len(failed_documents)
+        if latencies:
+            self.log_flush_summary(collection_name, written, latencies)
+        if errors:
             self.logger.error(
-                'run_id={} input={} error={} status="ERROR writing cache to={}"'.format(
+                'run_id={} script={} input={} method=write_kvstore_chunks_concurrently collection={} status="ERROR writing cache" failed_chunk_count={} chunk_count={} failed_document_count={}'.format(
                     self.run_id,
+                    self.SCRIPT_NAME,
                     self.source_name,
-                    str(error),
-                    collection_name,
+                    str(collection_name),
+                    str(len(errors)),
+                    str(len(chunks)),
+                    str(len(failed_documents)),
                 )
             )
             raise ValueError(
-                'run_id={} input={} status="ERROR writing cached records:{}"'.format(
-                    self.run_id, self.source_name, str(error)
+                'run_id={} input={} status="ERROR writing cached records" failed_chunk_count={} errors={}'.format(
+                    self.run_id, self.source_name, str(len(errors)), "; ".join(errors)
                 )
             )
-        self.logger.debug(
-            "run_id={} input={} method=write_kvstore_batch status=exit write_cache_size={}".format(
+        return written
+
+    def log_flush_summary(self, collection_name, document_count, latencies):
+        """log one line summarizing the batch_save requests of a flush"""
+        self.logger.info(
+            "run_id={} script={} input={} method=flush_cached_writes collection={} document_count={} chunk_count={} latency_ms_total={} latency_ms_max={} parallelism={} existing_cache_size={}".format(
                 self.run_id,
+                self.SCRIPT_NAME,
                 self.source_name,
+                str(collection_name),
+                str(document_count),
+                str(len(latencies)),
+                str(round(sum(latencies) * 1000, 1)),
+                str(round(max(latencies) * 1000, 1)),
+                str(self.KVSTORE_FLUSH_PARALLELISM),
                 str(len(self.write_cache[collection_name])),
             )
         )
 
     def handle_cached_write(self, collection_name, records=None, force=False):
         """implement kvstore batch saving to improve efficiency.
+        Records are added to the write cache, then every full batch is written.
         If records is None, consider it a request to flush and write the current cache, no matter the size.
 
         @param records:         list of dicts, dict, or None; the record(s) to be written
@@ -415,77 +1742,39 @@ class OversightScript:
         if not records:
             force = True
 
-        if records is None and len(self.write_cache[collection_name]) == 0:
-            return
-
-        if (
-            records is None
-            and len(self.write_cache[collection_name]) > self.kvstore_max_batch
-        ):
-            ## cached too much data previously, whoops!
-            overflow = []
-            overflow_count = (
-                len(self.write_cache[collection_name]) - self.kvstore_max_batch
-            )
-
-            while overflow_count > 0:
-                overflow.append(self.write_cache[collection_name].pop(-1))
-                overflow_count -= 1
-                time.sleep(0.01)
-            self.write_kvstore_batch(collection_name)
-            if len(overflow) > 0:
-                self.write_cache[collection_name] = copy.deepcopy(overflow)
-                self.write_kvstore_batch(collection_name)
-
-        elif (
-            records is None
-            and len(self.write_cache[collection_name]) <= self.kvstore_max_batch
-            and force
-        ):
-            ## flush cache
-            self.write_kvstore_batch(collection_name)
-
-        elif records:
-
-            # first add the record into the cache
-
-            if isinstance(records, list):
-                self.write_cache[collection_name].extend(copy.deepcopy(records))
-                self.logger.debug(
-                    "run_id={} script={} input={} method=handle_cached_write extended records into write_cache".format(
-                        self.run_id, self.SCRIPT_NAME, self.source_name
-                    )
+        # records are handed off to the write cache and not copied again;
+        # callers must not modify them after caching
+        if isinstance(records, list):
+            self.write_cache[collection_name].extend(records)
+            self.logger.debug(
+                "run_id={} script={} input={} method=handle_cached_write extended records into write_cache".format(
+                    self.run_id, self.SCRIPT_NAME, self.source_name
                 )
-                records = None
+            )
 
-            elif isinstance(records, dict):
-                self.write_cache[collection_name].append(
-                    copy.deepcopy(json.dumps(records))
-                )
-                records = None
-                self.logger.debug(
-                    "run_id={} script={} input={} method=handle_cached_write appending records into write_cache".format(
-                        self.run_id, self.SCRIPT_NAME, self.source_name
-                    )
+        elif isinstance(records, dict):
+            self.write_cache[collection_name].append(json.dumps(records))
+            self.logger.debug(
+                "run_id={} script={} input={} method=handle_cached_write appending records into write_cache".format(
+                    self.run_id, self.SCRIPT_NAME, self.source_name
                 )
-            elif isinstance(records, str):
-                self.write_cache[collection_name].append(copy.deepcopy(records))
-                records = None
-                self.logger.debug(
-                    "run_id={} script={} input={} method=handle_cached_write appending records into write_cache".format(
-                        self.run_id, self.SCRIPT_NAME, self.source_name
-                    )
+            )
+        elif isinstance(records, str):
+            self.write_cache[collection_name].append(records)
+            self.logger.debug(
+                "run_id={} script={} input={} method=handle_cached_write appending records into write_cache".format(
+                    self.run_id, self.SCRIPT_NAME, self.source_name
                 )
+            )
 
-            elif records:
-                self.logger.warning(
-                    "run_id={} script={} input={} method=handle_cached_write records={} are invalid, not caching; should be dict or list".format(
-                        self.run_id, self.SCRIPT_NAME, self.source_name, str(records)
-                    )
+        elif records:
+            self.logger.warning(
+                "run_id={} script={} input={} method=handle_cached_write records={} are invalid, not caching; should be dict or list".format(
+                    self.run_id, self.SCRIPT_NAME, self.source_name, str(records)
                 )
+            )
 
-            ## recursive call
-            self.handle_cached_write(collection_name, force=force)
+        self.flush_cached_writes(collection_name, force=force)
         self.logger.debug(
             "run_id={} script={} input={} method=handle_write_cache status=exit existing_cache_size={}".format(
                 self.run_id,
@@ -513,6 +1802,7 @@ class OversightScript:
             for x in fields
             if self.LAST_INVENTORIED_FIELD in x
             if x != self.LAST_INVENTORIED_FIELD
+            if not x.endswith(self.EPOCH_FIELD_SUFFIX)
         ]
         data_sources = [
             x.replace(
@@ -534,6 +1824,432 @@ class OversightScript:
         ]
         return filtered_list
 
+    def get_source_collection(self, source, method):
+        """return the kvstore collection for a data source, or None (logged) if it cannot be read
+
+        @param source:  string, name of the source kvstore collection
+        @param method:  string, name of the calling method for log messages
+        @returns        splunklib.client.KVStoreCollection or None
+        """
+        try:
+            return self.service.kvstore[source]
+        except KeyError as error:
+            self.logger.warning(
+                "run_id={} method={} Unable to examine kvstore={} for expiry job, error={} skipping data source.".format(
+                    self.run_id, method, str(source), str(error)
+                )
+            )
+        except binding.HTTPError as error:
+            self.logger.warning(
+                "run_id={} method={} Unable to read kvstore={} for expiry job, error={} skipping data source.".format(
+                    self.run_id, method, str(source), str(error)
+                )
+            )
+        except Exception as error:
+            self.logger.warning(
+                "run_id={} method={} Unable to examine kvstore={} for expiry job, error={} skipping data source.".format(
+                    self.run_id, method, str(source), str(error)
+                )
+            )
+        return None
+
+    def group_keys_by_source(self, events):
+        """map each data source collection to the keys of the events present in it,
+        see get_collection_names_to_purge()
+
+        EX: [{ip: 1.1.1.1, bigfix_last_inventoried: x}, {ip: 2.2.2.2, bigfix_last_inventoried: x, forescout_last_inventoried: x}]
+            => {bigfix_collection: [1.1.1.1, 2.2.2.2], forescout_collection: [2.2.2.2]}
+
+        @param events:  iterable of dicts, aggregation kvstore records
+        @returns        dict of lists of strings
+        """
+        output = {}
+        for event in events:
+            host_key = event.get(self.VISIBLE_KEY_FIELD)
+            if not host_key:
+                continue
+            for source in self.get_collection_names_to_purge(event):
+                output.setdefault(source, []).append(host_key)
+        return output
+
+    def iter_records_for_keys(self, source, keys, field="_key"):
+        """stream the records of a source collection whose _key (or field) is in keys.
+        Small key sets are fetched with $or queries of EXPIRY_QUERY_CHUNK_SIZE keys each;
+        at or above EXPIRY_FULL_SCAN_MIN_KEYS the collection is scanned once instead.
+
+        @param source:  string, name of the source kvstore collection
+        @param keys:    iterable of strings
+        @param field:   string, field to match keys against
+        @returns        generator of dicts
+        """
+        keys = list(dict.fromkeys(keys))
+        if len(keys) >= self.EXPIRY_FULL_SCAN_MIN_KEYS:
+            wanted = set(keys)
+            for record in self.iter_kvstore_records(source):
+                if record.get(field) in wanted:
+                    yield record
+            return
+
+        for offset in range(0, len(keys), self.EXPIRY_QUERY_CHUNK_SIZE):
+            chunk = keys[offset : offset + self.EXPIRY_QUERY_CHUNK_SIZE]
+            for record in self.iter_kvstore_records(
+                source, query=make_key_query(chunk, field)
+            ):
+                yield record
+
+    def expire_all_records_for_keys(self, events):
+        """
+        bulk version of expire_all_records_for_key(): mark expired the records of every event in each
+        _last_inventoried data source.  Keys are grouped per source collection and fetched together,
+        so the number of kvstore requests depends on the number of sources rather than hosts x sources.
+        Updated records are cached with handle_cached_write(); flush them with force when done.
+
+        @param events:  iterable of dicts, the existing aggregation kvstore records
+        @returns        int, number of source records marked expired
+        """
+        expired_timestamp = datetime.today().strftime(
+            self.app_settings["additional_parameters"]["time_format"]
+        )
+        expired_count = 0
+        for source, keys in self.group_keys_by_source(events).items():
+            if self.get_source_collection(source, "expire_all_records_for_keys") is None:
+                continue
+
+            found = set()
+            records = []
+            for record in self.iter_records_for_keys(source, keys):
+                found.add(record.get("_key"))
+                # set expired = timestamp
+                record[self.EXPIRED_FIELD] = expired_timestamp
+                records.append(record)
+                if len(records) >= self.kvstore_max_batch:
+                    self.handle_cached_write(source, records=records)
+                    records = []
+            if records:
+                self.handle_cached_write(source, records=records)
+            expired_count += len(found)
+
+            missing = [key for key in keys if key not in found]
+            if missing:
+                self.logger.warning(
+                    "run_id={} method=expire_all_records_for_keys Unable to find records to expire from data_source={} missing_count={} host_keys={}".format(
+                        self.run_id,
+                        str(source),
+                        str(len(missing)),
+                        format_log_payload(missing, self.LOG_PAYLOAD_MAX_LENGTH),
+                    )
+                )
+            self.logger.info(
+                "run_id={} method=expire_all_records_for_keys expiring source={} key_count={} expired_count={}".format(
+                    self.run_id, str(source), str(len(keys)), str(len(found))
+                )
+            )
+        return expired_count
+
+    def is_multivalued_mvkey(self, record):
+        """True if record's self.VISIBLE_MVKEY_FIELD links more than one value"""
+        mvkey = record.get(self.VISIBLE_MVKEY_FIELD)
+        return bool(mvkey) and isinstance(mvkey, list) and len(mvkey) > 1
+
+    def get_mvkey_index_name(self):
+        """name of the sidecar collection indexing which aggregation records list each mv_key value"""
+        return "{}{}".format(self.AGGREGATED_COLLECTION_NAME, self.MVKEY_INDEX_SUFFIX)
+
+    def is_mvkey_index_ready(self):
+        """True if the mv_key index collection exists and was fully built less than self.MVKEY_INDEX_MAX_AGE
+        seconds ago, see update_mvkey_index().  An older index is not trusted, so the next update_inventory run
+        reads the whole aggregated collection and rebuilds it."""
+        index_name = self.get_mvkey_index_name()
+        try:
+            if index_name not in self.service.kvstore:
+                return False
+            ready = self.service.kvstore[index_name].data.query(
+                query=json.dumps({"_key": self.MVKEY_INDEX_READY_KEY})
+            )
+        except Exception as error:
+            self.logger.warning(
+                "run_id={} script={} method=is_mvkey_index_ready Unable to read kvstore={} error={}".format(
+                    self.run_id, self.SCRIPT_NAME, index_name, str(error)
+                )
+            )
+            return False
+        if not ready:
+            return False
+        try:
+            age = time.time() - float(ready[0].get("built_epoch"))
+        except (TypeError, ValueError):
+            age = None
+        if age is None or age > self.MVKEY_INDEX_MAX_AGE:
+            self.logger.info(
+                "run_id={} script={} method=is_mvkey_index_ready status=expired collection={} age={}".format(
+                    self.run_id, self.SCRIPT_NAME, index_name, str(age)
+                )
+            )
+            return False
+        return True
+
+    def get_mvkey_owners(self, values):
+        """look up the aggregation records whose multi-valued self.VISIBLE_MVKEY_FIELD contains each value
+
+        @param values:  iterable of strings, mv_key values
+        @returns        dict, value => list of record keys; values without owners are omitted
+        """
+        values = [i for i in dict.fromkeys(values) if i != self.MVKEY_INDEX_READY_KEY]
+        output = {}
+        for record in self.iter_records_for_keys(self.get_mvkey_index_name(), values):
+            output[record["_key"]] = record.get(self.MVKEY_INDEX_OWNERS_FIELD) or []
+        return output
+
+    def load_linked_records(self, keys, values):
+        """read the aggregation records for keys and values, and every record linked to them through
+        the mv_key index, instead of the whole aggregation collection.
+        The links followed are checked against the records read, see find_stale_mvkey_links().
+
+        @param keys:    iterable of strings, record keys
+        @param values:  iterable of strings, mv_key values
+        @returns        dict, record key => record; None if the index is stale and the whole
+                         aggregation collection must be read instead
+        """
+        records = {}
+        links = {}
+        requested = set()
+        seen_values = set()
+        pending_keys = set(keys)
+        pending_values = set(values)
+        while pending_keys or pending_values:
+            pending_values -= seen_values
+            seen_values.update(pending_values)
+            # singly keyed records are not indexed, their key is the value itself
+            pending_keys.update(pending_values)
+            owners_by_value = self.get_mvkey_owners(pending_values)
+            links.update(owners_by_value)
+            for owners in owners_by_value.values():
+                pending_keys.update(owners)
+
+            pending_keys -= requested
+            requested.update(pending_keys)
+            pending_values = set()
+            for record in self.iter_records_for_keys(
+                self.AGGREGATED_COLLECTION_NAME, list(pending_keys)
+            ):
+                records[record["_key"]] = record
+                if self.is_multivalued_mvkey(record):
+                    pending_values.update(record[self.VISIBLE_MVKEY_FIELD])
+            pending_keys = set()
+
+        stale_links = self.find_stale_mvkey_links(records, links)
+        self.logger.info(
+            "run_id={} script={} input={} method=load_linked_records requested_key_count={} record_count={} stale_link_count={}".format(
+                self.run_id,
+                self.SCRIPT_NAME,
+                self.source_name,
+                str(len(requested)),
+                str(len(records)),
+                str(len(stale_links)),
+            )
+        )
+        if stale_links:
+            self.logger.warning(
+                "run_id={} script={} input={} method=load_linked_records status=stale_index collection={} stale_links={}".format(
+                    self.run_id,
+                    self.SCRIPT_NAME,
+                    self.source_name,
+                    self.get_mvkey_index_name(),
+                    format_log_payload(stale_links, self.LOG_PAYLOAD_MAX_LENGTH),
+                )
+            )
+            return None
+        return records
+
+    def find_stale_mvkey_links(self, records, links):
+        """compare the mv_key index entries followed by load_linked_records() with the records read.
+        Every owner listed for a value must be a record whose mv_key contains the value, and every
+        multi-valued record must be listed as an owner of each of its values.
+
+        @param records: dict, record key => aggregation record
+        @param links:   dict, mv_key value => list of owning record keys, as read from the index
+        @returns        list of (value, record key) tuples the index and the records disagree on
+        """
+        stale = []
+        for value, owners in links.items():
+            for key in owners:
+                record = records.get(key)
+                if not (
+                    record
+                    and self.is_multivalued_mvkey(record)
+                    and value in record[self.VISIBLE_MVKEY_FIELD]
+                ):
+                    stale.append((value, key))
+        for key, record in records.items():
+            if self.is_multivalued_mvkey(record):
+                for value in record[self.VISIBLE_MVKEY_FIELD]:
+                    if key not in links.get(value, ()):
+                        stale.append((value, key))
+        return stale
+
+    def update_mvkey_index(self, changes, rebuild=False):
+        """apply mv_key changes of aggregation records to the mv_key index collection.
+        Only multi-valued mv_keys are indexed.  With rebuild, the index is cleared first, changes must
+        describe every multi-valued record, and the index is then marked ready with its build time.
+
+        The owners of each value are read and then written back whole, without any locking: two runs
+        changing the owners of the same value at once (e.g. update_inventory alert actions of different
+        sources, or one of them and expire_inventory) can overwrite each other's links.  Such lost links
+        are caught by load_linked_records(), which then reads the whole aggregation collection, and
+        are repaired when the index is rebuilt, at the latest self.MVKEY_INDEX_MAX_AGE seconds after the
+        previous build, see is_mvkey_index_ready().
+
+        EX: {"1.1.1.1": (["1.1.1.1", "2.2.2.2"], ["1.1.1.1", "2.2.2.2", "3.3.3.3"])}
+            => adds 1.1.1.1 to the owners of 3.3.3.3
+
+        @param changes: dict, record key => (previous mv_key or None, new mv_key or None)
+        @param rebuild: bool
+        @returns        int, number of index documents written or deleted
+        """
+        index_name = self.get_mvkey_index_name()
+        if index_name not in self.service.kvstore:
+            self.logger.debug(
+                "run_id={} script={} method=update_mvkey_index status=skipped reason=\"collection={} not created yet\"".format(
+                    self.run_id, self.SCRIPT_NAME, index_name
+                )
+            )
+            return 0
+        collection_svc = self.service.kvstore[index_name]
+
+        added = {}
+        removed = {}
+        for key, (previous, current) in changes.items():
+            previous = set(previous) if previous and len(previous) > 1 else set()
+            current = set(current) if current and len(current) > 1 else set()
+            for value in previous - current:
+                removed.setdefault(value, set()).add(key)
+            for value in current - previous:
+                added.setdefault(value, set()).add(key)
+
+        touched = list(dict.fromkeys(list(added) + list(removed)))
+        if rebuild:
+            collection_svc.data.delete()
+            owners = {}
+        else:
+            owners = self.get_mvkey_owners(touched)
+
+        documents = []
+        emptied = []
+        for value in touched:
+            record_keys = set(owners.get(value, []))
+            record_keys.difference_update(removed.get(value, ()))
+            record_keys.update(added.get(value, ()))
+            if record_keys:
+                documents.append(
+                    {"_key": value, self.MVKEY_INDEX_OWNERS_FIELD: sorted(record_keys)}
+                )
+            elif value in owners:
+                emptied.append(value)
+
+        if rebuild:
+            documents.append(
+                {
+                    "_key": self.MVKEY_INDEX_READY_KEY,
+                    "run_id": self.run_id,
+                    "built_epoch": int(time.time()),
+                }
+            )
+        if documents:
+            self.handle_cached_write(index_name, records=documents, force=True)
+        for offset in range(0, len(emptied), self.EXPIRY_QUERY_CHUNK_SIZE):
+            chunk = emptied[offset : offset + self.EXPIRY_QUERY_CHUNK_SIZE]
+            collection_svc.data.delete(query=json.dumps(make_key_query(chunk)))
+
+        self.logger.info(
+            "run_id={} script={} input={} method=update_mvkey_index collection={} rebuild={} changed_record_count={} written_count={} deleted_count={}".format(
+                self.run_id,
+                self.SCRIPT_NAME,
+                self.source_name,
+                index_name,
+                str(rebuild).lower(),
+                str(len(changes)),
+                str(len(documents)),
+                str(len(emptied)),
+            )
+        )
+        return len(documents) + len(emptied)
+
+    def queue_purge_for_key(self, event):
+        """
+        deferred version of expire_all_records_for_key(event, purge_mode=True): remember the event's _key
+        for every _last_inventoried data source, to be deleted later by purge_queued_records().
+
+        @param event:   dict, the existing kvstore record
+        @returns        bool, False if the event has no _key to purge
+        """
+        primary_key = event.get(self.HIDDEN_KEY_FIELD)
+        if not primary_key:
+            self.logger.warning(
+                "run_id={} method=queue_purge_for_key Unable to purge key for event={}, _key not found for expiry job, verify key={} does not exist and purge manually if needed.".format(
+                    self.run_id, str(event), str(event.get(self.VISIBLE_KEY_FIELD))
+                )
+            )
+            return False
+        for source in self.get_collection_names_to_purge(event):
+            self.purge_queue.setdefault(source, []).append(primary_key)
+        return True
+
+    def purge_queued_records(self):
+        """
+        delete every record queued by queue_purge_for_key(), with one data.delete(query=...) request per
+        EXPIRY_QUERY_CHUNK_SIZE keys of each source collection.  Failures do not stop the remaining deletes;
+        they are summarized in a single warning so the keys can be purged manually.
+
+        @returns    dict, {"requested": int, "failed": int, "failed_sources": list of strings}
+        """
+        requested_count = 0
+        failures = {}
+        for source, keys in self.purge_queue.items():
+            keys = list(dict.fromkeys(keys))
+            requested_count += len(keys)
+            collection_svc = self.get_source_collection(source, "purge_queued_records")
+            if collection_svc is None:
+                failures[source] = keys
+                continue
+
+            for offset in range(0, len(keys), self.EXPIRY_QUERY_CHUNK_SIZE):
+                chunk = keys[offset : offset + self.EXPIRY_QUERY_CHUNK_SIZE]
+                try:
+                    collection_svc.data.delete(query=json.dumps(make_key_query(chunk)))
+                except Exception as error:
+                    self.logger.debug(
+                        "run_id={} method=purge_queued_records Unable to delete from kvstore={} error={} key_count={}".format(
+                            self.run_id, str(source), str(error), str(len(chunk))
+                        )
+                    )
+                    failures.setdefault(source, []).extend(chunk)
+
+            self.logger.info(
+                "run_id={} method=purge_queued_records source={} key_count={} failed_count={}".format(
+                    self.run_id,
+                    str(source),
+                    str(len(keys)),
+                    str(len(failures.get(source, []))),
+                )
+            )
+
+        failed_count = sum(len(keys) for keys in failures.values())
+        if failures:
+            self.logger.warning(
+                "run_id={} method=purge_queued_records Unable to delete failed_count={} of requested_count={} records for expiry job, should be purged manually. failed_keys={}".format(
+                    self.run_id,
+                    str(failed_count),
+                    str(requested_count),
+                    format_log_payload(failures, self.LOG_PAYLOAD_MAX_LENGTH),
+                )
+            )
+        self.purge_queue = {}
+        return {
+            "requested": requested_count,
+            "failed": failed_count,
+            "failed_sources": sorted(failures),
+        }
+
     @log_enter_exit()
     def expire_all_records_for_key(self, event, purge_mode=False):
         """
@@ -550,29 +2266,11 @@ class OversightScript:
 
         for source in data_sources:
 
-            try:
-                # make sure we can connect to the kvstore
-                self.collection_svc = self.service.kvstore[source]
-            except KeyError as error:
-                self.logger.warning(
-                    "run_id={} method=expire_all_records_for_key Unable to examine kvstore={} for expiry job, error={} skipping data source.".format(
-                        self.run_id, str(source), str(error)
-                    )
-                )
-                continue
-            except binding.HTTPError as error:
-                self.logger.warning(
-                    "run_id={} method=expire_all_records_for_key Unable to read kvstore={} for expiry job, error={} skipping data source.".format(
-                        self.run_id, str(source), str(error)
-                    )
-                )
-                continue
-            except Exception as error:
-                self.logger.warning(
-                    "run_id={} method=expire_all_records_for_key Unable to examine kvstore={} for expiry job, error={} skipping data source.".format(
-                        self.run_id, str(source), str(error)
-                    )
-                )
+            # make sure we can connect to the kvstore
+            self.collection_svc = self.get_source_collection(
+                source, "expire_all_records_for_key"
+            )
+            if self.collection_svc is None:
                 continue
 
             readable_key = host_key or primary_key
@@ -1,8 +1,5 @@
 # encoding = utf-8
 
-import copy
-import csv
-import gzip
 import json
 import os
 import sys
@@ -11,7 +8,13 @@ import import_declare_test
 import solnlib.log
 import splunklib.client
 
-from oversight_utils import log_enter_exit, OversightScript
+from oversight_utils import (
+    MvKeyIndex,
+    OversightScript,
+    copy_record,
+    log_enter_exit,
+    record_run_metrics,
+)
 
 
 class InventoryUpdater(OversightScript):
@@ -98,52 +101,36 @@ class InventoryUpdater(OversightScript):
             }
 
         existing_first = output_event.get(self.FIRST_INVENTORIED_FIELD)
-        existing_last = output_event.get(self.LAST_INVENTORIED_FIELD)
-        existing_last_checkin_source_field = output_event.get(
-            self.last_checkin_source_field
-        )
-
-        # normalize to epoch time
-        existing_first_epoch = None
-        existing_last_epoch = None
-        input_event_last_inventoried_epoch = None
-        existing_last_checkin_source_field_epoch = None
-
-        if existing_first:
-            existing_first_epoch = self.convert_timestring_to_epoch(
-                existing_first, self.TIME_FORMAT
-            )
-
-        if existing_last:
-            existing_last_epoch = self.convert_timestring_to_epoch(
-                existing_last, self.TIME_FORMAT
-            )
-
-        if input_event_last_inventoried:
-            input_event_last_inventoried_epoch = self.convert_timestring_to_epoch(
-                input_event_last_inventoried, self.TIME_FORMAT
-            )
 
-        if existing_last_checkin_source_field:
-            existing_last_checkin_source_field_epoch = self.convert_timestring_to_epoch(
-                existing_last_checkin_source_field, self.TIME_FORMAT
-            )
+        # normalize to epoch time; existing records carry epoch fields, see set_epoch_field()
+        existing_first_epoch = self.get_epoch(
+            output_event, self.FIRST_INVENTORIED_FIELD, self.TIME_FORMAT
+        )
+        existing_last_epoch = self.get_epoch(
+            output_event, self.LAST_INVENTORIED_FIELD, self.TIME_FORMAT
+        )
+        existing_last_checkin_source_field_epoch = self.get_epoch(
+            output_event, self.last_checkin_source_field, self.TIME_FORMAT
+        )
+        input_event_last_inventoried_epoch = self.get_epoch(
+            input_event, self.LAST_INVENTORIED_FIELD, self.TIME_FORMAT
+        )
 
         if (
-            not existing_last_epoch
+            existing_last_epoch is None
             or input_event_last_inventoried_epoch > existing_last_epoch
         ):
             output.update({self.LAST_INVENTORIED_FIELD: input_event_last_inventoried})
 
         if (
-            not existing_first_epoch
+            existing_first_epoch is None
             or input_event_last_inventoried_epoch < existing_first_epoch
             or (existing_first is None)
         ):
             output.update({self.FIRST_INVENTORIED_FIELD: input_event_last_inventoried})
 
         if (
-            not existing_last_checkin_source_field_epoch
+            existing_last_checkin_source_field_epoch is None
             or input_event_last_inventoried_epoch
             > existing_last_checkin_source_field_epoch
         ):
@@ -253,7 +240,8 @@ class InventoryUpdater(OversightScript):
         existing contents of the aggregated lookup
 
         1. Update output_event timestamps for self.LAST_INVENTORIED_FIELD,
-            self.FIRST_INVENTORIED_FIELD, and self.last_checkin_source_field, as necessary
+            self.FIRST_INVENTORIED_FIELD, and self.last_checkin_source_field, as necessary,
+            and the epoch seconds of each (see set_epoch_field())
         2. Add the aggregation field values to output_event from input_event, if necessary
         3. Set output_event['asset_group'] if defined in modular input parameters
         4. Set "expired" to false unless it is current not false
@@ -265,6 +253,12 @@ class InventoryUpdater(OversightScript):
         """
         updated_timestamp_fields = self.aggregate_timestamps(output_event, input_event)
         output_event.update(updated_timestamp_fields)
+        for field in [
+            self.LAST_INVENTORIED_FIELD,
+            self.FIRST_INVENTORIED_FIELD,
+            self.last_checkin_source_field,
+        ]:
+            self.set_epoch_field(output_event, field, self.TIME_FORMAT)
 
         aggregation_field_update = self.extract_aggregation_fields(input_event)
 
@@ -299,6 +293,25 @@ class InventoryUpdater(OversightScript):
         base_fields = dict.fromkeys(list(set(base_fields)))
         return base_fields
 
+    def get_input_fieldnames(self, base_fields):
+        """list the results file columns read while aggregating: base_fields, the validated fields,
+        the multi-value key column and every aggregation field with its __mv_ column
+
+        @param base_fields: dict, see get_base_fields()
+        @returns            list of strings
+        """
+        fieldnames = list(base_fields) + [
+            self.HIDDEN_KEY_FIELD,
+            self.id_field,
+            self.LAST_INVENTORIED_FIELD,
+            "expired",
+        ]
+        if self.mv_key_field:
+            fieldnames.append(self.mv_key_field)
+        for field in self.aggregation_fields or []:
+            fieldnames.extend([field, "__mv_{}".format(field)])
+        return list(dict.fromkeys(i for i in fieldnames if i))
+
     # do not log payload directly it includes a token and splunk URI (sensitive)
     def setup_attributes(self, service, payload, app_settings, input_settings):
         """set InventoryUpdater attributes from app settings and input settings"""
@@ -361,10 +374,8 @@ class InventoryUpdater(OversightScript):
         self.last_checkin_source_field = "{}_{}".format(
             self.source_name, self.LAST_INVENTORIED_FIELD
         )
-        # service.inputs yields 404 if directly accessed as non-admin .... not sure why
-        if self.source_name not in [
-            i.name for i in self.service.inputs.list(self.MODINPUT_KIND, count=-1)
-        ]:
+        # input_settings are the settings update_inventory() loaded for source_name, None if no such input
+        if input_settings is None:
             self.logger.error(
                 "run_id={} input={} status=fail msg=invalid source={} specified".format(
                     self.run_id, self.source_name, self.source_name
@@ -485,13 +496,13 @@ class InventoryUpdater(OversightScript):
         output_key = input_event[self.HIDDEN_KEY_FIELD]
 
         # remove chars illegal for kvstore/mongodb _key field value
-        readable_key = copy.deepcopy(output_key)
+        readable_key = output_key
         output_key = self.make_key_safe(output_key)
 
         output_event = self.get_cached_record(output_key)
 
         if not output_event:
-            output_event = copy.deepcopy(base_fields)
+            output_event = copy_record(base_fields)
             output_event.update({self.VISIBLE_KEY_FIELD: input_event[self.id_field]})
 
         output_event[self.HIDDEN_KEY_FIELD] = output_key
@@ -624,8 +635,104 @@ class InventoryUpdater(OversightScript):
         )
         return update_existing_key_only
 
+    def get_results_keys(self, results_file):
+        """read only the key and multi-value key columns of the results file
+
+        @param results_file:    string, path of the gzip csv results file
+        @returns                set of record keys, set of mv_key values
+        """
+        keys = set()
+        values = set()
+        fieldnames = [self.HIDDEN_KEY_FIELD]
+        if self.mv_key_field:
+            fieldnames.append(self.mv_key_field)
+        for row in self.iter_results_file(results_file, fieldnames):
+            key = self.make_key_safe(row.get(self.HIDDEN_KEY_FIELD))
+            if key:
+                keys.add(key)
+            if self.mv_key_field:
+                values.update(self.parse_mvkey_string(row.get(self.mv_key_field)) or [])
+        return keys, values
+
+    def synchronize_mvkeys(self, mvkey_index, phase_one_records, streamed_keys):
+        """give every record of a connected mv_key component the same, canonical self.VISIBLE_MVKEY_FIELD:
+        the sorted list of every value in the component (see MvKeyIndex).
+
+        Incoming records in phase_one_records are updated in place.  Existing records are updated in
+        self.aggregation_cache and returned to be written.  Records in streamed_keys were already
+        written before they were linked to a component, so they are read back from the aggregation
+        kvstore once the write cache is flushed.
+
+        @param mvkey_index:         MvKeyIndex of all existing and incoming mv_key values
+        @param phase_one_records:   2D dict - aggregated incoming records which are not written yet
+        @param streamed_keys:       set of strings - keys of incoming records already written
+        @returns update_existing_key_only - 2d dict - updated existing records not in phase_one_records
+        """
+        self.logger.debug(
+            """run_id={} input={} method=synchronize_mvkeys status=entered args={}""".format(
+                self.run_id,
+                self.source_name,
+                str(
+                    {
+                        "mvkey_value_count": len(mvkey_index),
+                        "component_count": len(mvkey_index.components()),
+                        "phase_one_records_size": len(phase_one_records),
+                    }
+                ),
+            )
+        )
+        update_existing_key_only = {}
+        late_linked = {}
+        for new_mvkey in mvkey_index.components().values():
+            for value in new_mvkey:
+                key = self.make_key_safe(value)
+                if key in phase_one_records:
+                    if phase_one_records[key].get(self.VISIBLE_MVKEY_FIELD) != new_mvkey:
+                        phase_one_records[key][self.VISIBLE_MVKEY_FIELD] = list(new_mvkey)
+                elif key in streamed_keys:
+                    late_linked[key] = new_mvkey
+                    continue
+
+                if (
+                    key in self.aggregation_cache
+                    and self.aggregation_cache[key].get(self.VISIBLE_MVKEY_FIELD)
+                    != new_mvkey
+                ):
+                    update_existing_key_only = self.update_cache_and_aggregation_mvkeys(
+                        key, list(new_mvkey), phase_one_records, update_existing_key_only
+                    )
+
+        if late_linked:
+            # make sure the streamed versions of these records are the ones read back
+            self.handle_cached_write(self.AGGREGATED_COLLECTION_NAME, force=True)
+            for record in self.iter_records_for_keys(
+                self.AGGREGATED_COLLECTION_NAME, list(late_linked)
+            ):
+                key = record.get(self.HIDDEN_KEY_FIELD)
+                if record.get(self.VISIBLE_MVKEY_FIELD) != late_linked[key]:
+                    record[self.VISIBLE_MVKEY_FIELD] = list(late_linked[key])
+                    update_existing_key_only[key] = record
+                    # the kvstore no longer matches the cached copy
+                    self.modified_cache_keys.add(key)
+
+        self.logger.debug(
+            """run_id={} input={} method=synchronize_mvkeys status=exited args={}""".format(
+                self.run_id,
+                self.source_name,
+                str(
+                    {
+                        "late_linked_count": len(late_linked),
+                        "update_existing_key_only_size": len(update_existing_key_only),
+                    }
+                ),
+            )
+        )
+        return update_existing_key_only
+
+    @record_run_metrics
     def update_inventory(self, payload):
         """This is the method called by Splunk to initate the alert action.
+        Its metrics are emitted as one oversight:metrics event, see emit_run_metrics().
         @param payload:      contains link to results file from outputlookup
 
         """
@@ -637,7 +744,8 @@ class InventoryUpdater(OversightScript):
         )
         self.validate_alert_arguments(payload)
         token = payload.get("session_key")
-        app_settings = self.read_app_settings(token)
+        with self.metrics.phase("settings_load"):
+            app_settings = self.load_app_settings(token)
         service = splunklib.client.connect(
             token=token, app=self.APP_NAME, owner="Nobody"
         )
@@ -651,13 +759,8 @@ class InventoryUpdater(OversightScript):
                 self.run_id, self.SCRIPT_NAME, self.source_name
             )
         )
-        try:
-            input_settings = [
-                i.content
-                for i in self.service.inputs.list(self.MODINPUT_KIND, count=-1)
-                if i.name == self.source_name
-            ][0]
-        except IndexError:
+        input_settings = self.get_input_settings(self.source_name)
+        if input_settings is None:
             self.logger.critical(
                 """run_id={} script={} input={} status=failed reason="could not load input definition.  Please try to EDIT and SAVE this input definition. Aborting execution." """.format(
                     self.run_id, self.SCRIPT_NAME, self.source_name
@@ -683,48 +786,62 @@ class InventoryUpdater(OversightScript):
             )
         )
 
+        results_file = payload.get("results_file")
+        if not results_file:
+            self.logger.error(
+                'run_id={} input={} status:fail msg="no results file included"'.format(
+                    self.run_id,
+                    self.source_name,
+                )
+            )
+            sys.exit(1)
+
         # prior host variables are to track if a given key has already been inserted previously.
         # If so, do an update not an insert.  Used to avoid excessive API calls for each record.
         # helpful to have this cache as an attribute for testing
-        cache = self.get_kvstore_records(self.AGGREGATED_COLLECTION_NAME)
-        self.aggregation_cache = self.get_dict_from_records("_key", cache)
-        aggregation_cache_mvkey = [
-            k
-            for k, v in self.aggregation_cache.items()
-            if v.get(self.VISIBLE_MVKEY_FIELD) and len(v[self.VISIBLE_MVKEY_FIELD]) > 1
-        ]
+        mvkey_index_ready = self.is_mvkey_index_ready()
+        with self.metrics.phase("aggregation_cache_load"):
+            if mvkey_index_ready:
+                # only the records for incoming keys and those linked to them by mv_key
+                self.aggregation_cache = self.load_linked_records(
+                    *self.get_results_keys(results_file)
+                )
+                # a stale index is rebuilt from the whole aggregation collection below
+                mvkey_index_ready = self.aggregation_cache is not None
+            if not mvkey_index_ready:
+                cache = self.iter_kvstore_records(self.AGGREGATED_COLLECTION_NAME)
+                self.aggregation_cache = self.get_dict_from_records("_key", cache)
+        # every mv_key value linked to another, across existing and incoming records
+        mvkey_index = MvKeyIndex()
+        original_mvkeys = {}
+        for key, record in self.aggregation_cache.items():
+            if self.is_multivalued_mvkey(record):
+                mvkey_index.add(record[self.VISIBLE_MVKEY_FIELD])
+                original_mvkeys[key] = list(record[self.VISIBLE_MVKEY_FIELD])
 
         self.logger.debug(
-            "prior_host_data_size={} run_id={} input={} kvstore_max_batch={}".format(
+            "prior_host_data_size={} run_id={} input={} kvstore_max_batch={} mvkey_index_ready={}".format(
                 str(len(self.aggregation_cache)),
                 self.run_id,
                 self.source_name,
                 self.kvstore_max_batch,
+                str(mvkey_index_ready).lower(),
             )
         )
 
-        results_file = payload.get("results_file")
-        if not results_file:
-            self.logger.error(
-                'run_id={} input={} status:fail msg="no results file included"'.format(
-                    self.run_id,
-                    self.source_name,
-                )
-            )
-            sys.exit(1)
-
         # still need to examine to see if self.VISIBLE_MVKEY_FIELD needs to be synchronized or not, dont' write yet!
         phase_one_records = {}
-        phase_one_mvkey_records = []
-
-        with gzip.open(
-            results_file,
-            "rt",
-        ) as csv_file:
-            csvreader = csv.DictReader(csv_file)
-            invalid_input_event_count = 0
-
-            for input_event in csvreader:
+        # records that are not linked to any other mv_key value so far are written as soon as they are
+        # aggregated; see synchronize_mvkeys() for those linked later in the results
+        streamed_keys = set()
+        invalid_input_event_count = 0
+        unchanged_record_count = 0
+
+        input_events = self.iter_results_file(
+            results_file, self.get_input_fieldnames(base_fields)
+        )
+        with self.metrics.phase("aggregation"):
+            for input_event in input_events:
                 if not self.validate_input_event(input_event):
                     invalid_input_event_count += 1
                     continue
@@ -737,7 +854,8 @@ class InventoryUpdater(OversightScript):
                     field_names_to_purge = self.get_fieldnames_to_purge(output_event)
                     if self.aggregation_cache.get(output_key):
                         del self.aggregation_cache[output_key]
-                    self.expire_all_records_for_key(output_event, purge_mode=True)
+                    # source records are deleted in bulk once all events are read
+                    self.queue_purge_for_key(output_event)
                     if field_names_to_purge:
                         for field in field_names_to_purge:
                             del output_event[field]
@@ -757,89 +875,60 @@ class InventoryUpdater(OversightScript):
                 output_event, output_key = self.aggregate_event(
                     input_event, output_event, output_key
                 )
-                phase_one_records.update({output_key: output_event})
+                is_mvkey_record = self.is_multivalued_mvkey(output_event)
                 if (
-                    output_event.get(self.VISIBLE_MVKEY_FIELD)
-                    and len(output_event.get(self.VISIBLE_MVKEY_FIELD)) > 1
+                    not is_mvkey_record
+                    and output_key not in mvkey_index
+                    and output_key not in phase_one_records
                 ):
-                    phase_one_mvkey_records.append(output_key)
-
-        self.logger.debug(
-            """run_id={} input={} method=mvkey_synchronization status=entered""".format(
-                self.run_id, self.source_name
-            )
-        )
-        # existing records with mvkey that are also in the incoming event set
-        records_to_review = set(aggregation_cache_mvkey + phase_one_mvkey_records)
-        keys_of_records_with_incorrect_mvkeys = (
-            self.identify_records_with_outdated_mvkeys(
-                records_to_review, phase_one_records
-            )
-        )
-
-        update_existing_key_only = {}
-        for key in keys_of_records_with_incorrect_mvkeys:
-            existing_mvkey = (
-                self.aggregation_cache[key].get(self.VISIBLE_MVKEY_FIELD)
-                if key in self.aggregation_cache
-                else None
-            )
-            incoming_mvkey = (
-                phase_one_records[key].get(self.VISIBLE_MVKEY_FIELD)
-                if key in phase_one_records
-                else None
-            )
-            if existing_mvkey:
-                existing_mvkey = set(existing_mvkey)
-            if incoming_mvkey:
-                incoming_mvkey = set(incoming_mvkey)
-
-            new_mvkey = self.calculate_new_mvkeys(existing_mvkey, incoming_mvkey)
-            if not new_mvkey:
-                continue
+                    # single valued mvkey, not part of any known mvkey: final as aggregated
+                    streamed_keys.add(output_key)
+                    if self.is_cached_record_unchanged(output_key, output_event):
+                        unchanged_record_count += 1
+                        continue
+                    self.handle_cached_write(
+                        self.AGGREGATED_COLLECTION_NAME, records=[output_event]
+                    )
+                    continue
 
-            if key in phase_one_records:
-                phase_one_records[key][self.VISIBLE_MVKEY_FIELD] = new_mvkey
-            if existing_mvkey and sorted(list(existing_mvkey)) != new_mvkey:
-                update_existing_key_only = self.update_cache_and_aggregation_mvkeys(
-                    key, new_mvkey, phase_one_records, update_existing_key_only
-                )
+                phase_one_records.update({output_key: output_event})
+                if is_mvkey_record:
+                    mvkey_index.add(output_event[self.VISIBLE_MVKEY_FIELD])
 
-            if (
-                existing_mvkey
-                and incoming_mvkey
-                and not existing_mvkey.issubset(incoming_mvkey)
-            ):
-                # add additional pending writes in edge cases
-                # look for all OTHER keys in new_keys, make sure they get updated too!
-                # ie existing_mvkey =["1", "2", "3"], incoming_mvkey: ["1","2","4"] ==> new_keys=["1", "2", "3", "4"]
-                # "4" will not be included in phase_one_records but needs to be updated in the aggregation collection
-
-                missing_mvkey_values = (
-                    set(incoming_mvkey).difference(set(new_mvkey))
-                    if incoming_mvkey and new_mvkey
-                    else incoming_mvkey or new_mvkey
+        if self.purge_queue:
+            purge_summary = self.purge_queued_records()
+            self.logger.info(
+                "run_id={} input={} method=purge_queued_records status=completed requested_count={} failed_count={} failed_sources={}".format(
+                    self.run_id,
+                    self.source_name,
+                    str(purge_summary["requested"]),
+                    str(purge_summary["failed"]),
+                    str(purge_summary["failed_sources"]),
                 )
-                for key in missing_mvkey_values:
-                    if (
-                        key in self.aggregation_cache
-                        and key not in update_existing_key_only
-                        and key not in phase_one_mvkey_records
-                    ):
-                        update_existing_key_only[key] = self.get_cached_record(key)
-                        update_existing_key_only[key][
-                            self.VISIBLE_MVKEY_FIELD
-                        ] = new_mvkey
+            )
 
-        self.logger.debug(
-            "run_id={} input={} method=mvkey_synchronization status=exit".format(
-                self.run_id, self.source_name
+        with self.metrics.phase("mvkey_sync"):
+            update_existing_key_only = self.synchronize_mvkeys(
+                mvkey_index, phase_one_records, streamed_keys
             )
-        )
+
+        # phase one records are written last and replace the whole document, so a key in both
+        # batches only needs its phase one record; unchanged records are not written at all
         records_batch_1 = [
-            value for value in update_existing_key_only.values() if value
+            value
+            for key, value in update_existing_key_only.items()
+            if value
+            and key not in phase_one_records
+            and not self.is_cached_record_unchanged(key, value)
         ]
-        records_batch_2 = [value for value in phase_one_records.values() if value]
+        records_batch_2 = []
+        for key, value in phase_one_records.items():
+            if not value:
+                continue
+            if self.is_cached_record_unchanged(key, value):
+                unchanged_record_count += 1
+                continue
+            records_batch_2.append(value)
         if len(records_batch_1) > 0:
             self.handle_cached_write(
                 self.AGGREGATED_COLLECTION_NAME, records=records_batch_1, force=True
@@ -848,18 +937,46 @@ class InventoryUpdater(OversightScript):
             self.handle_cached_write(
                 self.AGGREGATED_COLLECTION_NAME, records=records_batch_2, force=True
             )
+        # streamed records are only written in whole batches, write whatever is left
         self.logger.debug(
             "run_id={} input={} forcing a cached write".format(
                 self.run_id, self.source_name
             )
         )
+        self.handle_cached_write(self.AGGREGATED_COLLECTION_NAME, force=True)
+
+        final_mvkeys = {}
+        if not mvkey_index_ready:
+            final_mvkeys = {
+                key: record.get(self.VISIBLE_MVKEY_FIELD)
+                for key, record in self.aggregation_cache.items()
+                if self.is_multivalued_mvkey(record)
+            }
+        for records in [update_existing_key_only, phase_one_records]:
+            for key, record in records.items():
+                if record:
+                    final_mvkeys[key] = record.get(self.VISIBLE_MVKEY_FIELD)
+        if mvkey_index_ready:
+            mvkey_changes = {
+                key: (original_mvkeys.get(key), mvkey)
+                for key, mvkey in final_mvkeys.items()
+                if original_mvkeys.get(key) != mvkey
+            }
+        else:
+            # the whole aggregation collection was read, so the index can be built from scratch
+            mvkey_changes = {key: (None, mvkey) for key, mvkey in final_mvkeys.items()}
+        with self.metrics.phase("mvkey_index_update"):
+            self.update_mvkey_index(mvkey_changes, rebuild=not mvkey_index_ready)
+        self.metrics.count("invalid_rows", invalid_input_event_count)
+        self.metrics.count("unchanged_records", unchanged_record_count)
         self.logger.info(
-            "run_id={} input={} status=completed skipped_invalid_events={} aggregated_record_count={} aggregated_record_key_update_count={}".format(
+            "run_id={} input={} status=completed skipped_invalid_events={} aggregated_record_count={} aggregated_record_key_update_count={} unchanged_record_count={}".format(
                 self.run_id,
                 self.source_name,
                 str(invalid_input_event_count),
-                str(len(phase_one_records)),
-                str(len(update_existing_key_only)),
+                str(len(phase_one_records) + len(streamed_keys)),
+                str(len(records_batch_1)),
+                str(unchanged_record_count),
             )
         )
         return True
@@ -12,7 +12,7 @@ class mock_splunk_service(object):
     def __init__(self, app_name, *collections):
         super(mock_splunk_service, self).__init__()
         self.namespace = {"app": app_name, "sharing": None, "user": None}
-        self.kvstore = {}
+        self.kvstore = mock_kvstore_collections()
         for collection in collections:
             self.kvstore[collection] = mock_kvstore(collection)
 
@@ -51,14 +51,24 @@ class mock_service_inputs(object):
     def list(self, type_name, count=None):
         return self.input_list
 
-    def add(self, input_name):
-        self.input_list.append(mock_input_item(input_name))
+    def add(self, input_name, content=None):
+        self.input_list.append(mock_input_item(input_name, content))
+
+    def __getitem__(self, key):
+        # splunklib.client.Inputs[name, kind]
+        name, kind = key
+        self.get_count = getattr(self, "get_count", 0) + 1
+        for item in self.input_list:
+            if item.name == name:
+                return item
+        raise KeyError(key)
 
 
 class mock_input_item(object):
-    def __init__(self, name):
+    def __init__(self, name, content=None):
         super(mock_input_item, self).__init__()
         self.name = name
+        self.content = content or {}
 
 
 class mock_kvstore_data(object):
@@ -66,8 +76,24 @@ class mock_kvstore_data(object):
         super(mock_kvstore_data, self).__init__()
         self.data = data
 
-    def query(self):
-        return self.data
+    def query(self, **kwargs):
+        """supports the skip, limit, fields and query parameters of
+        splunklib.client.KVStoreCollectionData.query(); sort is ignored"""
+        self.query_count = getattr(self, "query_count", 0) + 1
+        output = self.data
+        if kwargs.get("query"):
+            query = kwargs["query"]
+            if isinstance(query, str):
+                query = json.loads(query)
+            output = [i for i in output if mock_query_match(i, query)]
+        skip = int(kwargs.get("skip") or 0)
+        output = output[skip:]
+        if kwargs.get("limit"):
+            output = output[: int(kwargs["limit"])]
+        if kwargs.get("fields"):
+            fields = kwargs["fields"].split(",")
+            output = [{k: v for k, v in i.items() if k in fields} for i in output]
+        return output
 
     def batch_save(self, *payload):
         input = iter(copy.deepcopy(payload))
@@ -87,11 +113,102 @@ class mock_kvstore_data(object):
             else:
                 self.data.extend([document])
 
+    def delete(self, query=None):
+        """delete documents matching query, or all documents if query is None"""
+        self.delete_count = getattr(self, "delete_count", 0) + 1
+        if query is None:
+            self.data[:] = []
+            return
+        if isinstance(query, str):
+            query = json.loads(query)
+        self.data[:] = [i for i in self.data if not mock_query_match(i, query)]
+
+
+def mock_query_match(document, query):
+    """evaluate the subset of the kvstore (mongodb) query language used by the app"""
+    for field, condition in query.items():
+        if field == "$and":
+            if not all(mock_query_match(document, i) for i in condition):
+                return False
+        elif field == "$or":
+            if not any(mock_query_match(document, i) for i in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = document.get(field)
+            for operator, operand in condition.items():
+                if operator == "$not" and mock_query_match(document, {field: operand}):
+                    return False
+                if operator == "$ne" and value == operand:
+                    return False
+                if operator in ["$lt", "$lte", "$gt", "$gte"] and value is None:
+                    return False
+                if operator == "$lt" and not value < operand:
+                    return False
+                if operator == "$lte" and not value <= operand:
+                    return False
+                if operator == "$gt" and not value > operand:
+                    return False
+                if operator == "$gte" and not value >= operand:
+                    return False
+        elif document.get(field) != condition:
+            return False
+    return True
+
+
 class mock_kvstore(object):
     def __init__(self, name, data=[]):
         super(mock_kvstore, self).__init__()
         self.name = name
         self.data = mock_kvstore_data(data)
+        self.content = {}  # collection config, ie field.* and accelerated_fields.*
+        self.update_count = 0
+
+    def update(self, **kwargs):
+        self.update_count += 1
+        for setting, value in kwargs.items():
+            # splunklib.client.KVStoreCollections returns accelerated_fields parsed
+            if setting.startswith("accelerated_fields."):
+                value = json.loads(value)
+            self.content[setting] = value
+
+
+class mock_kvstore_collections(dict):
+    def create(self, name, **kwargs):
+        self[name] = mock_kvstore(name, [])
+        self[name].update(**kwargs)
+        self[name].update_count = 0
+
+    def list(self):
+        return list(self.values())
+
+
+class mock_conf_entity(object):
+    # for mocking splunklib.client.Stanza and SavedSearch
+    def __init__(self, name, content=None):
+        super(mock_conf_entity, self).__init__()
+        self.name = name
+        self.content = dict(content or {})
+        self.update_count = 0
+
+    def update(self, **kwargs):
+        self.update_count += 1
+        self.content.update(kwargs)
+        return self
+
+
+class mock_conf_file(dict):
+    # for mocking splunklib.client.ConfigurationFile and SavedSearches
+    def __init__(self, stanzas=None):
+        super(mock_conf_file, self).__init__()
+        for name, content in (stanzas or {}).items():
+            self[name] = mock_conf_entity(name, content)
+
+    def create(self, name, **kwargs):
+        self[name] = mock_conf_entity(name, kwargs)
+        return self[name]
+
+    def list(self):
+        return list(self.values())
 
 
 class mock_arg(object):
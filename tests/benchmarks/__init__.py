@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Offline benchmarks for the Oversight scripts.
+
+These are not collected by pytest.  Run them from the repository root against the ucc-gen
+build output, ie:
+
+    python -m tests.benchmarks.bench_record_copy --events 100000
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# hack for making sure we load the ucc-gen build dir, same as the unit tests
+bindir = glob.glob("**/bin", recursive=True)
+bindir = [i for i in bindir if "output" in i][0]
+sys.path.insert(0, bindir)
+
+
+def make_splunk_home():
+    """point SPLUNK_HOME at a scratch directory so script logging has somewhere to write"""
+    splunk_home = tempfile.mkdtemp(prefix="oversight_bench_")
+    os.makedirs(os.path.join(splunk_home, "var", "log", "splunk"))
+    os.makedirs(os.path.join(splunk_home, "var", "run"))
+    os.environ["SPLUNK_HOME"] = splunk_home
+    return splunk_home
+
+
+def measure(func, *args, **kwargs):
+    """run func twice: once for wall clock time, once under tracemalloc for memory
+
+    @returns    dict with elapsed seconds and peak traced bytes
+    """
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"elapsed": elapsed, "peak_bytes": peak}
+
+
+def print_table(title, rows):
+    """print a list of dicts as a fixed width table"""
+    print(title)
+    if not rows:
+        return
+    columns = list(rows[0])
+    widths = [max(len(str(c)), *(len(str(r[c])) for r in rows)) for c in columns]
+    print("  ".join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[c]).ljust(w) for c, w in zip(columns, widths)))
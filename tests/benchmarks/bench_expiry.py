@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Compare InventoryExpirator.categorize_host_records (one pass, per asset group cutoffs)
+against calling is_expired on each record.
+
+    python -m tests.benchmarks.bench_expiry --records 2000000
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from tests import mock_splunk_service
+from tests.benchmarks import make_splunk_home, measure, print_table
+
+make_splunk_home()
+
+from expire_inventory import InventoryExpirator
+
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+APP_SETTINGS = {
+    "additional_parameters": {
+        "primary_id_field": "ip",
+        "primary_mv_id_field": "ip_addresses",
+        "last_inventoried_fieldname": "last_inventoried",
+        "first_inventoried_fieldname": "first_inventoried",
+        "aggregated_lookup_name": "hosts_lookup",
+        "aggregated_collection_name": "hosts_collection",
+        "time_format": TIME_FORMAT,
+    },
+    "logging": {"loglevel": "INFO"},
+    "default": 180,
+    "servers": 7,
+    "workstations": 30,
+}
+ASSET_GROUPS = ["default", "servers", "workstations"]
+
+
+def make_ip(index):
+    return "10.{}.{}.{}".format((index >> 16) & 255, (index >> 8) & 255, index & 255)
+
+
+def make_records(record_count, seed=0):
+    """records last inventoried within the past year, at hour granularity"""
+    rand = random.Random(seed)
+    now = datetime.today().replace(minute=0, second=0, microsecond=0)
+    records = []
+    for index in range(record_count):
+        ip = make_ip(index)
+        last_inventoried = now - timedelta(hours=rand.randint(0, 24 * 365))
+        records.append(
+            {
+                "_key": ip,
+                "ip": ip,
+                "asset_group": rand.choice(ASSET_GROUPS),
+                "last_inventoried": last_inventoried.strftime(TIME_FORMAT),
+            }
+        )
+    return records
+
+
+def make_expirator():
+    expirator = InventoryExpirator()
+    expirator.app_settings = APP_SETTINGS
+    expirator.setup(mock_splunk_service(expirator.APP_NAME), APP_SETTINGS)
+    expirator.LAST_INVENTORIED_FIELD = "last_inventoried"
+    expirator.VISIBLE_KEY_FIELD = "ip"
+    return expirator
+
+
+def per_record(expirator, records, pre_expired):
+    """the previous categorize_host_records loop"""
+    expired = {}
+    active = {}
+    for record in records:
+        if expirator.is_expired(record, pre_expired):
+            expired[record["_key"]] = record
+        else:
+            active[record["_key"]] = record
+    return expired, active
+
+
+def single_pass(expirator, records, pre_expired):
+    return expirator.categorize_host_records(records, pre_expired)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=200000)
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    pre_expired = [make_ip(i) for i in range(0, args.records, 100)]
+    expirator = make_expirator()
+    # expired records are logged one line each; keep that out of the comparison
+    expirator.logger.disabled = True
+
+    rows = []
+    for label, func in [("per_record", per_record), ("single_pass", single_pass)]:
+        result = measure(func, expirator, records, pre_expired)
+        expired, _ = func(expirator, records, pre_expired)
+        rows.append(
+            {
+                "method": label,
+                "records": args.records,
+                "expired": len(expired),
+                "seconds": "{:.3f}".format(result["elapsed"]),
+                "usec_per_record": "{:.2f}".format(
+                    result["elapsed"] * 1e6 / args.records
+                ),
+                "peak_mb": "{:.1f}".format(result["peak_bytes"] / 2 ** 20),
+            }
+        )
+    print_table("expiry categorization", rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""Run InventoryUpdater.update_inventory and InventoryExpirator.expire_inventory end to end against a
+synthetic inventory (see synthetic.py) held in an in-memory KV store stand-in which simulates request
+latency (see kvstore.py), and report throughput, REST calls and memory.
+
+With --splunkd the stand-in is served over HTTP by a local splunkd stand-in (see splunkd.py), so the
+scripts use real splunklib and solnlib clients, with their pooled keep-alive connections, and read
+their app settings and inputs over REST; the modular input reconciling the knowledge objects of every
+source runs first.
+
+Each inventory size runs in its own process, so peak RSS is not carried over between sizes; it includes
+the documents held by the stand-in, about the size of the collections.  For each
+size, update_inventory runs twice: first for source_0 while the mv_key index is built, then for the
+next source with the index; expire_inventory runs last.
+
+    python -m tests.benchmarks.bench_inventory --hosts 10000 100000 1000000
+    python -m tests.benchmarks.bench_inventory --hosts 10000 --splunkd
+"""
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import time
+import types
+from datetime import datetime
+
+from tests.benchmarks import make_splunk_home, print_table
+
+make_splunk_home()
+
+import solnlib.splunk_rest_client
+import splunklib.client
+
+import input_module_oversight
+from expire_inventory import InventoryExpirator
+from oversight_utils import DEFAULT_TIME_FORMAT, METRICS_LOG_FILENAME, OversightScript
+from tests import mock_arg, mock_scheme
+from tests.benchmarks import synthetic
+from tests.benchmarks.kvstore import BenchService
+from tests.benchmarks.splunkd import SplunkdStandIn
+from update_inventory import InventoryUpdater
+
+AGGREGATED_COLLECTION_NAME = "hosts_collection"
+
+
+def make_app_settings(asset_groups, loglevel):
+    """ta_oversight_settings.conf as read by OversightScript.read_app_settings()"""
+    settings = {
+        "additional_parameters": {
+            "primary_id_field": synthetic.ID_FIELD,
+            "primary_mv_id_field": synthetic.MV_ID_FIELD,
+            "last_inventoried_fieldname": synthetic.LAST_INVENTORIED_FIELD,
+            "first_inventoried_fieldname": synthetic.FIRST_INVENTORIED_FIELD,
+            "aggregated_lookup_name": "hosts_lookup",
+            "aggregated_collection_name": AGGREGATED_COLLECTION_NAME,
+            "time_format": DEFAULT_TIME_FORMAT,
+        },
+        "logging": {"loglevel": loglevel},
+        "asset_groups": {},
+    }
+    for number, (name, max_age) in enumerate(asset_groups.items(), 1):
+        settings["asset_groups"]["asset_group_{}_name".format(number)] = name
+        settings["asset_groups"]["asset_group_{}_max_age".format(number)] = str(max_age)
+    return settings
+
+
+def parse_asset_groups(values):
+    """["default:180", "servers:7"] => {"default": 180, "servers": 7}"""
+    asset_groups = {}
+    for value in values:
+        name, _, max_age = value.partition(":")
+        asset_groups[name] = int(max_age or 30)
+    if not 1 <= len(asset_groups) <= 3:
+        raise ValueError("between 1 and 3 asset groups are supported, got {}".format(values))
+    return asset_groups
+
+
+def make_service(options, assets):
+    service = BenchService(
+        latency_ms=options["latency_ms"],
+        document_latency_us=options["document_latency_us"],
+        max_rows_per_query=options["max_rows_per_query"],
+        max_documents_per_batch_save=options["max_documents_per_batch_save"],
+    )
+    service.load_collection(
+        AGGREGATED_COLLECTION_NAME, synthetic.make_aggregated_records(assets)
+    )
+    # empty, so the first update_inventory run builds the index
+    service.load_collection(AGGREGATED_COLLECTION_NAME + OversightScript.MVKEY_INDEX_SUFFIX)
+    asset_groups = list(options["asset_groups"])
+    for number, source in enumerate(synthetic.get_source_names(options["sources"])):
+        service.load_collection(
+            source + "_collection", synthetic.make_source_records(assets, source)
+        )
+        service.inputs.add(
+            source,
+            {
+                "id_field": synthetic.ID_FIELD,
+                "mv_id_field": synthetic.MV_ID_FIELD,
+                "asset_group": asset_groups[number % len(asset_groups)],
+                "aggregation_fields": ",".join(synthetic.AGGREGATION_FIELDS),
+            },
+        )
+    return service
+
+
+def make_input_definition(options):
+    """@returns (inputs as in the input definition stream_events() receives, scheme arguments)"""
+    inputs = {}
+    for number, source in enumerate(synthetic.get_source_names(options["sources"])):
+        inputs["oversight://" + source] = {
+            "source_expression": "index=main sourcetype={}".format(source),
+            "id_field": synthetic.ID_FIELD,
+            "id_field_rename": "",
+            "mv_id_field": synthetic.MV_ID_FIELD,
+            "source_fields": ",".join(synthetic.AGGREGATION_FIELDS),
+            "enrichment_expression": "",
+            "enrichment_fields": "",
+            "source_filter": "",
+            "inventory_filter": "",
+            "inventory_source": "1",
+            "aggregation_fields": ",".join(synthetic.AGGREGATION_FIELDS) if number == 0 else "",
+            "replicate": "0",
+            "cron": "0 {} * * *".format(number),
+        }
+    scheme = mock_scheme()
+    scheme.arguments = [mock_arg(i) for i in next(iter(inputs.values()))]
+    return inputs, scheme
+
+
+def serve_splunkd(service, app_settings):
+    """serve service with a SplunkdStandIn and point the scripts' splunklib and solnlib clients at it
+
+    @returns    SplunkdStandIn, started
+    """
+    server = SplunkdStandIn(service).start()
+    service.confs["ta_oversight_settings"] = copy.deepcopy(app_settings)
+    service.confs["transforms"] = {}
+    service.confs["macros"] = {}
+    connect = splunklib.client.connect
+    splunklib.client.connect = lambda **kwargs: connect(
+        **dict(kwargs, scheme="http", host=server.host, port=server.port)
+    )
+    solnlib.splunk_rest_client.get_splunkd_access_info = server.get_access_info
+    return server
+
+
+def run_modular_input(server, options):
+    """run input_module_oversight.stream_events() for every source, as splunkd runs the oversight input"""
+    inputs, scheme = make_input_definition(options)
+    modinput = types.SimpleNamespace(service=server.connect(), get_scheme=lambda: scheme)
+    input_module_oversight.stream_events(modinput, types.SimpleNamespace(inputs=inputs), None)
+    return True
+
+
+def read_metrics_event():
+    """the event emitted by the last script run, see OversightScript.emit_run_metrics()"""
+    path = os.path.join(os.environ["SPLUNK_HOME"], "var", "log", "splunk", METRICS_LOG_FILENAME)
+    with open(path) as metrics_file:
+        return json.loads(metrics_file.read().splitlines()[-1])
+
+
+def run_script(service, label, host_count, record_count, run):
+    """@param run:  callable returning the script's main method result
+    @returns        dict, a row of the report"""
+    service.reset_counts()
+    start = time.perf_counter()
+    if not run():
+        raise ValueError("{} failed".format(label))
+    elapsed = time.perf_counter() - start
+
+    event = read_metrics_event()
+    phases = sorted(
+        event["phases"].items(), key=lambda item: item[1]["self_seconds"], reverse=True
+    )
+    requests, _ = service.get_counts()
+    _, documents_read = service.get_counts("query")
+    _, documents_written = service.get_counts("batch_save")
+    return {
+        "hosts": host_count,
+        "run": label,
+        "records": record_count,
+        "seconds": "{:.2f}".format(elapsed),
+        "records_per_s": "{:.0f}".format(record_count / elapsed),
+        "rest_calls": requests,
+        "docs_read": documents_read,
+        "docs_written": documents_written,
+        "mb_sent": "{:.1f}".format(service.bytes_sent / 2 ** 20),
+        "peak_rss_mb": "{:.0f}".format((event["peak_rss_bytes"] or 0) / 2 ** 20),
+        "top_phases": " ".join(
+            "{}={:.2f}".format(name, phase["self_seconds"]) for name, phase in phases[:3]
+        ),
+    }
+
+
+def run_benchmark(options, host_count):
+    """generate an inventory of host_count assets and run the scripts against it
+
+    @param options:     dict, parsed command line arguments
+    @param host_count:  int
+    @returns            list of dicts, report rows
+    """
+    now = datetime.today().replace(second=0, microsecond=0)
+    assets = synthetic.make_assets(
+        host_count,
+        options["asset_groups"],
+        now,
+        multi_homed_ratio=options["multi_homed_ratio"],
+        source_count=options["sources"],
+        expired_fraction=options["expired_fraction"],
+        seed=options["seed"],
+    )
+    service = make_service(options, assets)
+    app_settings = make_app_settings(options["asset_groups"], options["loglevel"])
+
+    rows = []
+    if options["splunkd"]:
+        server = serve_splunkd(service, app_settings)
+        rows.append(
+            run_script(
+                service,
+                "oversight input",
+                host_count,
+                options["sources"],
+                lambda: run_modular_input(server, options),
+            )
+        )
+    else:
+        # the scripts connect to splunkd and read their settings over REST; hand them the stand-in instead
+        splunklib.client.connect = lambda *args, **kwargs: service
+        OversightScript.read_app_settings = lambda self, token, stanza="all": copy.deepcopy(
+            app_settings
+        )
+
+    sources = synthetic.get_source_names(options["sources"])
+    runs = []
+    for label, source in [
+        ("update_inventory (index build)", sources[0]),
+        ("update_inventory", sources[1 % len(sources)]),
+    ]:
+        results_file = os.path.join(
+            os.environ["SPLUNK_HOME"], "{}_{}_results.csv.gz".format(len(runs), source)
+        )
+        row_count = synthetic.write_results_file(
+            results_file, assets, source, now, seed=options["seed"] + len(runs)
+        )
+        runs.append((label, source, results_file, row_count))
+    # only the stand-in's collections stay in memory while the scripts run
+    del assets
+
+    for label, source, results_file, row_count in runs:
+        payload = {
+            "session_key": "bench",
+            "results_file": results_file,
+            "configuration": {"source_name": source},
+        }
+        rows.append(
+            run_script(
+                service,
+                label,
+                host_count,
+                row_count,
+                lambda: InventoryUpdater().update_inventory(payload),
+            )
+        )
+
+    record_count = len(service.kvstore[AGGREGATED_COLLECTION_NAME].data.documents)
+    payload = {"session_key": "bench", "configuration": {}}
+    rows.append(
+        run_script(
+            service,
+            "expire_inventory",
+            host_count,
+            record_count,
+            lambda: InventoryExpirator().expire_inventory(payload),
+        )
+    )
+    if options["splunkd"]:
+        server.stop()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--multi-homed-ratio", type=float, default=0.1)
+    parser.add_argument("--sources", type=int, default=3)
+    parser.add_argument(
+        "--asset-groups",
+        nargs="+",
+        default=["default:180", "servers:7", "workstations:30"],
+        help="name:max_age_days, at most 3",
+    )
+    parser.add_argument("--expired-fraction", type=float, default=0.05)
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="per request")
+    parser.add_argument(
+        "--document-latency-us", type=float, default=5.0, help="per document read or written"
+    )
+    parser.add_argument("--max-rows-per-query", type=int, default=50000)
+    parser.add_argument("--max-documents-per-batch-save", type=int, default=1000)
+    parser.add_argument("--loglevel", default="INFO")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--splunkd", action="store_true", help="serve the stand-in over HTTP, see splunkd.py"
+    )
+    args = parser.parse_args()
+    options = vars(args)
+    options["asset_groups"] = parse_asset_groups(args.asset_groups)
+
+    rows = []
+    context = multiprocessing.get_context("spawn")
+    for host_count in args.hosts:
+        with context.Pool(1) as pool:
+            rows.extend(pool.apply(run_benchmark, (options, host_count)))
+    print_table(
+        "end to end, latency_ms={} document_latency_us={}{}".format(
+            args.latency_ms, args.document_latency_us, " over http" if args.splunkd else ""
+        ),
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Build the MvKeyIndex used for mv_key synchronization over synthetic mv_key graphs.
+
+    python -m tests.benchmarks.bench_mvkey_index --keys 1000000
+"""
+import argparse
+import random
+
+from tests.benchmarks import make_splunk_home, measure, print_table
+
+make_splunk_home()
+
+from oversight_utils import MvKeyIndex
+
+
+def make_ip(index):
+    return "10.{}.{}.{}".format((index >> 16) & 255, (index >> 8) & 255, index & 255)
+
+
+def make_groups(key_count, seed=0):
+    """multi-homed assets of 1-4 addresses, as the mv_key lists of existing records"""
+    rand = random.Random(seed)
+    groups = []
+    index = 0
+    while index < key_count:
+        size = min(rand.choice([1, 1, 1, 2, 2, 3, 4]), key_count - index)
+        groups.append([make_ip(i) for i in range(index, index + size)])
+        index += size
+    return groups
+
+
+def make_bridges(groups, count, seed=1):
+    """incoming mv_key lists which link two existing assets, ie transitive merges"""
+    rand = random.Random(seed)
+    return [
+        [rand.choice(rand.choice(groups)), rand.choice(rand.choice(groups))]
+        for _ in range(count)
+    ]
+
+
+def make_chain(key_count):
+    """a single asset whose addresses were linked pairwise, one link per run"""
+    return [[make_ip(i), make_ip(i + 1)] for i in range(key_count - 1)]
+
+
+def build(mvkeys):
+    index = MvKeyIndex()
+    for mvkey in mvkeys:
+        index.add(mvkey)
+    return index.components()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--keys", type=int, default=1000000)
+    args = parser.parse_args()
+
+    groups = make_groups(args.keys)
+    graphs = [
+        ("assets", groups),
+        ("assets+bridges", groups + make_bridges(groups, args.keys // 100)),
+        ("chain", make_chain(args.keys)),
+    ]
+
+    rows = []
+    for label, mvkeys in graphs:
+        result = measure(build, mvkeys)
+        components = build(mvkeys)
+        rows.append(
+            {
+                "graph": label,
+                "keys": args.keys,
+                "mvkeys": len(mvkeys),
+                "components": len(components),
+                "largest": max([len(i) for i in components.values()] or [0]),
+                "seconds": "{:.3f}".format(result["elapsed"]),
+                "usec_per_key": "{:.2f}".format(result["elapsed"] * 1e6 / args.keys),
+                "peak_mb": "{:.1f}".format(result["peak_bytes"] / 2 ** 20),
+            }
+        )
+    print_table("mv_key union-find index", rows)
+
+
+if __name__ == "__main__":
+    main()
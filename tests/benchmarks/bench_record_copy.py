@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Compare the record copy policy of the aggregation and write cache hot paths
+(copy_record) against the previous copy.deepcopy policy.
+
+    python -m tests.benchmarks.bench_record_copy --events 100000
+"""
+import argparse
+import copy
+import random
+
+from tests import mock_splunk_service
+from tests.benchmarks import make_splunk_home, measure, print_table
+
+make_splunk_home()
+
+import oversight_utils
+import update_inventory
+from update_inventory import InventoryUpdater
+
+APP_SETTINGS = {
+    "additional_parameters": {
+        "primary_id_field": "ip",
+        "primary_mv_id_field": "ip_addresses",
+        "last_inventoried_fieldname": "last_inventoried",
+        "first_inventoried_fieldname": "first_inventoried",
+        "aggregated_lookup_name": "hosts_lookup",
+        "aggregated_collection_name": "hosts_collection",
+        "time_format": "%Y-%m-%d %H:%M",
+    },
+    "logging": {"loglevel": "INFO"},
+}
+INPUT_SETTINGS = {
+    "asset_group": "default",
+    "aggregation_fields": "os, hostname, owner",
+    "id_field": "ip",
+    "mv_id_field": "ip_addresses",
+}
+
+
+def make_ip(index):
+    return "10.{}.{}.{}".format((index >> 16) & 255, (index >> 8) & 255, index & 255)
+
+
+def make_data(event_count, seed=0):
+    """return (input events, existing aggregation cache); half the events update an existing record"""
+    rand = random.Random(seed)
+    events = []
+    cache = {}
+    for index in range(event_count):
+        ip = make_ip(index)
+        events.append(
+            {
+                "_key": ip,
+                "ip": ip,
+                "expired": "false",
+                "last_inventoried": "2021-06-{:02d} {:02d}:00".format(
+                    rand.randint(1, 28), rand.randint(0, 23)
+                ),
+                "os": "linux",
+                "hostname": "host{}".format(index),
+                "owner": "team{}".format(index % 50),
+                "__mv_ip_addresses": "",
+            }
+        )
+        if index % 2:
+            cache[ip] = {
+                "_key": ip,
+                "_user": "nobody",
+                "ip": ip,
+                "ip_addresses": [ip],
+                "expired": "false",
+                "asset_group": "default",
+                "first_inventoried": "2021-01-01 00:00",
+                "last_inventoried": "2021-05-01 00:00",
+                "bench_last_inventoried": "2021-05-01 00:00",
+                "os": "linux",
+                "hostname": "host{}".format(index),
+                "owner": "team{}".format(index % 50),
+            }
+    return events, cache
+
+
+class discard_kvstore_data(object):
+    """kvstore data stand-in which accepts and discards writes"""
+
+    def query(self, **kwargs):
+        return []
+
+    def batch_save(self, *documents):
+        return []
+
+
+def make_updater():
+    updater = InventoryUpdater()
+    updater.source_name = "bench"
+    service = mock_splunk_service(updater.APP_NAME, "hosts_collection")
+    service.kvstore["hosts_collection"].data = discard_kvstore_data()
+    service.inputs.add("bench")
+    payload = {"configuration": {"source_name": "bench", "log_level": "INFO"}}
+    updater.setup_attributes(service, payload, APP_SETTINGS, INPUT_SETTINGS)
+    # a single batch, the copies are measured not the kvstore
+    updater.kvstore_max_batch = 10 ** 9
+    return updater
+
+
+def aggregate(updater, events, cache):
+    """the per-event copy sites of InventoryUpdater.update_inventory"""
+    updater.aggregation_cache = {key: dict(value) for key, value in cache.items()}
+    updater.write_cache = {}
+    base_fields = updater.get_base_fields()
+    records = []
+    for input_event in events:
+        output_key, output_event = updater.initialize_output_event(
+            input_event, base_fields
+        )
+        output_event, output_key = updater.aggregate_event(
+            input_event, output_event, output_key
+        )
+        updater.update_cached_record(
+            output_key, **{updater.VISIBLE_MVKEY_FIELD: output_event["ip_addresses"]}
+        )
+        records.append(output_event)
+    updater.handle_cached_write(updater.AGGREGATED_COLLECTION_NAME, records=records)
+
+
+def use_deepcopy(updater):
+    """restore the previous copy.deepcopy policy for comparison"""
+    oversight_utils.copy_record = copy.deepcopy
+    update_inventory.copy_record = copy.deepcopy
+    handle_cached_write = updater.handle_cached_write
+
+    def deepcopy_cached_write(collection_name, records=None, force=False):
+        return handle_cached_write(
+            collection_name, records=copy.deepcopy(records), force=force
+        )
+
+    updater.handle_cached_write = deepcopy_cached_write
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=100000)
+    args = parser.parse_args()
+
+    events, cache = make_data(args.events)
+    copy_record = oversight_utils.copy_record
+
+    rows = []
+    for label in ["copy_record", "deepcopy"]:
+        updater = make_updater()
+        if label == "deepcopy":
+            use_deepcopy(updater)
+        result = measure(aggregate, updater, events, cache)
+        rows.append(
+            {
+                "policy": label,
+                "events": args.events,
+                "seconds": "{:.3f}".format(result["elapsed"]),
+                "usec_per_event": "{:.2f}".format(
+                    result["elapsed"] * 1e6 / args.events
+                ),
+                "peak_mb": "{:.1f}".format(result["peak_bytes"] / 2 ** 20),
+            }
+        )
+    oversight_utils.copy_record = copy_record
+    update_inventory.copy_record = copy_record
+    print_table("aggregation and write cache record copies", rows)
+
+
+if __name__ == "__main__":
+    main()
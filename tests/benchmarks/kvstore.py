@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""In-memory stand-in for the splunkd KV store, with simulated request latency.
+
+BenchService provides the parts of splunklib.client.Service the Oversight scripts use:
+kvstore[name].data query/batch_save/insert/update/delete, confs["limits"]["kvstore"] and
+inputs[name, kind].  Unlike the unit test mocks in tests/__init__.py, collections are indexed by _key
+so they hold millions of documents, query() honors max_rows_per_query, batch_save() rejects batches
+larger than max_documents_per_batch_save, and every request is counted and delayed like a REST call.
+splunkd.py serves a BenchService over HTTP for real splunklib clients.
+"""
+import json
+import threading
+import time
+import uuid
+
+from tests import mock_input_item, mock_query_match
+
+
+class KVStoreLimitError(Exception):
+    """a request exceeded a limits.conf [kvstore] limit, as splunkd would reject it"""
+
+
+def get_key_lookup(query):
+    """@returns (field, set of values) if query only matches field against a list of values,
+    ie make_key_query() output, otherwise None"""
+    terms = query.get("$or", [query]) if len(query) == 1 else None
+    if not terms:
+        return None
+    field = None
+    values = set()
+    for term in terms:
+        if not isinstance(term, dict) or len(term) != 1:
+            return None
+        name, value = next(iter(term.items()))
+        if name.startswith("$") or isinstance(value, dict) or field not in (None, name):
+            return None
+        field = name
+        values.add(value)
+    return field, values
+
+
+class KVStoreData:
+    """documents of one collection, keyed by _key.  Documents are stored and returned as JSON
+    round trips, so callers get new dicts as they would from splunkd."""
+
+    def __init__(self, service, name, documents=None):
+        self.service = service
+        self.name = name
+        self.documents = {}
+        self.sorted_keys = None  # cached sort order, reset when keys are added or deleted
+        self.query_cache = {}  # query => matching keys, reset on every write
+        self.lock = threading.Lock()
+        if documents:
+            self.load(documents)
+
+    def load(self, documents):
+        """add documents without a simulated request, ie to seed a snapshot"""
+        for document in documents:
+            self.documents[document["_key"]] = json.loads(json.dumps(document))
+        self.sorted_keys = None
+        self.query_cache = {}
+
+    def get_keys(self, query):
+        if self.sorted_keys is None:
+            self.sorted_keys = sorted(self.documents)
+        if not query:
+            return self.sorted_keys
+        if query in self.query_cache:
+            return self.query_cache[query]
+
+        parsed = json.loads(query)
+        lookup = get_key_lookup(parsed)
+        if lookup and lookup[0] == "_key":
+            keys = sorted(key for key in lookup[1] if key in self.documents)
+        elif lookup:
+            field, values = lookup
+            keys = [
+                key
+                for key in self.sorted_keys
+                if self.documents[key].get(field) in values
+            ]
+        else:
+            keys = [
+                key
+                for key in self.sorted_keys
+                if mock_query_match(self.documents[key], parsed)
+            ]
+        self.query_cache[query] = keys
+        return keys
+
+    def query(self, **kwargs):
+        """splunklib.client.KVStoreCollectionData.query(); skip, limit, fields and query are supported,
+        results are always sorted by _key"""
+        query = kwargs.get("query")
+        if isinstance(query, dict):
+            query = json.dumps(query)
+        skip = int(kwargs.get("skip") or 0)
+        limit = int(kwargs.get("limit") or 0) or self.service.max_rows_per_query
+        limit = min(limit, self.service.max_rows_per_query)
+        fields = kwargs["fields"].split(",") if kwargs.get("fields") else None
+
+        with self.lock:
+            keys = self.get_keys(query)[skip : skip + limit]
+            documents = [self.documents[key] for key in keys]
+            if fields:
+                # like splunkd, _key is returned unless excluded
+                documents = [
+                    {k: v for k, v in document.items() if k in fields or k == "_key"}
+                    for document in documents
+                ]
+            body = json.dumps(documents)
+        self.service.request(self.name, "query", len(documents), len(query or ""))
+        return json.loads(body)
+
+    def save(self, documents):
+        """store documents, replacing existing ones; a _key is generated for documents without one
+
+        @returns    list of the documents' keys
+        """
+        keys = []
+        with self.lock:
+            for document in documents:
+                document.setdefault("_key", uuid.uuid4().hex)
+                if document["_key"] not in self.documents:
+                    self.sorted_keys = None
+                self.documents[document["_key"]] = document
+                keys.append(document["_key"])
+            self.query_cache = {}
+        return keys
+
+    def batch_save(self, *documents):
+        """splunklib.client.KVStoreCollectionData.batch_save(); documents replace existing ones"""
+        if len(documents) > self.service.max_documents_per_batch_save:
+            raise KVStoreLimitError(
+                "batch_save of {} documents exceeds max_documents_per_batch_save={}".format(
+                    len(documents), self.service.max_documents_per_batch_save
+                )
+            )
+        body = json.dumps(
+            [json.loads(i) if isinstance(i, str) else i for i in documents]
+        )
+        self.service.request(self.name, "batch_save", len(documents), len(body))
+        return self.save(json.loads(body))
+
+    def insert(self, data):
+        """splunklib.client.KVStoreCollectionData.insert()"""
+        body = data if isinstance(data, str) else json.dumps(data)
+        self.service.request(self.name, "insert", 1, len(body))
+        return {"_key": self.save([json.loads(body)])[0]}
+
+    def update(self, id, data):
+        """splunklib.client.KVStoreCollectionData.update(); the document with _key id is replaced"""
+        body = data if isinstance(data, str) else json.dumps(data)
+        self.service.request(self.name, "update", 1, len(body))
+        document = json.loads(body)
+        document["_key"] = id
+        return {"_key": self.save([document])[0]}
+
+    def delete(self, query=None):
+        """splunklib.client.KVStoreCollectionData.delete(); all documents if query is None"""
+        with self.lock:
+            if query is None:
+                keys = list(self.documents)
+            else:
+                if isinstance(query, dict):
+                    query = json.dumps(query)
+                keys = list(self.get_keys(query))
+            for key in keys:
+                del self.documents[key]
+            self.sorted_keys = None
+            self.query_cache = {}
+        self.service.request(self.name, "delete", len(keys), len(query or ""))
+
+
+class KVStoreCollection:
+    def __init__(self, service, name, documents=None):
+        self.name = name
+        self.content = {}
+        self.data = KVStoreData(service, name, documents)
+
+
+class KVStoreCollections(dict):
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def create(self, name, **kwargs):
+        self[name] = KVStoreCollection(self.service, name)
+        self[name].content.update(kwargs)
+        return self[name]
+
+
+class BenchInputs:
+    """splunklib.client.Inputs[name, kind]"""
+
+    def __init__(self, service):
+        self.service = service
+        self.items = {}
+
+    def add(self, name, content):
+        self.items[name] = mock_input_item(name, content)
+
+    def __getitem__(self, key):
+        name, kind = key
+        self.service.request("inputs", "get", 1, 0)
+        return self.items[name]
+
+
+class BenchService:
+    """splunklib.client.Service stand-in backed by in-memory collections.
+
+    Each request sleeps latency_ms plus document_latency_us for every document read, written or
+    deleted, and is counted in requests, by collection and method, with the bytes sent.
+
+    @param latency_ms:                      float, round trip time of every request
+    @param document_latency_us:             float, additional time per document
+    @param max_rows_per_query:              int, limits.conf [kvstore]
+    @param max_documents_per_batch_save:    int, limits.conf [kvstore]
+    """
+
+    def __init__(
+        self,
+        latency_ms=0,
+        document_latency_us=0,
+        max_rows_per_query=50000,
+        max_documents_per_batch_save=1000,
+    ):
+        self.namespace = {}
+        self.token = "bench"
+        self.latency = latency_ms / 1000.0
+        self.document_latency = document_latency_us / 1e6
+        self.max_rows_per_query = max_rows_per_query
+        self.max_documents_per_batch_save = max_documents_per_batch_save
+        self.kvstore = KVStoreCollections(self)
+        self.inputs = BenchInputs(self)
+        self.confs = {
+            "limits": {
+                "kvstore": {
+                    "max_rows_per_query": str(max_rows_per_query),
+                    "max_documents_per_batch_save": str(max_documents_per_batch_save),
+                }
+            }
+        }
+        self.lock = threading.Lock()
+        self.reset_counts()
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests = {}  # (collection, method) => count
+            self.documents = {}  # (collection, method) => documents read, written or deleted
+            self.bytes_sent = 0
+
+    def request(self, collection, method, document_count, bytes_sent):
+        with self.lock:
+            key = (collection, method)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.documents[key] = self.documents.get(key, 0) + document_count
+            self.bytes_sent += bytes_sent
+        delay = self.latency + self.document_latency * document_count
+        if delay:
+            time.sleep(delay)
+
+    def load_collection(self, name, documents=()):
+        """create collection name holding documents, without simulated requests"""
+        self.kvstore[name] = KVStoreCollection(self, name, documents)
+        return self.kvstore[name]
+
+    def get_counts(self, method=None):
+        """@returns (requests, documents) summed over collections, for one method or all"""
+        with self.lock:
+            requests = sum(
+                v for (_, m), v in self.requests.items() if method in (None, m)
+            )
+            documents = sum(
+                v for (_, m), v in self.documents.items() if method in (None, m)
+            )
+        return requests, documents
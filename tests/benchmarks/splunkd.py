@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""Local splunkd stand-in: serves the REST endpoints the Oversight scripts use from a BenchService
+(see kvstore.py) over HTTP, so real splunklib and solnlib clients run against it with no Splunk instance.
+
+Served under /services/ and /servicesNS/<owner>/<app>/:
+
+    storage/collections/data/<collection>[/batch_save|/<key>]   JSON, query/insert/update/batch_save/delete
+    storage/collections/config[/<collection>]                   Atom, list/create/update/delete
+    properties[/<conf>], configs/conf-<conf>[/<stanza>]         Atom, conf files in BenchService.confs
+    data/inputs/<kind>[/<name>]                                 Atom, BenchService.inputs
+    saved/searches[/<name>[/enable|disable]]                    Atom
+    server/info
+
+KV store requests are delayed and limited as BenchService does in process: queries return at most
+max_rows_per_query documents and a batch_save above max_documents_per_batch_save is rejected with
+HTTP 400, as splunkd does.  Every other request is counted and delayed like one KV store request.
+Requests without an Authorization header are rejected with HTTP 401.
+
+    with SplunkdStandIn(BenchService(latency_ms=2)) as server:
+        service = server.connect()
+        service.kvstore["hosts_collection"].data.query(limit=10)
+"""
+import collections.abc
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape, quoteattr
+
+import splunklib.client
+
+from tests import APP_NAME
+from tests.benchmarks.kvstore import BenchService, KVStoreLimitError
+
+SPLUNK_VERSION = "9.1.0"
+
+
+class NotFound(Exception):
+    """the requested entity does not exist, answered with HTTP 404"""
+
+
+def format_value(value):
+    """@returns string, value as the content of an Atom <s:key>"""
+    if isinstance(value, dict):
+        return "<s:dict>{}</s:dict>".format(
+            "".join(
+                "<s:key name={}>{}</s:key>".format(quoteattr(str(k)), format_value(v))
+                for k, v in value.items()
+            )
+        )
+    if isinstance(value, (list, tuple)):
+        return "<s:list>{}</s:list>".format(
+            "".join("<s:item>{}</s:item>".format(format_value(i)) for i in value)
+        )
+    if value is None:
+        return ""
+    return escape(str(value))
+
+
+def format_entry(base_path, name, content, owner, app):
+    """@param base_path:    string, path of the collection the entry belongs to, ie /servicesNS/nobody/app/saved/searches
+    @returns                string, Atom <entry>"""
+    content = dict(content)
+    content["eai:acl"] = {"app": app, "owner": owner, "sharing": "app"}
+    return (
+        '<entry><title>{}</title><id>{}</id><link href={} rel="alternate"/>'
+        '<content type="text/xml">{}</content></entry>'
+    ).format(
+        escape(name),
+        escape(base_path),
+        quoteattr("{}/{}".format(base_path, urllib.parse.quote(name, safe=""))),
+        format_value(content),
+    )
+
+
+def format_feed(base_path, entities, owner, app):
+    """@param entities: list of (name, content dict)
+    @returns            bytes, Atom <feed>"""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:s="http://dev.splunk.com/ns/rest" '
+        'xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">'
+        "<title>{}</title><opensearch:totalResults>{}</opensearch:totalResults>{}</feed>"
+    ).format(
+        escape(base_path),
+        len(entities),
+        "".join(format_entry(base_path, n, c, owner, app) for n, c in entities),
+    ).encode("utf-8")
+
+
+def format_error(message):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><response><messages>'
+        '<msg type="ERROR">{}</msg></messages></response>'.format(escape(message))
+    ).encode("utf-8")
+
+
+def get_page(entities, params):
+    """apply the name, count and offset parameters of a collection GET to a list of (name, content)"""
+    if params.get("name"):
+        entities = [i for i in entities if i[0] == params["name"]]
+    offset = int(params.get("offset") or 0)
+    count = int(params.get("count") or 0)
+    return entities[offset : offset + count] if count > 0 else entities[offset:]
+
+
+class CollectionContents(collections.abc.MutableMapping):
+    """KVStoreCollections as name => content, so collections are created, updated and deleted as
+    the other entities are"""
+
+    def __init__(self, kvstore):
+        self.kvstore = kvstore
+
+    def __getitem__(self, name):
+        return self.kvstore[name].content
+
+    def __setitem__(self, name, content):
+        self.kvstore.create(name, **content)
+
+    def __delitem__(self, name):
+        del self.kvstore[name]
+
+    def __iter__(self):
+        return iter(self.kvstore)
+
+    def __len__(self):
+        return len(self.kvstore)
+
+
+class SplunkdRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as splunkd
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def send(self, status, body, content_type="text/xml; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        # like splunkd, answer "Connection: Close" to a client which asked for it: splunklib's default
+        # handler only reads the body of a response which says so
+        self.send_header("Connection", "close" if self.close_connection else "keep-alive")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, value):
+        self.send(status, json.dumps(value).encode("utf-8"), "application/json; charset=utf-8")
+
+    def dispatch(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        segments = [urllib.parse.unquote(i) for i in url.path.split("/")[1:]]
+        if segments and segments[-1] == "":
+            segments.pop()
+        owner, app = "nobody", self.server.app
+        if segments[:1] == ["servicesNS"] and len(segments) >= 3:
+            owner, app, segments = segments[1], segments[2], segments[3:]
+        elif segments[:1] == ["services"]:
+            segments = segments[1:]
+        else:
+            self.send(404, format_error("unknown path {}".format(url.path)))
+            return
+
+        params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        if method == "POST" and "json" not in (self.headers.get("Content-Type") or ""):
+            params.update(
+                urllib.parse.parse_qsl(body.decode("utf-8"), keep_blank_values=True)
+            )
+        if not self.headers.get("Authorization"):
+            self.send(401, format_error("call not properly authenticated"))
+            return
+
+        self.owner, self.app = owner, app
+        self.base_path = "/servicesNS/{}/{}".format(owner, app)
+        try:
+            if segments[:3] == ["storage", "collections", "data"] and len(segments) > 3:
+                self.handle_kvstore_data(method, segments[3], segments[4:], params, body)
+            else:
+                self.server.service.request("/".join(segments[:2]), method.lower(), 1, len(body))
+                self.handle_entities(method, segments, params)
+        except NotFound as error:
+            self.send(404, format_error("Could not find object id={}".format(error)))
+        except KVStoreLimitError as error:
+            self.send_json(400, {"messages": [{"type": "ERROR", "text": str(error)}]})
+        except (KeyError, ValueError) as error:
+            # a required argument is missing or a body is not valid JSON
+            self.send(400, format_error("bad request: {}".format(error)))
+
+    def handle_kvstore_data(self, method, name, rest, params, body):
+        """storage/collections/data/<name>[/batch_save|/<key>]"""
+        collection = self.server.service.kvstore.get(name)
+        if collection is None:
+            raise NotFound(name)
+        data = collection.data
+        if rest == ["batch_save"] and method == "POST":
+            self.send_json(200, data.batch_save(*json.loads(body)))
+        elif rest and method == "GET":
+            documents = data.query(query={"_key": rest[0]})
+            if not documents:
+                raise NotFound(rest[0])
+            self.send_json(200, documents[0])
+        elif rest and method == "POST":
+            self.send_json(200, data.update(rest[0], body.decode("utf-8")))
+        elif rest and method == "DELETE":
+            data.delete(query={"_key": rest[0]})
+            self.send(200, b"", "application/json")
+        elif method == "GET":
+            self.send_json(200, data.query(**params))
+        elif method == "POST":
+            self.send_json(201, data.insert(body.decode("utf-8")))
+        elif method == "DELETE":
+            data.delete(params.get("query"))
+            self.send(200, b"", "application/json")
+        else:
+            raise NotFound("/".join([name] + rest))
+
+    def handle_entities(self, method, segments, params):
+        """the Atom endpoints: each is a dict of name => content dict, see get_entities()"""
+        if segments == ["server", "info"]:
+            self.send_feed("server", [("server-info", {"version": SPLUNK_VERSION})])
+            return
+        if segments == ["properties"] and method == "POST":
+            # Configurations.create()
+            name = params["__conf"]
+            with self.server.lock:
+                exists = name in self.server.service.confs
+                self.server.service.confs.setdefault(name, {})
+            self.send(303 if exists else 201, b"")
+            return
+        if segments[:1] == ["properties"] and len(segments) == 2:
+            # Configurations[name] only checks that the conf file exists
+            if segments[1] not in self.server.service.confs:
+                raise NotFound(segments[1])
+            self.send_feed("properties/" + segments[1], [])
+            return
+
+        path, entities, name, action = self.get_entities(segments)
+        if name is None and method == "GET":
+            with self.server.lock:
+                page = get_page(sorted(entities.items()), params)
+            self.send_feed(path, page)
+        elif name is None and method == "POST":
+            name = params.pop("name")
+            with self.server.lock:
+                entities[name] = params
+                self.send_feed(path, [(name, dict(params))], 201)
+        elif name not in entities:
+            raise NotFound(name)
+        elif method == "GET":
+            with self.server.lock:
+                self.send_feed(path, [(name, dict(entities[name]))])
+        elif method == "POST":
+            if action in ["enable", "disable"]:
+                params = {"disabled": "1" if action == "disable" else "0"}
+            with self.server.lock:
+                entities[name].update(params)
+                self.send_feed(path, [(name, dict(entities[name]))])
+        elif method == "DELETE":
+            with self.server.lock:
+                del entities[name]
+                self.send_feed(path, sorted(entities.items()))
+
+    def get_entities(self, segments):
+        """@returns (path, dict of name => content, entity name or None, action or None)"""
+        service = self.server.service
+        if segments[:3] == ["storage", "collections", "config"] and len(segments) <= 4:
+            path, entities = "storage/collections/config", CollectionContents(service.kvstore)
+            segments = segments[3:]
+        elif segments[:1] == ["configs"] and len(segments) in [2, 3]:
+            conf = segments[1].split("conf-", 1)[-1]
+            if conf not in service.confs:
+                raise NotFound(conf)
+            path, entities = "configs/" + segments[1], service.confs[conf]
+            segments = segments[2:]
+        elif segments[:2] == ["data", "inputs"] and len(segments) in [3, 4]:
+            path = "data/inputs/" + segments[2]
+            entities = {k: v.content for k, v in service.inputs.items.items()}
+            segments = segments[3:]
+        elif segments[:2] == ["saved", "searches"] and len(segments) <= 4:
+            path, entities = "saved/searches", self.server.saved_searches
+            segments = segments[2:]
+        else:
+            raise NotFound("/".join(segments))
+        segments += [None, None]
+        return path, entities, segments[0], segments[1]
+
+    def send_feed(self, path, entities, status=200):
+        base_path = "{}/{}".format(self.base_path, path)
+        self.send(status, format_feed(base_path, entities, self.owner, self.app))
+
+
+class SplunkdStandIn(ThreadingHTTPServer):
+    """HTTP server answering splunklib's REST calls from service, in a background thread once started.
+
+    @param service: BenchService, holds the collections, conf files and inputs served
+    @param host:    string, address to listen on
+    @param port:    int, 0 for any free port
+    @param app:     string, app of the namespace when a request has none
+    """
+
+    daemon_threads = True
+
+    def __init__(self, service=None, host="127.0.0.1", port=0, app=APP_NAME):
+        self.service = service or BenchService()
+        self.app = app
+        self.saved_searches = {}  # name => content
+        self.lock = threading.Lock()
+        self.thread = None
+        super().__init__((host, port), SplunkdRequestHandler)
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def get_access_info(self, session_key=None):
+        """(scheme, host, port), see solnlib.splunkenv.get_splunkd_access_info()"""
+        return "http", self.host, self.port
+
+    def connect(self, token="standin", **kwargs):
+        """@returns splunklib.client.Service connected to this server"""
+        return splunklib.client.connect(
+            scheme="http", host=self.host, port=self.port, token=token, **kwargs
+        )
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Synthetic inventories for the offline benchmarks: alert action results files and KV store
+snapshots in the shapes the Oversight scripts read and write.
+
+An inventory is a list of assets.  Each asset has one or more addresses (multi-homed assets have
+2-4), an asset group, the sources which reported it and when it was last inventoried.  The
+aggregated collection holds one record per address, each listing all of the asset's addresses
+in the multi-value key field, as update_inventory writes them.
+"""
+import csv
+import gzip
+import random
+from datetime import timedelta
+
+from oversight_utils import DEFAULT_TIME_FORMAT, datetime_to_epoch
+
+ID_FIELD = "ip"
+MV_ID_FIELD = "ip_addresses"
+LAST_INVENTORIED_FIELD = "last_inventoried"
+FIRST_INVENTORIED_FIELD = "first_inventoried"
+AGGREGATION_FIELDS = ["os", "mac"]
+OPERATING_SYSTEMS = ["windows 10", "windows 2019", "rhel 8", "ubuntu 22.04", "macos 14"]
+
+
+def make_ip(index):
+    return "10.{}.{}.{}".format((index >> 16) & 255, (index >> 8) & 255, index & 255)
+
+
+def make_mac(index):
+    return ":".join("{:02x}".format((index >> shift) & 255) for shift in range(40, -8, -8))
+
+
+def get_source_names(source_count):
+    return ["source_{}".format(i) for i in range(source_count)]
+
+
+def make_assets(
+    host_count,
+    asset_groups,
+    now,
+    multi_homed_ratio=0.1,
+    source_count=3,
+    expired_fraction=0.05,
+    seed=0,
+):
+    """@param host_count:         int, number of assets
+    @param asset_groups:        dict, asset group name => max age in days
+    @param now:                 datetime
+    @param multi_homed_ratio:   float, fraction of assets with 2-4 addresses
+    @param source_count:        int, number of sources; every asset is reported by at least one
+    @param expired_fraction:    float, fraction of assets last inventoried longer ago than their
+                                  asset group's max age
+    @param seed:                int
+    @returns                    list of dicts with addresses, asset_group, sources, os, mac,
+                                  first_inventoried, last_inventoried and stale (due to expire)
+    """
+    rand = random.Random(seed)
+    sources = get_source_names(source_count)
+    group_names = list(asset_groups)
+    assets = []
+    address = 0
+    for index in range(host_count):
+        address_count = rand.randint(2, 4) if rand.random() < multi_homed_ratio else 1
+        asset_group = rand.choice(group_names)
+        max_age = int(asset_groups[asset_group])
+        stale = rand.random() < expired_fraction
+        if stale:
+            age = timedelta(days=max_age + rand.randint(2, 30), hours=rand.randint(0, 23))
+        else:
+            age = timedelta(hours=rand.randint(0, max(max_age * 24 - 1, 0)))
+        last_inventoried = now - age
+        assets.append(
+            {
+                "addresses": [make_ip(i) for i in range(address, address + address_count)],
+                "asset_group": asset_group,
+                "sources": [s for s in sources if rand.random() < 0.5] or [rand.choice(sources)],
+                "os": rand.choice(OPERATING_SYSTEMS),
+                "mac": make_mac(index),
+                "first_inventoried": last_inventoried - timedelta(days=rand.randint(0, 365)),
+                "last_inventoried": last_inventoried,
+                "stale": stale,
+            }
+        )
+        address += address_count
+    return assets
+
+
+def make_aggregated_records(assets, time_format=DEFAULT_TIME_FORMAT):
+    """the aggregated collection (hosts_collection) snapshot: one record per address"""
+    records = []
+    for asset in assets:
+        last_inventoried = asset["last_inventoried"].strftime(time_format)
+        for ip in asset["addresses"]:
+            record = {
+                "_key": ip,
+                ID_FIELD: ip,
+                MV_ID_FIELD: list(asset["addresses"]),
+                FIRST_INVENTORIED_FIELD: asset["first_inventoried"].strftime(time_format),
+                LAST_INVENTORIED_FIELD: last_inventoried,
+                LAST_INVENTORIED_FIELD + "_epoch": datetime_to_epoch(asset["last_inventoried"]),
+                "expired": "false",
+                "asset_group": asset["asset_group"],
+                "os": asset["os"],
+                "mac": asset["mac"],
+            }
+            for source in asset["sources"]:
+                record["{}_{}".format(source, LAST_INVENTORIED_FIELD)] = last_inventoried
+            records.append(record)
+    return records
+
+
+def make_source_records(assets, source, time_format=DEFAULT_TIME_FORMAT):
+    """the snapshot of a source's own collection (<source>_collection): one record per address"""
+    return [
+        {
+            "_key": ip,
+            ID_FIELD: ip,
+            MV_ID_FIELD: list(asset["addresses"]),
+            LAST_INVENTORIED_FIELD: asset["last_inventoried"].strftime(time_format),
+            "expired": "false",
+            "os": asset["os"],
+            "mac": asset["mac"],
+        }
+        for asset in assets
+        if source in asset["sources"]
+        for ip in asset["addresses"]
+    ]
+
+
+def format_mv(values):
+    """@returns (value, __mv_ value) as splunk writes a multi-value field to a results file"""
+    if len(values) == 1:
+        return values[0], ""
+    return "\n".join(values), ";".join("${}$".format(i) for i in values)
+
+
+def write_results_file(path, assets, source, now, time_format=DEFAULT_TIME_FORMAT, seed=0):
+    """write the gzipped csv results of the source's update_inventory alert action: a row per address
+    of every asset the source still reports (not stale), last inventoried within the past day
+
+    @returns    int, number of rows written
+    """
+    rand = random.Random(seed)
+    columns = ["_key", ID_FIELD, LAST_INVENTORIED_FIELD, "expired", MV_ID_FIELD, "__mv_" + MV_ID_FIELD]
+    for field in AGGREGATION_FIELDS:
+        columns.extend([field, "__mv_" + field])
+    row_count = 0
+    with gzip.open(path, "wt", newline="") as results_file:
+        writer = csv.writer(results_file)
+        writer.writerow(columns)
+        for asset in assets:
+            if asset["stale"] or source not in asset["sources"]:
+                continue
+            last_inventoried = (now - timedelta(minutes=rand.randint(0, 24 * 60))).strftime(
+                time_format
+            )
+            addresses, mv_addresses = format_mv(asset["addresses"])
+            for ip in asset["addresses"]:
+                writer.writerow(
+                    [ip, ip, last_inventoried, "false", addresses, mv_addresses]
+                    + [asset["os"], "", asset["mac"], ""]
+                )
+                row_count += 1
+    return row_count
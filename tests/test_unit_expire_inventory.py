@@ -200,6 +200,184 @@ def test_expire_inventory_is_expired(
     assert result == expected_output
 
 
+fixed_now = datetime(2020, 10, 10, 12, 0)
+test_data = [
+    ("2020-10-02 12:00", "default_7", True),  # exactly 8 days
+    ("2020-10-02 12:01", "default_7", False),  # 7 days 23:59
+    ("2020-10-03 12:00", "default_7", False),  # exactly 7 days
+    ("2020-04-12 12:00", "not_default", True),  # default max age of 180
+    ("2020-04-13 12:00", "not_default", False),
+    ("2020-10-11 12:00", "default_7", False),  # future last_seen
+]
+
+
+@pytest.mark.parametrize("last_seen, asset_group, expected_output", test_data)
+def test_is_expired_at_fixed_now(last_seen, asset_group, expected_output, test_obj):
+    row = {"last_seen": last_seen, "_key": "1", "asset_group": asset_group, "ip": "1"}
+    assert test_obj.is_expired(row, set(), now=fixed_now) == expected_output
+
+    # the epoch field is compared when present, without parsing last_seen
+    row["last_seen_epoch"] = oversight_utils.datetime_to_epoch(
+        datetime.strptime(last_seen, "%Y-%m-%d %H:%M")
+    )
+    row["last_seen"] = "not parsed"
+    assert test_obj.is_expired(row, set(), now=fixed_now) == expected_output
+    expired, active = test_obj.categorize_host_records([row], [], now=fixed_now)
+    assert bool(expired) == expected_output
+
+
+def test_categorize_host_records(test_obj):
+    rows = [
+        {
+            "last_seen": last_seen,
+            "_key": str(i),
+            "asset_group": asset_group,
+            "ip": str(i),
+        }
+        for i, (last_seen, asset_group) in enumerate(
+            [
+                (bad_timestamp, "default_7"),
+                (good_timestamp, "default_7"),
+                (good_timestamp2, "default_7"),
+                (good_timestamp3, None),
+                (bad_timestamp, None),
+                (good_timestamp, "default_7"),
+            ]
+        )
+    ]
+    pre_expired = ["5", "not_a_record"]
+
+    expired, active = test_obj.categorize_host_records(iter(rows), pre_expired)
+
+    assert sorted(expired) == ["0", "5"]
+    assert sorted(active) == ["1", "2", "3", "4"]
+    assert expired["0"] is rows[0]
+    for row in rows:
+        assert test_obj.is_expired(row, pre_expired) == (row["_key"] in expired)
+
+
+test_data = [
+    ({}, datetime(2020, 4, 12, 12, 0)),  # only the 180 day default
+    (
+        {"asset_group_1_name": "default_7", "asset_group_1_max_age": "7"},
+        datetime(2020, 10, 2, 12, 0),
+    ),
+    (
+        {"asset_group_1_name": "default_7", "asset_group_2_name": ""},
+        datetime(2020, 10, 2, 12, 0),
+    ),
+]
+
+
+@pytest.mark.parametrize("asset_groups, expected_cutoff", test_data)
+def test_get_candidate_cutoff(asset_groups, expected_cutoff, test_obj):
+    test_obj.app_settings["asset_groups"] = asset_groups
+    assert test_obj.get_candidate_cutoff(fixed_now) == expected_cutoff
+
+
+def make_aggregated_record(key, last_seen, expired="false", epoch=True, **kwargs):
+    record = {
+        "_key": key,
+        "ip": key,
+        "asset_group": "default_7",
+        "last_seen": last_seen,
+        "expired": expired,
+    }
+    if epoch:
+        record["last_seen_epoch"] = oversight_utils.datetime_to_epoch(
+            datetime.strptime(last_seen, "%Y-%m-%d %H:%M")
+        )
+    record.update(kwargs)
+    return record
+
+
+test_data = [
+    # expiration expression matches, expected candidate keys
+    ([], ["old", "old_no_epoch", "recent_no_epoch"]),
+    (["recent", "old", "missing"], ["old", "old_no_epoch", "recent", "recent_no_epoch"]),
+    (["already_expired"], ["old", "old_no_epoch", "recent_no_epoch"]),
+]
+
+
+@pytest.mark.parametrize("matched, expected_keys", test_data)
+def test_iter_expiry_candidates(matched, expected_keys, test_obj):
+    test_obj.app_settings["asset_groups"] = {"asset_group_1_name": "default_7"}
+    test_obj.service.load_mock_collection(
+        "hosts_collection",
+        [
+            make_aggregated_record("old", "2020-10-02 12:00"),
+            make_aggregated_record("recent", "2020-10-02 12:01"),
+            make_aggregated_record("old_no_epoch", "2020-01-01 00:00", epoch=False),
+            make_aggregated_record("recent_no_epoch", "2020-10-10 00:00", epoch=False),
+            make_aggregated_record("already_expired", "2020-01-01 00:00", expired="x"),
+        ],
+    )
+
+    # method under test
+    result = list(test_obj.iter_expiry_candidates(matched, fixed_now))
+
+    assert sorted(i["_key"] for i in result) == expected_keys
+
+
+def test_load_mvkey_linked_records(test_obj):
+    test_obj.service.load_mock_collection(
+        "hosts_collection",
+        [
+            make_aggregated_record("1", good_timestamp, ip_addresses=["1", "2"]),
+            make_aggregated_record("3", good_timestamp, ip_addresses=["3", "4"]),
+            make_aggregated_record("4", good_timestamp, expired="x"),
+            make_aggregated_record("5", good_timestamp, ip_addresses=["2", "5"]),
+        ],
+    )
+    expired = {
+        "2": make_aggregated_record("2", bad_timestamp, ip_addresses=["1", "2", "5"]),
+        "6": make_aggregated_record("6", bad_timestamp, ip_addresses=["3", "4", "6"]),
+    }
+    active = {"3": make_aggregated_record("3", good_timestamp)}
+
+    # method under test
+    added = test_obj.load_mvkey_linked_records(expired, active)
+
+    # 3 is already active, 4 is already expired
+    assert added == 2
+    assert sorted(active) == ["1", "3", "5"]
+
+
+test_data = [
+    # expiration expression, max keys in memory, expected matches, expected spilled
+    (None, 100000, [], False),
+    ("search ip=10.*", 100000, ["10.0.0.1", "10.0.0.2"], False),
+    ("search ip=10.*", 1, ["10.0.0.1", "10.0.0.2"], True),
+]
+
+
+@pytest.mark.parametrize(
+    "expression, max_keys, expected_matches, expected_spilled", test_data
+)
+def test_get_expiration_expression_results(
+    expression, max_keys, expected_matches, expected_spilled, test_obj, mocker
+):
+    test_obj.EXPIRATION_EXPRESSION = expression
+    test_obj.EXPIRATION_MATCH_MAX_KEYS = max_keys
+    test_obj.service.jobs = mocker.Mock()
+    test_obj.service.jobs.export.return_value = [
+        b'{"preview":false,"offset":0,"result":{"ip":"10.0.0.1"}}',
+        b"",
+        b'{"preview":false,"offset":1,"result":{"ip":"10.0.0.2"}}',
+        b'{"preview":false,"offset":2,"result":{"ip":"10.0.0.1"}}',
+        b'{"preview":false,"offset":3,"lastrow":true,"result":{"ip":"10.0.0.2"}}',
+        b'{"preview":false,"offset":4,"result":{"ip":"10.0.0.3"}}',
+    ]
+
+    # method under test
+    matches = test_obj.get_expiration_expression_results()
+
+    assert sorted(matches) == expected_matches
+    assert matches.spilled == expected_spilled
+    assert "10.0.0.3" not in matches
+    matches.close()
+
+
 test_data = [
     (
         {
@@ -236,6 +414,16 @@ test_data = [
         },
         True,
     ),
+    (  # epoch field is used instead of the formatted string
+        {
+            "last_seen": "01/10/2020",
+            "last_seen_epoch": 1601514600,
+            "asset_group": "default_7",
+            "_key": "1.1.1.1",
+            "ip": "1.1.1.1",
+        },
+        True,
+    ),
     ({}, False),  # test row null
 ]
 
@@ -0,0 +1,106 @@
+## -*- coding: utf-8 -*-
+## Tests for the modular input 'oversight' external rest handler
+import glob
+import logging
+import os
+import sys
+import types
+from unittest.mock import MagicMock
+
+import pytest
+
+import tests
+
+bindir = glob.glob("**/bin", recursive=True)
+# hack for making sure we load the ucc-gen build dir
+bindir = [i for i in bindir if "output" in i][0]
+sys.path.insert(0, bindir)
+
+TEST_DIR = tests.TEST_DIR
+APP_NAME = tests.APP_NAME
+
+APP_DIR = os.path.join(TEST_DIR, APP_NAME)
+BIN_DIR = os.path.join(TEST_DIR, APP_NAME, "bin")
+
+sys.path.insert(0, BIN_DIR)
+
+# splunktaucclib is packaged into the app lib by ucc-gen
+pytest.importorskip("splunktaucclib")
+
+import input_module_handler as lib
+from oversight_utils import get_settings_cache_path
+
+
+class CachingHandler:
+    """rest handler stand in, where an update_inventory run re-caches the input settings while
+    the stanza is being written"""
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.calls = []
+
+    def write(self, method, name):
+        self.calls.append((method, name))
+        with open(self.cache_path, "w") as cache_file:
+            cache_file.write('{"inputs": {}}')
+        return []
+
+    def update(self, name, data):
+        return self.write("update", name)
+
+    def disable(self, name):
+        return self.write("disable", name)
+
+    def enable(self, name):
+        return self.write("enable", name)
+
+    def delete(self, name):
+        return self.write("delete", name)
+
+
+@pytest.fixture(scope="function")
+@pytest.mark.no_cover
+def test_obj(fs):
+    fs.create_dir("/opt/splunk/var/run/" + APP_NAME)
+    # __init__ connects to splunkd, set what it would
+    test_obj = object.__new__(lib.OversightInputExternalHandler)
+    test_obj.service = MagicMock()
+    test_obj.logger = logging.getLogger("test")
+    test_obj.run_id = "1"
+    test_obj.settings_cache_path = get_settings_cache_path(
+        "/opt/splunk", APP_NAME
+    )
+    test_obj.handler = CachingHandler(test_obj.settings_cache_path)
+    test_obj.callerArgs = types.SimpleNamespace(id="test")
+    test_obj.getSessionKey = lambda: "token"
+    test_obj._get_name = lambda: "oversight"
+    test_obj.edit_hook = MagicMock()
+    test_obj.delete_hook = MagicMock()
+    return test_obj
+
+
+test_data = [
+    ({"id_field": "mac"}, "update"),
+    ({"disabled": "1"}, "disable"),
+    ({"disabled": "0"}, "enable"),
+]
+
+
+@pytest.mark.parametrize("payload,expected", test_data)
+def test_handle_edit(test_obj, payload, expected):
+    test_obj.payload = payload
+
+    # method under test
+    test_obj.handleEdit(MagicMock())
+
+    assert test_obj.handler.calls == [(expected, "test")]
+    assert not os.path.exists(test_obj.settings_cache_path)
+
+
+def test_handle_remove(test_obj):
+    # method under test
+    test_obj.handleRemove(MagicMock())
+
+    assert test_obj.handler.calls == [("delete", "test")]
+    assert test_obj.delete_hook.called
+    assert not os.path.exists(test_obj.settings_cache_path)
@@ -97,7 +97,18 @@ test_data = [
             "name": "source1",
             "aggregation_fields": ["cpu", "os"],
         },
-        ["ip", "ips", "last_seen", "first_seen", "cpu", "os", "source1_last_seen"],
+        [
+            "ip",
+            "ips",
+            "last_seen",
+            "last_seen_epoch",
+            "first_seen",
+            "first_seen_epoch",
+            "cpu",
+            "os",
+            "source1_last_seen",
+            "source1_last_seen_epoch",
+        ],
     )
 ]
 
@@ -586,8 +597,8 @@ test_data = [
 
 
 @pytest.mark.parametrize("app_settings, expected_output", test_data)
-def test_normalize_global_settings(app_settings, expected_output, test_obj):
-    output = test_obj.normalize_global_settings(app_settings)
+def test_flatten_app_settings(app_settings, expected_output, test_obj):
+    output = test_obj.flatten_app_settings(app_settings)
     assert output == expected_output
 
 
@@ -784,3 +795,272 @@ test_data = [
 def test_normalize_source_expression(definition, expected_output, test_obj):
     output = test_obj.normalize_source_expression(definition)
     assert output == expected_output
+
+
+test_data = [
+    (  # source collection, id_field
+        False,
+        {"name": "test", "id_field": "ip"},
+        {"expired": "string", "ip": "string", "last_seen": "string"},
+        ["expired", "ip", "last_seen"],
+    ),
+    (  # source collection, renamed id_field
+        False,
+        {"name": "test", "id_field": "dest_ip", "id_field_rename": "ip"},
+        {"expired": "string", "ip": "string", "last_seen": "string"},
+        ["expired", "ip", "last_seen"],
+    ),
+    (  # aggregated collection
+        True,
+        {"name": "test"},
+        {
+            "expired": "string",
+            "asset_group": "string",
+            "ip": "string",
+            "last_seen_epoch": "number",
+            "first_seen_epoch": "number",
+        },
+        ["expiry_candidates", "asset_group", "ip"],
+    ),
+    (  # aggregated collection, inventory source
+        True,
+        {"name": "test", "inventory_source": "1"},
+        {
+            "expired": "string",
+            "asset_group": "string",
+            "ip": "string",
+            "last_seen_epoch": "number",
+            "first_seen_epoch": "number",
+            "test_last_seen_epoch": "number",
+        },
+        ["expiry_candidates", "asset_group", "ip", "test_last_seen_epoch"],
+    ),
+]
+
+
+@pytest.mark.parametrize(
+    "aggregated, params, expected_fields, expected_accelerations", test_data
+)
+def test_get_collection_schema(
+    test_obj, aggregated, params, expected_fields, expected_accelerations
+):
+    test_obj.params = params
+    fields, accelerated_fields = test_obj.get_collection_schema(aggregated)
+    assert fields == expected_fields
+    assert sorted(accelerated_fields) == sorted(expected_accelerations)
+    # every accelerated field is typed
+    for definition in accelerated_fields.values():
+        assert set(definition) <= set(fields)
+    if aggregated:
+        assert accelerated_fields["expiry_candidates"] == {
+            "expired": 1,
+            "last_seen_epoch": 1,
+        }
+
+
+def make_reconcile_service(test_obj):
+    test_obj.service = mock_splunk_service(test_obj.APP_NAME)
+    test_obj.service.confs["transforms"] = tests.mock_conf_file(
+        {
+            "hosts_lookup": {"fields_list": "_key, ip", "filter": "expired=false"},
+            "hosts_lookup_all": {"fields_list": "_key, ip"},
+        }
+    )
+    test_obj.service.confs["macros"] = tests.mock_conf_file(
+        {
+            "eval_last_seen": {
+                "definition": 'eval last_seen = strftime(_time, "%Y-%m-%d %H:%M")'
+            },
+            "eval_last_inventoried": {
+                "definition": 'eval last_seen = strftime(_time, "%Y-%m-%d %H:%M")'
+            },
+            "inventory_time_format": {"definition": '"%Y-%m-%d %H:%M"'},
+        }
+    )
+    test_obj.service.saved_searches = tests.mock_conf_file()
+    return test_obj.service
+
+
+def make_input_params(name, **kwargs):
+    params = {
+        "name": name,
+        "source_expression": "index=main",
+        "id_field": "ip",
+        "id_field_rename": None,
+        "mv_id_field": None,
+        "source_fields": ["os"],
+        "enrichment_expression": None,
+        "enrichment_fields": None,
+        "source_filter": None,
+        "inventory_filter": None,
+        "inventory_source": True,
+        "aggregation_fields": None,
+        "replicate": None,
+        "cron": "0 1 * * *",
+    }
+    params.update(kwargs)
+    return params
+
+
+def build_desired_state(test_obj, current, *inputs):
+    desired = {}
+    for params in inputs:
+        test_obj.params = params
+        test_obj.name = params["name"]
+        test_obj.build_desired_state(current, desired)
+    return desired
+
+
+def test_load_knowledge_objects(test_obj):
+    service = make_reconcile_service(test_obj)
+    service.kvstore.create("hosts_lookup")
+    current = test_obj.load_knowledge_objects()
+    assert sorted(current) == sorted(test_obj.RECONCILED_CONF_TYPES)
+    assert sorted(current["transforms"]) == ["hosts_lookup", "hosts_lookup_all"]
+    assert list(current["collections"]) == ["hosts_lookup"]
+    assert current["savedsearches"] == {}
+
+
+def test_reconcile(test_obj):
+    service = make_reconcile_service(test_obj)
+    inputs = [
+        make_input_params("one", aggregation_fields=["os"]),
+        make_input_params("two", inventory_source=False, replicate=True),
+    ]
+    current = test_obj.load_knowledge_objects()
+    desired = build_desired_state(test_obj, current, *inputs)
+    plan = test_obj.plan_reconciliation(current, desired)
+
+    # new objects are created; existing macro is unchanged
+    created = sorted(
+        (i["conf_type"], i["name"]) for i in plan if i["action"] == "create"
+    )
+    assert created == [
+        ("collections", "hosts_lookup"),
+        ("collections", "hosts_lookup_mvkey_index"),
+        ("collections", "one_collection"),
+        ("collections", "two_collection"),
+        ("macros", "one_fields"),
+        ("macros", "one_source"),
+        ("macros", "two_fields"),
+        ("macros", "two_source"),
+        ("savedsearches", "one_hosts"),
+        ("savedsearches", "two_data"),
+        ("transforms", "one_lookup"),
+        ("transforms", "one_lookup_all"),
+        ("transforms", "two_lookup"),
+    ]
+    updated = {i["name"]: i["args"] for i in plan if i["action"] == "update"}
+    assert sorted(updated) == ["hosts_lookup", "hosts_lookup_all"]
+    assert updated["hosts_lookup"] == updated["hosts_lookup_all"]
+    fields_list = updated["hosts_lookup"]["fields_list"]
+    assert fields_list.startswith("_key, ip, ")
+    assert "one_last_seen_epoch" in fields_list and "os" in fields_list
+    assert "two_last_seen" not in fields_list
+    # changes are applied in order, collections before their transforms
+    assert [i["conf_type"] for i in plan] == sorted(
+        [i["conf_type"] for i in plan], key=test_obj.RECONCILED_CONF_TYPES.index
+    )
+    assert test_obj.format_plan(plan)[0].startswith(
+        "action=create type=collections name=hosts_lookup "
+    )
+
+    assert test_obj.apply_plan(current, plan) == 0
+    # inventory_time_format already matches time_format
+    assert test_obj.conf_write_counts == {"applied": len(plan), "skipped": 1}
+    assert service.confs["transforms"]["hosts_lookup"].content["fields_list"] == (
+        fields_list
+    )
+    assert service.confs["transforms"]["hosts_lookup"].content["filter"] == (
+        "expired=false"
+    )
+    assert "filter" not in service.confs["transforms"]["one_lookup_all"].content
+    assert service.confs["transforms"]["one_lookup"].content["filter"] == (
+        "expired=false"
+    )
+    assert service.kvstore["two_collection"].content["replicate"] == "true"
+    savedsearch = service.saved_searches["one_hosts"].content
+    assert savedsearch["search"].startswith("`one_source` | `eval_last_seen` | ")
+    assert savedsearch["enableSched"] == "1"
+    assert savedsearch["action.update_inventory.param.source_name"] == "one"
+    assert "enableSched" not in service.saved_searches["two_data"].content
+
+    # a second run has nothing to write
+    current = test_obj.load_knowledge_objects()
+    desired = build_desired_state(test_obj, current, *inputs)
+    assert test_obj.plan_reconciliation(current, desired) == []
+    assert test_obj.conf_write_counts["skipped"] == 1 + sum(
+        len(i) for i in desired.values()
+    )
+
+    # only the changed settings of an edited input are written
+    inputs[1]["cron"] = "0 2 * * *"
+    inputs[1]["source_fields"] = ["os", "owner"]
+    desired = build_desired_state(test_obj, current, *inputs)
+    plan = test_obj.plan_reconciliation(current, desired)
+    assert [(i["action"], i["name"], sorted(i["args"])) for i in plan] == [
+        ("update", "two_lookup", ["fields_list"]),
+        ("update", "two_fields", ["definition"]),
+        ("update", "two_data", ["cron_schedule"]),
+    ]
+
+
+def test_reconcile_time_format_macro(test_obj):
+    service = make_reconcile_service(test_obj)
+    test_obj.settings = dict(test_obj.settings, time_format="%d/%m/%Y %H:%M:%S")
+    current = test_obj.load_knowledge_objects()
+    desired = build_desired_state(test_obj, current, make_input_params("one"))
+
+    # method under test
+    plan = test_obj.plan_reconciliation(current, desired)
+
+    updated = {i["name"]: i["args"] for i in plan if i["action"] == "update"}
+    assert updated["inventory_time_format"] == {"definition": '"%d/%m/%Y %H:%M:%S"'}
+    assert test_obj.apply_plan(current, plan) == 0
+    assert service.confs["macros"]["inventory_time_format"].content["definition"] == (
+        '"%d/%m/%Y %H:%M:%S"'
+    )
+
+
+def test_reconcile_renamed_aggregation_lookup(test_obj):
+    make_reconcile_service(test_obj)
+    test_obj.settings = dict(test_obj.settings, aggregated_lookup_name="assets_lookup")
+    current = test_obj.load_knowledge_objects()
+    desired = build_desired_state(test_obj, current, make_input_params("one"))
+    lookup = desired["transforms"]["assets_lookup"]
+    lookup_all = desired["transforms"]["assets_lookup_all"]
+    assert lookup["collection"] == "hosts_lookup"
+    assert lookup["filter"] == "expired=false"
+    assert "filter" not in lookup_all
+    assert lookup["fields_list"] == lookup_all["fields_list"]
+    assert lookup["fields_list"].startswith("_key, ip, ")
+
+
+def test_reconcile_last_inventoried_macro(test_obj):
+    make_reconcile_service(test_obj)
+    test_obj.settings = dict(test_obj.settings, time_format="%Y-%m-%dT%H:%M")
+    current = test_obj.load_knowledge_objects()
+    desired = build_desired_state(test_obj, current, make_input_params("one"))
+    plan = test_obj.plan_reconciliation(current, desired)
+    change = [i for i in plan if i["name"] == "eval_last_seen"][0]
+    assert change["action"] == "update"
+    assert change["args"] == {
+        "definition": 'eval last_seen = strftime(_time, "%Y-%m-%dT%H:%M")'
+    }
+
+
+test_data = [
+    ({}, False),
+    ({"reconcile_dry_run": "0"}, False),
+    ({"reconcile_dry_run": "1"}, True),
+    ({"reconcile_dry_run": "true"}, True),
+]
+
+
+@pytest.mark.parametrize("additional_parameters, expected_output", test_data)
+def test_setup_reconcile_dry_run(test_obj, additional_parameters, expected_output):
+    app_settings = {
+        "additional_parameters": dict(test_obj.settings, **additional_parameters)
+    }
+    test_obj.setup(mock_splunk_service(test_obj.APP_NAME), app_settings)
+    assert test_obj.RECONCILE_DRY_RUN == expected_output
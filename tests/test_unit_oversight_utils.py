@@ -1,10 +1,16 @@
 import copy
 import glob
+import gzip
+import http.server
+import io
+import json
 import logging
 import operator
 import os
 import re
 import sys
+import threading
+import time
 import uuid
 from datetime import datetime, timedelta
 from pprint import pprint as pp
@@ -12,6 +18,7 @@ from pprint import pprint as pp
 import pyfakefs
 import pytest
 import pytest_mock
+import splunklib.binding
 
 import tests
 from tests import mock_arg, mock_scheme, mock_splunk_service
@@ -33,10 +40,29 @@ sys.path.insert(0, BIN_DIR)
 print(sys.path)
 
 
-from oversight_utils import OversightScript
+import oversight_utils
+from oversight_utils import (
+    KeySet,
+    MvKeyIndex,
+    OversightScript,
+    PooledHTTPHandler,
+    RunMetrics,
+    copy_record,
+    datetime_to_epoch,
+    dedupe_documents_by_key,
+    diff_conf_args,
+    format_log_payload,
+    get_settings_cache_path,
+    invalidate_settings_cache,
+    log_enter_exit,
+    normalize_conf_value,
+    parse_timestring,
+    record_run_metrics,
+)
 
 from tests import (
     mock_arg,
+    mock_conf_file,
     mock_kvstore,
     mock_kvstore_data,
     mock_scheme,
@@ -93,6 +119,40 @@ def test_convert_timesting_to_epoch(test_obj, timestring, timeformat, expected_o
     assert output == expected_output
 
 
+test_data = [
+    ("2020-01-01 00:00", "%Y-%m-%d %H:%M"),
+    ("1999-12-31 23:59", "%Y-%m-%d %H:%M"),
+    ("2020-02-29 12:05", "%Y-%m-%d %H:%M"),
+    ("2020-1-1 1:5", "%Y-%m-%d %H:%M"),  # valid for strptime, not the fast path
+    ("2020-01-01", "%Y-%m-%d"),
+    ("01/31/2021 10:00", "%m/%d/%Y %H:%M"),
+]
+
+
+@pytest.mark.parametrize("timestring, timeformat", test_data)
+def test_parse_timestring(timestring, timeformat):
+    expected_output = datetime.strptime(timestring, timeformat)
+    assert parse_timestring(timestring, timeformat) == expected_output
+    # memoized result is identical
+    assert parse_timestring(timestring, timeformat) == expected_output
+
+
+test_data = [
+    ("2020-13-01 00:00", "%Y-%m-%d %H:%M"),
+    ("2020-02-30 00:00", "%Y-%m-%d %H:%M"),
+    ("2020-01-01 24:00", "%Y-%m-%d %H:%M"),
+    ("2020-01-01 1 :05", "%Y-%m-%d %H:%M"),
+    ("Tuesday, Jan 1, 2020", "%Y-%m-%d %H:%M"),
+    ("2020-01-01", "%Y-%m-%d %H:%M"),
+]
+
+
+@pytest.mark.parametrize("timestring, timeformat", test_data)
+def test_parse_timestring_invalid(timestring, timeformat):
+    with pytest.raises(ValueError):
+        parse_timestring(timestring, timeformat)
+
+
 test_data = [
     ([{"_key": "bar"}], {"bar": {"_key": "bar"}}),
     (
@@ -126,6 +186,95 @@ def test_populate_local_aggregation_cache(test_obj, kvstore_data, expected_outpu
     test_obj.service.kvstore[col_name].data = mock_kvstore_data()
 
 
+test_data = [
+    # test fewer records than a single page
+    ([{"_key": "1"}, {"_key": "2"}], 5, None, None, [{"_key": "1"}, {"_key": "2"}]),
+    # test records spanning several pages are not truncated
+    (
+        [{"_key": str(i)} for i in range(7)],
+        2,
+        None,
+        None,
+        [{"_key": str(i)} for i in range(7)],
+    ),
+    # test exact multiple of page size
+    (
+        [{"_key": str(i)} for i in range(4)],
+        2,
+        None,
+        None,
+        [{"_key": str(i)} for i in range(4)],
+    ),
+    # test field projection
+    (
+        [{"_key": "1", "expired": "false", "ip": "1.1.1.1"}],
+        2,
+        ["_key", "expired"],
+        None,
+        [{"_key": "1", "expired": "false"}],
+    ),
+    # test server side query filter
+    (
+        [
+            {"_key": "1", "expired": "false"},
+            {"_key": "2", "expired": "2020-01-01 00:00"},
+            {"_key": "3", "expired": "false"},
+        ],
+        1,
+        None,
+        {"expired": "false"},
+        [{"_key": "1", "expired": "false"}, {"_key": "3", "expired": "false"}],
+    ),
+    # test empty collection
+    ([], 2, None, None, []),
+]
+
+
+@pytest.mark.parametrize(
+    "kvstore_data, page_size, fields, query, expected_output", test_data
+)
+def test_iter_kvstore_records(
+    test_obj, kvstore_data, page_size, fields, query, expected_output
+):
+    col_name = test_obj.AGGREGATED_COLLECTION_NAME
+    test_obj.service.load_mock_collection(col_name, kvstore_data)
+    test_obj.kvstore_max_rows = page_size
+
+    # method under test
+    output = test_obj.iter_kvstore_records(col_name, fields=fields, query=query)
+    assert not isinstance(output, list)
+    assert list(output) == expected_output
+    assert test_obj.get_kvstore_records(col_name, fields, query) == expected_output
+
+    ## teardown
+    test_obj.service.kvstore[col_name].data = mock_kvstore_data()
+
+
+def test_iter_kvstore_records_missing_collection(test_obj):
+    with pytest.raises(KeyError):
+        list(test_obj.iter_kvstore_records("missing_collection"))
+
+
+def test_iter_kvstore_records_failed_page(test_obj, mocker):
+    col_name = test_obj.AGGREGATED_COLLECTION_NAME
+    test_obj.service.load_mock_collection(col_name, [])
+    test_obj.kvstore_max_rows = 2
+    mocker.patch.object(
+        test_obj.service.kvstore[col_name].data,
+        "query",
+        side_effect=[[{"_key": "1"}, {"_key": "2"}], make_http_error(503)],
+    )
+
+    # method under test
+    output = test_obj.iter_kvstore_records(col_name)
+
+    # a read failure is not mistaken for the end of the collection
+    assert next(output) == {"_key": "1"}
+    assert next(output) == {"_key": "2"}
+    with pytest.raises(splunklib.binding.HTTPError):
+        next(output)
+
+
 def test_get_cached_record(test_obj):
     cached_key = "1"
     cached_data = {"_key": "1", "status": "ok"}
@@ -141,6 +290,16 @@ def test_get_cached_record(test_obj):
     assert test_obj.get_cached_record("invalid_key") is None
 
 
+def test_copy_record():
+    record = {"_key": "1", "status": "ok", "ips": ["1", "2"], "expired": None}
+    output = copy_record(record)
+    assert output == record
+
+    output["status"] = "invalid"
+    output["ips"].append("3")
+    assert record == {"_key": "1", "status": "ok", "ips": ["1", "2"], "expired": None}
+
+
 def test_update_cached_record(test_obj):
     # test setup
     test_obj.aggregation_cache = {}
@@ -173,6 +332,15 @@ test_data = [
         ["mgmt1_collection"],
     ),
     ({"key": "account:instance:/i-111", "last_seen": "1999-09-09"}, []),
+    (  # epoch fields are not data sources
+        {
+            "key": "1.1.1.1",
+            "last_seen": "1999-09-09",
+            "last_seen_epoch": 936835200,
+            "mgmt1_last_seen": "1999-09-09",
+        },
+        ["mgmt1_collection"],
+    ),
 ]
 
 
@@ -407,3 +575,1223 @@ def test_handle_cached_write(
     ## teardown
     test_obj.service.kvstore[col_name].data = mock_kvstore_data()
     test_obj.write_cache[col_name] = []
+
+
+class str_counter(object):
+    """argument which records how many times it was formatted for logging"""
+
+    count = 0
+
+    def __str__(self):
+        str_counter.count += 1
+        return "str_counter"
+
+    __repr__ = __str__
+
+
+class decorated_script(OversightScript):
+    @log_enter_exit()
+    def echo(self, value):
+        return value
+
+
+@pytest.mark.parametrize("log_level, expect_formatted", [("INFO", False), ("DEBUG", True)])
+def test_log_enter_exit_skips_formatting_unless_debug(fs, log_level, expect_formatted):
+    fs.create_dir("/opt/splunk/var/log/splunk")
+    test_obj = decorated_script()
+    test_obj.logger.setLevel(log_level)
+    str_counter.count = 0
+    argument = str_counter()
+
+    # method under test
+    assert test_obj.echo(argument) is argument
+    assert (str_counter.count > 0) == expect_formatted
+
+
+def test_log_enter_exit_sample_rate(fs):
+    fs.create_dir("/opt/splunk/var/log/splunk")
+    test_obj = decorated_script()
+    test_obj.logger.setLevel("DEBUG")
+    test_obj.LOG_PAYLOAD_SAMPLE_RATE = 5
+    str_counter.count = 0
+
+    for _ in range(10):
+        test_obj.echo(str_counter())
+    # args and return value formatted for calls 1 and 6 only
+    assert str_counter.count == 4
+
+
+test_data = [
+    ("short", 10, "short"),
+    ("0123456789abc", 10, "0123456789...(truncated 3 chars)"),
+    ("0123456789abc", None, "0123456789abc"),
+    (["a"], 0, "['a']"),
+]
+
+
+@pytest.mark.parametrize("value, max_length, expected_output", test_data)
+def test_format_log_payload(value, max_length, expected_output):
+    assert format_log_payload(value, max_length) == expected_output
+
+
+test_data = [
+    # records, batch size, force, expected batch_save calls, expected records left cached
+    ([{"_key": str(i)} for i in range(7)], 3, True, 3, 0),
+    ([{"_key": str(i)} for i in range(7)], 3, False, 2, 1),
+    ([{"_key": str(i)} for i in range(6)], 3, False, 2, 0),
+    ([{"_key": str(i)} for i in range(2)], 3, False, 0, 2),
+    ([{"_key": str(i)} for i in range(2000)], 7, True, 286, 0),
+]
+
+
+@pytest.mark.parametrize(
+    "records, max_records_per_batch, force, expected_writes, expected_cached", test_data
+)
+def test_flush_cached_writes(
+    test_obj, records, max_records_per_batch, force, expected_writes, expected_cached, mocker
+):
+    col_name = test_obj.AGGREGATED_COLLECTION_NAME
+    test_obj.service.load_mock_collection(col_name, [])
+    test_obj.kvstore_max_batch = max_records_per_batch
+    test_obj.write_cache = {col_name: list(records)}
+    batch_save = mocker.patch.object(
+        test_obj.service.kvstore[col_name].data, "batch_save"
+    )
+    sleep = mocker.patch("oversight_utils.time.sleep")
+
+    # method under test
+    written = test_obj.flush_cached_writes(col_name, force=force)
+
+    assert batch_save.call_count == expected_writes
+    assert written == len(records) - expected_cached
+    assert len(test_obj.write_cache[col_name]) == expected_cached
+    assert all(len(i.args) <= max_records_per_batch for i in batch_save.call_args_list)
+    saved = [document for i in batch_save.call_args_list for document in i.args]
+    assert saved + test_obj.write_cache[col_name] == records
+    sleep.assert_not_called()
+    assert test_obj.metrics.counters.get("records_written", 0) == written
+    flushes = test_obj.metrics.phases.get("flush." + col_name, {"count": 0})
+    assert flushes["count"] == (1 if written else 0)
+
+
+def make_http_error(status, headers=None):
+    response = splunklib.binding.record(
+        {
+            "status": status,
+            "reason": "error",
+            "headers": headers or [],
+            "body": io.BytesIO(b""),
+        }
+    )
+    return splunklib.binding.HTTPError(response)
+
+
+test_data = [
+    ([503], [], 1, [0.5]),
+    ([429, 503, 429], [], 1, [0.5, 1.0, 2.0]),
+    ([429], [("Retry-After", "3")], 1, [3.0]),
+]
+
+
+@pytest.mark.parametrize(
+    "statuses, headers, expected_writes, expected_delays", test_data
+)
+def test_write_kvstore_batch_retries_when_busy(
+    test_obj, statuses, headers, expected_writes, expected_delays, mocker
+):
+    col_name = test_obj.AGGREGATED_COLLECTION_NAME
+    test_obj.service.load_mock_collection(col_name, [])
+    test_obj.write_cache = {col_name: []}
+    mock_data = test_obj.service.kvstore[col_name].data
+    batch_save = mocker.patch.object(
+        mock_data,
+        "batch_save",
+        side_effect=[make_http_error(i, headers) for i in statuses] + [None],
+    )
+    sleep = mocker.patch("oversight_utils.time.sleep")
+
+    # method under test
+    test_obj.write_kvstore_batch(col_name, documents=[{"_key": "1"}])
+
+    assert batch_save.call_count == len(statuses) + expected_writes
+    assert [i.args[0] for i in sleep.call_args_list] == expected_delays
+
+
+def test_write_kvstore_batch_raises_on_error(test_obj, mocker):
+    col_name = test_obj.AGGREGATED_COLLECTION_NAME
+    test_obj.service.load_mock_collection(col_name, [])
+    test_obj.write_cache = {col_name: [{"_key": "1"}]}
+    mocker.patch.object(
+        test_obj.service.kvstore[col_name].data,
+        "batch_save",
+        side_effect=make_http_error(400),
+    )
+    sleep = mocker.patch("oversight_utils.time.sleep")
+
+    with pytest.raises(ValueError):
+        test_obj.flush_cached_writes(col_name, force=True)
+    sleep.assert_not_called()
+    # records that were not written remain cached
+    assert test_obj.write_cache[col_name] == [{"_key": "1"}]
+
+
+test_data = [
+    ([], []),
+    ([{"_key": "1", "a": "1"}, {"_key": "2"}], [{"_key": "1", "a": "1"}, {"_key": "2"}]),
+    (
+        [{"_key": "1", "a": "1"}, {"_key": "2"}, {"_key": "1", "a": "2"}],
+        [{"_key": "2"}, {"_key": "1", "a": "2"}],
+    ),
+    (
+        ['{"_key": "1", "a": "1"}', {"a": "new"}, '{"_key": "1", "a": "2"}', {"a": "new"}],
+        [{"a": "new"}, '{"_key": "1", "a": "2"}', {"a": "new"}],
+    ),
+]
+
+
+@pytest.mark.parametrize("documents, expected", test_data)
+def test_dedupe_documents_by_key(documents, expected):
+    assert dedupe_documents_by_key(documents) == expected
+
+
+test_data = [
+    # records, batch size, force, expected records written, expected records left cached
+    ([{"_key": str(i)} for i in range(7)], 3, True, 7, 0),
+    ([{"_key": str(i)} for i in range(7)], 3, False, 6, 1),
+    ([{"_key": str(i % 4)} for i in range(9)], 3, True, 4, 0),
+    ([{"_key": str(i)} for i in range(2000)], 7, True, 2000, 0),
+]
+
+
+@pytest.mark.parametrize(
+    "records, max_records_per_batch, force, expected_written, expected_cached", test_data
+)
+def test_flush_cached_writes_concurrently(
+    test_obj, records, max_records_per_batch, force, expected_written, expected_cached, mocker
+):
+    col_name = test_obj.AGGREGATED_COLLECTION_NAME
+    test_obj.service.load_mock_collection(col_name, [])
+    test_obj.kvstore_max_batch = max_records_per_batch
+    test_obj.KVSTORE_FLUSH_PARALLELISM = 4
+    test_obj.write_cache = {col_name: list(records)}
+    batch_save = mocker.patch.object(
+        test_obj.service.kvstore[col_name].data, "batch_save"
+    )
+
+    # method under test
+    written = test_obj.flush_cached_writes(col_name, force=force)
+
+    assert written == expected_written
+    assert len(test_obj.write_cache[col_name]) == expected_cached
+    assert all(len(i.args) <= max_records_per_batch for i in batch_save.call_args_list)
+    saved = [document for i in batch_save.call_args_list for document in i.args]
+    # each _key is written exactly once, with its last cached value
+    assert len(saved) == expected_written
+    assert sorted(saved, key=lambda i: i["_key"]) == sorted(
+        {i["_key"]: i for i in records[: len(records) - expected_cached]}.values(),
+        key=lambda i: i["_key"],
+    )
+
+
+def test_flush_cached_writes_concurrently_reports_errors(test_obj, mocker):
+    col_name = test_obj.AGGREGATED_COLLECTION_NAME
+    test_obj.service.load_mock_collection(col_name, [])
+    test_obj.kvstore_max_batch = 2
+    test_obj.KVSTORE_FLUSH_PARALLELISM = 3
+    records = [{"_key": str(i)} for i in range(7)]
+    test_obj.write_cache = {col_name: list(records)}
+
+    def batch_save(*documents):
+        if documents[0]["_key"] in ("2", "6"):
+            raise make_http_error(400)
+
+    mocker.patch.object(
+        test_obj.service.kvstore[col_name].data, "batch_save", side_effect=batch_save
+    )
+
+    with pytest.raises(ValueError, match="failed_chunk_count=2"):
+        test_obj.flush_cached_writes(col_name, force=True)
+    # only the failed chunks stay cached, in order
+    assert test_obj.write_cache[col_name] == [{"_key": "2"}, {"_key": "3"}, {"_key": "6"}]
+
+
+test_data = [
+    ({}, 1),
+    ({"kvstore_flush_parallelism": ""}, 1),
+    ({"kvstore_flush_parallelism": "8"}, 8),
+    ({"kvstore_flush_parallelism": "0"}, 1),
+]
+
+
+@pytest.mark.parametrize("setting, expected", test_data)
+def test_setup_flush_parallelism(test_obj, setting, expected):
+    test_obj.app_settings["additional_parameters"].update(setting)
+
+    # method under test
+    test_obj.setup(test_obj.service, test_obj.app_settings)
+
+    assert test_obj.KVSTORE_FLUSH_PARALLELISM == expected
+
+
+test_data = [
+    ([], {}),
+    ([{"ip": "1.1.1.1", "last_seen": "x"}], {}),
+    (
+        [
+            {"ip": "1.1.1.1", "last_seen": "x", "bigfix_last_seen": "x"},
+            {"ip": "2.2.2.2", "bigfix_last_seen": "x", "forescout_last_seen": "x"},
+            {"bigfix_last_seen": "x"},
+        ],
+        {
+            "bigfix_collection": ["1.1.1.1", "2.2.2.2"],
+            "forescout_collection": ["2.2.2.2"],
+        },
+    ),
+]
+
+
+@pytest.mark.parametrize("events, expected", test_data)
+def test_group_keys_by_source(test_obj, events, expected):
+    assert test_obj.group_keys_by_source(events) == expected
+
+
+test_data = [
+    # chunk size, full scan threshold, expected bigfix queries
+    (500, 20000, 1),
+    (2, 20000, 2),
+    (1, 20000, 4),
+    (500, 1, 1),
+]
+
+
+@pytest.mark.parametrize("chunk_size, full_scan_min_keys, expected_queries", test_data)
+def test_expire_all_records_for_keys(
+    test_obj, chunk_size, full_scan_min_keys, expected_queries
+):
+    test_obj.app_settings["additional_parameters"]["time_format"] = "%Y-%m-%d"
+    test_obj.EXPIRY_QUERY_CHUNK_SIZE = chunk_size
+    test_obj.EXPIRY_FULL_SCAN_MIN_KEYS = full_scan_min_keys
+    test_obj.kvstore_max_batch = 1000
+    test_obj.service.load_mock_collection(
+        "bigfix_collection",
+        [{"_key": "1.1.1.1"}, {"_key": "2.2.2.2"}, {"_key": "3.3.3.3"}, {"_key": "4.4.4.4"}],
+    )
+    test_obj.service.load_mock_collection(
+        "forescout_collection", [{"_key": "2.2.2.2"}]
+    )
+    events = [
+        {"ip": "1.1.1.1", "bigfix_last_seen": "x"},
+        {"ip": "2.2.2.2", "bigfix_last_seen": "x", "forescout_last_seen": "x"},
+        {"ip": "3.3.3.3", "bigfix_last_seen": "x", "missing_last_seen": "x"},
+        {"ip": "5.5.5.5", "bigfix_last_seen": "x"},
+    ]
+    today = datetime.today().strftime("%Y-%m-%d")
+
+    # method under test
+    expired_count = test_obj.expire_all_records_for_keys(events)
+
+    assert expired_count == 4
+    assert test_obj.service.kvstore["bigfix_collection"].data.query_count == expected_queries
+    assert test_obj.service.kvstore["forescout_collection"].data.query_count == 1
+    assert sorted(i["_key"] for i in test_obj.write_cache["bigfix_collection"]) == [
+        "1.1.1.1",
+        "2.2.2.2",
+        "3.3.3.3",
+    ]
+    assert test_obj.write_cache["forescout_collection"] == [
+        {"_key": "2.2.2.2", "expired": today}
+    ]
+    assert all(i["expired"] == today for i in test_obj.write_cache["bigfix_collection"])
+    assert "missing_collection" not in test_obj.write_cache
+
+
+test_data = [
+    # chunk size, expected bigfix delete requests
+    (500, 1),
+    (2, 2),
+    (1, 3),
+]
+
+
+@pytest.mark.parametrize("chunk_size, expected_deletes", test_data)
+def test_purge_queued_records(test_obj, chunk_size, expected_deletes):
+    test_obj.EXPIRY_QUERY_CHUNK_SIZE = chunk_size
+    test_obj.service.load_mock_collection(
+        "bigfix_collection",
+        [{"_key": "1.1.1.1"}, {"_key": "2.2.2.2"}, {"_key": "3.3.3.3"}, {"_key": "4.4.4.4"}],
+    )
+    test_obj.service.load_mock_collection("forescout_collection", [{"_key": "2.2.2.2"}])
+    events = [
+        {"_key": "1.1.1.1", "bigfix_last_seen": "x"},
+        {"_key": "2.2.2.2", "bigfix_last_seen": "x", "forescout_last_seen": "x"},
+        {"_key": "3.3.3.3", "bigfix_last_seen": "x", "missing_last_seen": "x"},
+        {"_key": "3.3.3.3", "bigfix_last_seen": "x"},
+        {"ip": "5.5.5.5", "bigfix_last_seen": "x"},
+    ]
+
+    assert [test_obj.queue_purge_for_key(i) for i in events] == [
+        True,
+        True,
+        True,
+        True,
+        False,
+    ]
+    # nothing is deleted until the queue is purged
+    assert len(test_obj.service.kvstore["bigfix_collection"].data.data) == 4
+
+    # method under test
+    summary = test_obj.purge_queued_records()
+
+    assert summary == {
+        "requested": 5,
+        "failed": 1,
+        "failed_sources": ["missing_collection"],
+    }
+    assert test_obj.service.kvstore["bigfix_collection"].data.data == [
+        {"_key": "4.4.4.4"}
+    ]
+    assert test_obj.service.kvstore["bigfix_collection"].data.delete_count == expected_deletes
+    assert test_obj.service.kvstore["forescout_collection"].data.data == []
+    assert test_obj.purge_queue == {}
+
+
+def test_purge_queued_records_reports_errors(test_obj, mocker):
+    test_obj.EXPIRY_QUERY_CHUNK_SIZE = 1
+    test_obj.service.load_mock_collection(
+        "bigfix_collection", [{"_key": "1.1.1.1"}, {"_key": "2.2.2.2"}]
+    )
+    data = test_obj.service.kvstore["bigfix_collection"].data
+    delete = mocker.patch.object(
+        data, "delete", side_effect=[make_http_error(500), None]
+    )
+    test_obj.queue_purge_for_key({"_key": "1.1.1.1", "bigfix_last_seen": "x"})
+    test_obj.queue_purge_for_key({"_key": "2.2.2.2", "bigfix_last_seen": "x"})
+
+    # method under test
+    summary = test_obj.purge_queued_records()
+
+    # a failed request does not stop the remaining deletes
+    assert delete.call_count == 2
+    assert summary == {
+        "requested": 2,
+        "failed": 1,
+        "failed_sources": ["bigfix_collection"],
+    }
+
+
+test_data = [
+    (  # only requested columns, in requested order, missing columns skipped
+        "_key,ip,last_seen,expired,foo\n1,1.1.1.1,2021-01-01,false,bar\n\n2,2.2.2.2,2021-01-02,false,baz\n",
+        ["ip", "_key", "missing", "ip"],
+        [{"ip": "1.1.1.1", "_key": "1"}, {"ip": "2.2.2.2", "_key": "2"}],
+    ),
+    (  # all columns
+        'a,b\n1,"x,y"\n3\n',
+        None,
+        [{"a": "1", "b": "x,y"}, {"a": "3", "b": None}],
+    ),
+    (  # single column
+        "a,b\n1,2\n",
+        ["b"],
+        [{"b": "2"}],
+    ),
+    ("a,b\n1,2\n", ["c"], []),
+    ("", ["a"], []),
+]
+
+
+@pytest.mark.parametrize("content, fieldnames, expected_output", test_data)
+def test_iter_results_file(test_obj, content, fieldnames, expected_output):
+    results_file = "/tmp/results.csv.gz"
+    with gzip.open(results_file, "wt") as csv_file:
+        csv_file.write(content)
+
+    # method under test
+    output = list(test_obj.iter_results_file(results_file, fieldnames))
+
+    assert output == expected_output
+    if output:
+        assert test_obj.metrics.counters["rows_read"] == len(output)
+        assert test_obj.metrics.phases["csv_parse"]["count"] == 1
+
+
+test_data = [
+    # record, mvkey update applied to the cache, expected
+    ({"_key": "1", "ip": "1", "ips": ["1"], "last_seen": "2021"}, None, True),
+    ({"_key": "1", "ip": "1", "ips": ["1"], "last_seen": "2022"}, None, False),
+    ({"_key": "1", "ip": "1", "ips": ["1", "2"], "last_seen": "2021"}, None, False),
+    ({"_key": "1", "ip": "1", "ips": ["1", "2"], "last_seen": "2021"}, ["1", "2"], False),
+    ({"_key": "2", "ip": "2", "ips": ["2"], "last_seen": "2021"}, None, False),
+]
+
+
+@pytest.mark.parametrize("record, mvkey_update, expected", test_data)
+def test_is_cached_record_unchanged(test_obj, record, mvkey_update, expected):
+    test_obj.aggregation_cache = {
+        "1": {"_key": "1", "ip": "1", "ips": ["1"], "last_seen": "2021"}
+    }
+    if mvkey_update:
+        test_obj.update_cached_record("1", ips=mvkey_update)
+
+    assert test_obj.is_cached_record_unchanged(record["_key"], record) == expected
+
+
+test_data = [
+    ([], {}),
+    ([["1"], "2"], {}),
+    ([["1", "2"]], {"1": ["1", "2"], "2": ["1", "2"]}),
+    (  # transitive merge across records
+        [["1", "2"], ["3", "2"], ["4"], ["5", "6"]],
+        {
+            "1": ["1", "2", "3"],
+            "2": ["1", "2", "3"],
+            "3": ["1", "2", "3"],
+            "4": None,
+            "5": ["5", "6"],
+            "6": ["5", "6"],
+            "7": None,
+        },
+    ),
+    (  # components merged after being built
+        [["1", "2"], ["3", "4"], ["2", "3"]],
+        {"1": ["1", "2", "3", "4"], "4": ["1", "2", "3", "4"]},
+    ),
+]
+
+
+@pytest.mark.parametrize("mvkeys, expected", test_data)
+def test_mvkey_index(mvkeys, expected):
+    index = MvKeyIndex()
+    for mvkey in mvkeys:
+        index.add(mvkey)
+
+    for value, mvkey in expected.items():
+        assert index.get_mvkey(value) == mvkey
+    assert sorted(map(tuple, index.components().values())) == sorted(
+        {tuple(i) for i in expected.values() if i}
+    )
+
+
+def test_mvkey_index_chain():
+    index = MvKeyIndex()
+    values = [str(i) for i in range(10000)]
+    for first, second in zip(values, values[1:]):
+        index.add([first, second])
+
+    assert len(index) == len(values)
+    assert len(index.components()) == 1
+    assert index.get_mvkey("5000") == sorted(values)
+    # components are recomputed after the index changes
+    index.add(["a", "b"])
+    assert len(index.components()) == 2
+
+
+test_data = [
+    # keys, max memory keys, expected spilled
+    ([], None, False),
+    (["a", "b", "a"], None, False),
+    (["a", "b", "a"], 5, False),
+    (["a", "b", "a", "c"], 2, True),
+    ([str(i) for i in range(1000)] * 2, 100, True),
+]
+
+
+@pytest.mark.parametrize("keys, max_memory_keys, expected_spilled", test_data)
+def test_key_set(keys, max_memory_keys, expected_spilled):
+    with KeySet(max_memory_keys=max_memory_keys) as key_set:
+        key_set.update(keys)
+
+        assert key_set.spilled == expected_spilled
+        assert len(key_set) == len(set(keys))
+        assert sorted(key_set) == sorted(set(keys))
+        for key in keys:
+            assert key in key_set
+        assert "missing" not in key_set
+        # keys added after the set was counted or iterated
+        key_set.add("late")
+        assert "late" in key_set
+        assert len(key_set) == len(set(keys)) + 1
+    assert not key_set.spilled
+
+
+test_data = [
+    ({}, 100000),
+    ({"expiration_match_max_keys": ""}, 100000),
+    ({"expiration_match_max_keys": "500"}, 500),
+    ({"expiration_match_max_keys": "0"}, 1),
+]
+
+
+@pytest.mark.parametrize("setting, expected", test_data)
+def test_setup_expiration_match_max_keys(test_obj, setting, expected):
+    test_obj.app_settings["additional_parameters"].update(setting)
+
+    # method under test
+    test_obj.setup(test_obj.service, test_obj.app_settings)
+
+    assert test_obj.EXPIRATION_MATCH_MAX_KEYS == expected
+
+
+test_data = [
+    # record, expected epoch field (None = absent), expected changed
+    ({"last_seen": "2021-06-01 12:30"}, datetime(2021, 6, 1, 12, 30), True),
+    (
+        {"last_seen": "2021-06-01 12:30", "last_seen_epoch": 1},
+        datetime(2021, 6, 1, 12, 30),
+        True,
+    ),
+    (  # already current
+        {"last_seen": "2021-06-01 12:30", "last_seen_epoch": "current"},
+        datetime(2021, 6, 1, 12, 30),
+        False,
+    ),
+    ({"last_seen": "not a time", "last_seen_epoch": 1}, None, True),
+    ({"last_seen": None}, None, False),
+    ({}, None, False),
+]
+
+
+@pytest.mark.parametrize("record, expected_epoch, expected_changed", test_data)
+def test_set_epoch_field(test_obj, record, expected_epoch, expected_changed):
+    if record.get("last_seen_epoch") == "current":
+        record["last_seen_epoch"] = datetime_to_epoch(expected_epoch)
+
+    # method under test
+    changed = test_obj.set_epoch_field(record, "last_seen", "%Y-%m-%d %H:%M")
+
+    assert changed == expected_changed
+    if expected_epoch:
+        assert record["last_seen_epoch"] == datetime_to_epoch(expected_epoch)
+        assert datetime.fromtimestamp(record["last_seen_epoch"]) == expected_epoch
+    else:
+        assert "last_seen_epoch" not in record
+
+
+def test_iter_records_for_keys_by_field(test_obj):
+    records = [{"_key": str(i), "ip": "10.0.0.{}".format(i)} for i in range(5)]
+    test_obj.service.load_mock_collection("hosts_collection", records)
+    test_obj.EXPIRY_QUERY_CHUNK_SIZE = 2
+
+    # method under test
+    result = test_obj.iter_records_for_keys(
+        "hosts_collection", ["10.0.0.1", "10.0.0.3", "10.0.0.4", "1"], field="ip"
+    )
+
+    assert sorted(i["_key"] for i in result) == ["1", "3", "4"]
+    assert test_obj.service.kvstore["hosts_collection"].data.query_count == 2
+
+
+test_data = [
+    (  # incremental: new link, grown mv_key, record no longer multi-valued
+        [
+            {"_key": "1", "record_keys": ["1", "2"]},
+            {"_key": "2", "record_keys": ["1", "2"]},
+            {"_key": "5", "record_keys": ["5", "6"]},
+            {"_key": "6", "record_keys": ["5", "6"]},
+        ],
+        {
+            "1": (["1", "2"], ["1", "2", "3"]),
+            "3": (None, ["1", "2", "3"]),
+            "5": (["5", "6"], ["5"]),
+            "6": (["5", "6"], None),
+        },
+        False,
+        {
+            "1": ["1", "2", "3"],
+            "2": ["1", "2", "3"],
+            "3": ["1", "3"],
+        },
+    ),
+    (  # rebuild replaces everything and marks the index ready
+        [{"_key": "9", "record_keys": ["9", "8"]}],
+        {"1": (None, ["1", "2"]), "2": (None, ["1", "2"]), "4": (None, ["4"])},
+        True,
+        {"1": ["1", "2"], "2": ["1", "2"], "__mvkey_index_ready__": None},
+    ),
+]
+
+
+@pytest.mark.parametrize("index_data, changes, rebuild, expected", test_data)
+def test_update_mvkey_index(test_obj, index_data, changes, rebuild, expected):
+    index_name = test_obj.get_mvkey_index_name()
+    assert index_name == "hosts_collection_mvkey_index"
+    test_obj.service.load_mock_collection(index_name, copy.deepcopy(index_data))
+    assert not test_obj.is_mvkey_index_ready()
+
+    # method under test
+    test_obj.update_mvkey_index(changes, rebuild=rebuild)
+
+    index = {
+        i["_key"]: i.get("record_keys")
+        for i in test_obj.service.kvstore[index_name].data.data
+    }
+    assert index == expected
+    assert test_obj.is_mvkey_index_ready() == rebuild
+    assert test_obj.get_mvkey_owners(["1", "2", "7"]) == {
+        k: v for k, v in expected.items() if k in ["1", "2"]
+    }
+
+
+def test_update_mvkey_index_without_collection(test_obj):
+    assert not test_obj.is_mvkey_index_ready()
+    assert test_obj.update_mvkey_index({"1": (None, ["1", "2"])}) == 0
+
+
+test_data = [
+    # incoming keys, incoming values, expected records loaded
+    ([], [], []),
+    (["9"], [], ["9"]),
+    (["1"], [], ["1", "2", "3"]),  # 1~2 and 2~3 in the index
+    (["8"], ["3"], ["1", "2", "3"]),  # value links to records, missing keys are skipped
+    (["4"], [], ["4"]),  # singly keyed, not in the index
+]
+
+
+@pytest.mark.parametrize("keys, values, expected", test_data)
+def test_load_linked_records(test_obj, keys, values, expected):
+    test_obj.VISIBLE_MVKEY_FIELD = "ips"
+    records = [
+        {"_key": "1", "ips": ["1", "2"]},
+        {"_key": "2", "ips": ["2", "3"]},
+        {"_key": "3", "ips": ["2", "3"]},
+        {"_key": "4", "ips": ["4"]},
+        {"_key": "9", "ips": ["9"]},
+    ]
+    test_obj.service.load_mock_collection("hosts_collection", records)
+    test_obj.service.load_mock_collection(
+        test_obj.get_mvkey_index_name(),
+        [
+            {"_key": "__mvkey_index_ready__"},
+            {"_key": "1", "record_keys": ["1"]},
+            {"_key": "2", "record_keys": ["1", "2", "3"]},
+            {"_key": "3", "record_keys": ["2", "3"]},
+        ],
+    )
+
+    # method under test
+    output = test_obj.load_linked_records(keys, values)
+
+    assert sorted(output) == expected
+    assert all(output[i] == records[int(i) - 1] for i in expected if i != "9")
+
+
+test_data = [
+    # mv_key index documents; the records are those of test_load_linked_records
+    (  # 2 is missing from the owners of 3, e.g. lost to a concurrent update
+        [
+            {"_key": "1", "record_keys": ["1"]},
+            {"_key": "2", "record_keys": ["1", "2", "3"]},
+            {"_key": "3", "record_keys": ["3"]},
+        ],
+        [("3", "2")],
+    ),
+    (  # owner 7 was deleted from the aggregation collection
+        [
+            {"_key": "1", "record_keys": ["1", "7"]},
+            {"_key": "2", "record_keys": ["1", "2", "3"]},
+            {"_key": "3", "record_keys": ["2", "3"]},
+        ],
+        [("1", "7")],
+    ),
+]
+
+
+@pytest.mark.parametrize("index_data, expected_stale_links", test_data)
+def test_load_linked_records_stale_index(test_obj, index_data, expected_stale_links):
+    test_obj.VISIBLE_MVKEY_FIELD = "ips"
+    records = [
+        {"_key": "1", "ips": ["1", "2"]},
+        {"_key": "2", "ips": ["2", "3"]},
+        {"_key": "3", "ips": ["2", "3"]},
+    ]
+    test_obj.service.load_mock_collection("hosts_collection", records)
+    test_obj.service.load_mock_collection(test_obj.get_mvkey_index_name(), index_data)
+
+    # methods under test
+    assert test_obj.load_linked_records(["1"], []) is None
+    links = {i["_key"]: i["record_keys"] for i in index_data}
+    records = {i["_key"]: i for i in records}
+    assert test_obj.find_stale_mvkey_links(records, links) == expected_stale_links
+
+
+test_data = [
+    # READY marker, expected
+    (None, False),
+    ({"_key": "__mvkey_index_ready__", "run_id": "1"}, False),  # built before its age was kept
+    ({"_key": "__mvkey_index_ready__", "built_epoch": 0}, False),
+    ({"_key": "__mvkey_index_ready__", "built_epoch": "current"}, True),
+]
+
+
+@pytest.mark.parametrize("marker, expected", test_data)
+def test_is_mvkey_index_ready(test_obj, marker, expected):
+    if marker and marker.get("built_epoch") == "current":
+        marker["built_epoch"] = int(time.time()) - 60
+    test_obj.service.load_mock_collection(
+        test_obj.get_mvkey_index_name(), [marker] if marker else []
+    )
+
+    # method under test
+    assert test_obj.is_mvkey_index_ready() == expected
+
+
+test_data = [
+    (True, "1"),
+    (False, "0"),
+    ("true", "1"),
+    ("False", "0"),
+    ("1", "1"),
+    (0, "0"),
+    ("string", "string"),
+    (["kvstore"], "kvstore"),
+    (None, ""),
+]
+
+
+@pytest.mark.parametrize("value, expected_output", test_data)
+def test_normalize_conf_value(value, expected_output):
+    assert normalize_conf_value(value) == expected_output
+
+
+test_data = [
+    ({"replicate": "1"}, {"replicate": "true"}, {}),  # booleans normalized
+    ({"replicate": "0"}, {"replicate": "true"}, {"replicate": "true"}),
+    ({}, {"action.update_inventory.param.source_name": ""}, {}),  # unset is empty
+    ({"external_type": "kvstore"}, {"external_type": ["kvstore"]}, {}),
+    (  # accelerated_fields as returned by list() or __getitem__
+        {"accelerated_fields.ip": '{"ip": 1}', "accelerated_fields.x": {"x": 1}},
+        {"accelerated_fields.ip": '{"ip": 1}', "accelerated_fields.x": '{"x": 1}'},
+        {},
+    ),
+    (
+        {"accelerated_fields.ip": {"ip": 1}},
+        {"accelerated_fields.ip": '{"expired": 1, "ip": 1}'},
+        {"accelerated_fields.ip": '{"expired": 1, "ip": 1}'},
+    ),
+    ({"definition": "foo"}, {"definition": "bar"}, {"definition": "bar"}),
+]
+
+
+@pytest.mark.parametrize("current, desired, expected_output", test_data)
+def test_diff_conf_args(current, desired, expected_output):
+    assert diff_conf_args(current, desired) == expected_output
+
+
+def test_write_conf(test_obj):
+    test_obj.service.confs["macros"] = mock_conf_file({"foo": {"definition": "bar"}})
+    macros = test_obj.service.confs["macros"]
+
+    # unchanged; nothing posted
+    assert test_obj.write_macro("foo", " bar") is False
+    assert macros["foo"].update_count == 0
+
+    # only the changed settings are posted
+    assert test_obj.write_conf("macros", "foo", {"definition": "baz", "args": ""})
+    assert macros["foo"].update_count == 1
+    assert macros["foo"].content == {"definition": "baz"}
+
+    # missing objects are created
+    assert test_obj.write_macro("new", "definition")
+    assert macros["new"].content == {"definition": "definition"}
+
+    # an already loaded object is not read again
+    existing = macros.pop("foo")
+    assert test_obj.write_macro("foo", "baz", existing) is False
+
+    assert test_obj.conf_write_counts == {"applied": 2, "skipped": 2}
+
+
+class KeepAliveRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    close_after = None  # close the connection after this many requests on it
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        self.server.received.append((self.command, self.path))
+        if self.server.drop_count:
+            # as if splunkd closed the connection while the request was in flight
+            self.server.drop_count -= 1
+            self.close_connection = True
+            return
+        body = self.path.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.requests += 1
+        if self.close_after and self.server.requests % self.close_after == 0:
+            # as if splunkd timed out the idle connection, without telling the client
+            self.close_connection = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="function")
+def http_server():
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), KeepAliveRequestHandler
+    )
+    server.connections = set()
+    server.requests = 0
+    server.received = []
+    server.drop_count = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def http_get(handler, server, path, method="GET"):
+    url = "http://127.0.0.1:{}{}".format(server.server_address[1], path)
+    message = {"method": method, "headers": []}
+    if method == "POST":
+        message["body"] = "[]"
+    response = handler(url, message)
+    return response["status"], response["body"].read()
+
+
+def test_pooled_http_handler_reuses_connection(http_server):
+    handler = PooledHTTPHandler(pool_size=2)
+    for i in range(5):
+        path = "/{}".format(i)
+        assert http_get(handler, http_server, path) == (200, path.encode("utf-8"))
+    assert handler.requests == 5
+    assert handler.connections_opened == 1
+    assert len(http_server.connections) == 1
+    handler.close()
+    assert handler.idle == {}
+
+
+def test_pooled_http_handler_pool_size(http_server):
+    handler = PooledHTTPHandler(pool_size=1)
+    connections = [handler.acquire("http", "127.0.0.1", 1)[0] for _ in range(3)]
+    for connection in connections:
+        handler.release("http", "127.0.0.1", 1, connection)
+    assert handler.idle[("http", "127.0.0.1", 1)] == connections[:1]
+    assert handler.acquire("http", "127.0.0.1", 1) == (connections[0], True)
+
+
+def test_pooled_http_handler_retries_closed_connection(http_server, monkeypatch):
+    monkeypatch.setattr(KeepAliveRequestHandler, "close_after", 2)
+    handler = PooledHTTPHandler()
+    for i in range(4):
+        assert http_get(handler, http_server, "/{}".format(i))[0] == 200
+    # a new connection after the server closed each idle one
+    assert handler.connections_opened == 2
+
+
+def test_pooled_http_handler_replaces_dropped_connection(http_server, monkeypatch):
+    monkeypatch.setattr(KeepAliveRequestHandler, "close_after", 1)
+    handler = PooledHTTPHandler()
+    assert http_get(handler, http_server, "/0")[0] == 200
+    time.sleep(0.1)
+
+    # the idle connection closed by the server is not used
+    assert http_get(handler, http_server, "/1", method="POST")[0] == 200
+    assert http_server.received == [("GET", "/0"), ("POST", "/1")]
+    assert handler.connections_opened == 2
+
+
+@pytest.mark.parametrize(
+    "method, expected_received", [("GET", 2), ("POST", 1)]
+)
+def test_pooled_http_handler_retries_idempotent(http_server, method, expected_received):
+    handler = PooledHTTPHandler()
+    assert http_get(handler, http_server, "/0")[0] == 200
+    http_server.received = []
+    http_server.drop_count = 1
+
+    # a POST may have been applied by splunkd, so it is not sent again
+    if method == "POST":
+        with pytest.raises(http.client.RemoteDisconnected):
+            http_get(handler, http_server, "/1", method=method)
+    else:
+        assert http_get(handler, http_server, "/1", method=method)[0] == 200
+    assert http_server.received == [(method, "/1")] * expected_received
+
+
+def test_get_http_handler(monkeypatch):
+    monkeypatch.setattr(oversight_utils, "HTTP_HANDLERS", {})
+
+    # method under test
+    handler = oversight_utils.get_http_handler(2)
+
+    assert handler.pool_size == 2
+    assert oversight_utils.get_http_handler(2) is handler
+    # another size is another pool, and doesn't resize this one
+    assert oversight_utils.get_http_handler(8).pool_size == 8
+    assert handler.pool_size == 2
+    assert oversight_utils.get_http_handler().pool_size == 4
+
+
+def test_setup_http_handler(test_obj):
+    service = splunklib.binding.Context(token="token")
+    app_settings = dict(
+        test_obj.app_settings,
+        additional_parameters=dict(
+            test_obj.app_settings["additional_parameters"], http_pool_size="8"
+        ),
+    )
+    test_obj.setup(service, app_settings)
+    assert isinstance(service.http.handler, PooledHTTPHandler)
+    assert service.http.handler.pool_size == test_obj.HTTP_POOL_SIZE == 8
+
+
+def test_get_input_settings(test_obj):
+    test_obj.service.inputs.add("test", {"id_field": "ip"})
+    inputs = test_obj.service.inputs
+
+    assert test_obj.get_input_settings("test") == {"id_field": "ip"}
+    assert inputs.get_count == 1
+    # reused from the settings cache, also by another process
+    other = type(test_obj)()
+    assert other.get_input_settings("test") == {"id_field": "ip"}
+    assert test_obj.get_input_settings("test") == {"id_field": "ip"}
+    assert inputs.get_count == 1
+
+    # missing inputs are not cached
+    assert test_obj.get_input_settings("missing") is None
+    assert test_obj.get_input_settings("missing") is None
+    assert inputs.get_count == 3
+
+    # invalidated, ie by an edit of the input
+    path = get_settings_cache_path(test_obj.get_splunkhome_env(), test_obj.APP_NAME)
+    assert os.path.isfile(path)
+    invalidate_settings_cache(path)
+    invalidate_settings_cache(path)
+    inputs.input_list[0].content = {"id_field": "mac"}
+    assert test_obj.get_input_settings("test") == {"id_field": "mac"}
+    assert inputs.get_count == 4
+
+
+def test_settings_cache_ttl(test_obj):
+    test_obj.write_settings_cache("inputs", "test", {"id_field": "ip"})
+    test_obj.write_settings_cache("app_settings", "all", {"logging": {}})
+    assert test_obj.read_settings_cache("inputs", "test") == {"id_field": "ip"}
+    assert test_obj.read_settings_cache("inputs", "other") is None
+
+    # expired entries are not read, and dropped on the next write
+    path = get_settings_cache_path(test_obj.get_splunkhome_env(), test_obj.APP_NAME)
+    with open(path) as cache_file:
+        cache = json.load(cache_file)
+    cache["inputs"]["test"]["cached"] -= test_obj.SETTINGS_CACHE_TTL
+    with open(path, "w") as cache_file:
+        json.dump(cache, cache_file)
+    assert test_obj.read_settings_cache("inputs", "test") is None
+    test_obj.write_settings_cache("inputs", "other", {})
+    with open(path) as cache_file:
+        assert sorted(json.load(cache_file)["inputs"]) == ["other"]
+    assert test_obj.read_settings_cache("app_settings", "all") == {"logging": {}}
+
+    # unreadable caches are replaced
+    with open(path, "w") as cache_file:
+        cache_file.write("[not json")
+    assert test_obj.read_settings_cache("inputs", "other") is None
+    test_obj.write_settings_cache("inputs", "other", {})
+    assert test_obj.read_settings_cache("inputs", "other") == {}
+
+    # disabled
+    test_obj.SETTINGS_CACHE_TTL = 0
+    assert test_obj.read_settings_cache("inputs", "other") is None
+
+
+test_data = [(None, 60), ("0", 0), ("300", 300), ("-1", 0)]
+
+
+@pytest.mark.parametrize("setting, expected", test_data)
+def test_setup_settings_cache_ttl(test_obj, setting, expected):
+    app_settings = copy.deepcopy(test_obj.app_settings)
+    app_settings["additional_parameters"]["settings_cache_ttl"] = setting
+    test_obj.setup(test_obj.service, app_settings)
+    assert test_obj.SETTINGS_CACHE_TTL == expected
+
+
+def test_load_app_settings(test_obj, fs, mocker):
+    oversight_utils.APP_SETTINGS_SNAPSHOT.clear()
+    conf_dir = os.path.join("/opt/splunk/etc/apps", test_obj.APP_NAME)
+    fs.create_file(
+        os.path.join(conf_dir, "default", "ta_oversight_settings.conf"),
+        contents="[asset_groups]\n",
+    )
+    raw_settings = {
+        "asset_groups": {
+            "asset_group_1_name": "servers",
+            "asset_group_1_max_age": "7",
+        },
+        "additional_parameters": {
+            "last_inventoried_fieldname": "last_seen",
+            "time_format": "%Y-%m-%d",
+        },
+    }
+    read_app_settings = mocker.patch.object(
+        test_obj,
+        "read_app_settings",
+        side_effect=lambda token: copy.deepcopy(raw_settings),
+    )
+
+    settings = test_obj.load_app_settings("token")
+    assert settings["servers"] == 7
+    # once per process
+    assert test_obj.load_app_settings("token") == settings
+    assert read_app_settings.call_count == 1
+    # each caller gets its own copy, changes to it are not shared
+    changed = test_obj.load_app_settings("token")
+    changed["additional_parameters"]["time_format"] = "%d/%m/%Y"
+    changed["servers"] = 1
+    assert test_obj.load_app_settings("token")["servers"] == 7
+    assert test_obj.load_app_settings("token")["additional_parameters"]["time_format"] == (
+        "%Y-%m-%d"
+    )
+
+    # another process uses the snapshot
+    oversight_utils.APP_SETTINGS_SNAPSHOT.clear()
+    assert test_obj.load_app_settings("token") == settings
+    assert read_app_settings.call_count == 1
+
+    # until the settings are edited
+    raw_settings["asset_groups"]["asset_group_1_max_age"] = "14"
+    fs.create_file(
+        os.path.join(conf_dir, "local", "ta_oversight_settings.conf"),
+        contents="[asset_groups]\nasset_group_1_max_age = 14\n",
+    )
+    assert test_obj.load_app_settings("token")["servers"] == 14
+    assert read_app_settings.call_count == 2
+    oversight_utils.APP_SETTINGS_SNAPSHOT.clear()
+    assert test_obj.load_app_settings("token")["servers"] == 14
+    assert read_app_settings.call_count == 2
+    oversight_utils.APP_SETTINGS_SNAPSHOT.clear()
+
+
+def test_load_app_settings_without_conf_files(test_obj, mocker):
+    oversight_utils.APP_SETTINGS_SNAPSHOT.clear()
+    read_app_settings = mocker.patch.object(
+        test_obj,
+        "read_app_settings",
+        return_value={
+            "additional_parameters": {
+                "last_inventoried_fieldname": "last_seen",
+                "time_format": "%Y-%m-%d",
+            }
+        },
+    )
+    settings = test_obj.load_app_settings("token")
+    assert settings[test_obj.DEFAULT_ASSET_GROUP_NAME] == 30
+    oversight_utils.APP_SETTINGS_SNAPSHOT.clear()
+    test_obj.load_app_settings("token")
+    assert read_app_settings.call_count == 2
+    oversight_utils.APP_SETTINGS_SNAPSHOT.clear()
+
+
+def test_run_metrics_phases(mocker):
+    clock = mocker.patch("oversight_utils.time.perf_counter")
+    clock.side_effect = [0.0, 1.0, 2.0, 4.0, 5.0, 6.0, 10.0, 20.0]
+    metrics = RunMetrics()
+
+    with metrics.phase("aggregation"):
+        with metrics.phase("flush"):
+            pass
+        metrics.add_phase("csv_parse", 0.5)
+        with metrics.phase("flush"):
+            pass
+    metrics.count("rows_read")
+    metrics.count("rows_read", 2)
+
+    assert metrics.phases == {
+        "aggregation": {"count": 1, "seconds": 9.0, "self_seconds": 5.5, "max_seconds": 9.0},
+        "flush": {"count": 2, "seconds": 3.0, "self_seconds": 3.0, "max_seconds": 2.0},
+        "csv_parse": {"count": 1, "seconds": 0.5, "self_seconds": 0.5, "max_seconds": 0.5},
+    }
+    event = metrics.get_event(run_id="1", status="completed")
+    assert list(event)[:4] == ["time", "started", "run_id", "status"]
+    assert event["duration_seconds"] == 20.0
+    assert event["counters"] == {"rows_read": 3, "rest_calls": 0, "bytes_sent": 0}
+
+
+def test_run_metrics_http_counters(monkeypatch):
+    handler = PooledHTTPHandler()
+    handler.requests, handler.bytes_sent = 3, 100
+    monkeypatch.setattr(oversight_utils, "HTTP_HANDLERS", {4: handler})
+    metrics = RunMetrics()
+    handler.requests, handler.bytes_sent = 5, 250
+
+    counters = metrics.get_event()["counters"]
+    assert counters == {"rest_calls": 2, "bytes_sent": 150}
+
+
+def test_emit_run_metrics(test_obj):
+    col_name = test_obj.AGGREGATED_COLLECTION_NAME
+    test_obj.handle_cached_write(col_name, records=[{"_key": "1"}, {"_key": "2"}], force=True)
+
+    # method under test
+    event = test_obj.emit_run_metrics("completed", invalid_rows=2)
+
+    with open("/opt/splunk/var/log/splunk/ta_oversight_metrics.log") as metrics_file:
+        lines = metrics_file.read().splitlines()
+    assert [json.loads(line) for line in lines] == [event]
+    assert event["script"] == test_obj.SCRIPT_NAME
+    assert event["input"] == "test"
+    assert event["status"] == "completed"
+    assert event["counters"]["records_written"] == 2
+    assert event["counters"]["invalid_rows"] == 2
+    assert event["phases"]["flush.hosts_collection"]["count"] == 1
+    assert event["peak_rss_bytes"] > 0
+
+    test_obj.emit_run_metrics("completed")
+    with open("/opt/splunk/var/log/splunk/ta_oversight_metrics.log") as metrics_file:
+        assert len(metrics_file.read().splitlines()) == 2
+
+
+def test_emit_run_metrics_not_written(test_obj, fs, mocker):
+    fs.remove_object("/opt/splunk/var/log/splunk")
+    warning = mocker.patch.object(test_obj.logger, "warning")
+
+    event = test_obj.emit_run_metrics("failed")
+    assert event["status"] == "failed"
+    warning.assert_called_once()
+
+
+class metered_script(OversightScript):
+    @record_run_metrics
+    def run(self, result):
+        if result == "exit":
+            sys.exit(1)
+        if result == "raise":
+            raise ValueError("kvstore unavailable")
+        return result
+
+
+@pytest.mark.parametrize(
+    "result, expected_status, expected_error",
+    [
+        (True, "completed", None),
+        (False, "failed", None),
+        ("exit", "failed", SystemExit),
+        ("raise", "failed", ValueError),
+    ],
+)
+def test_record_run_metrics(fs, mocker, result, expected_status, expected_error):
+    fs.create_dir("/opt/splunk/var/log/splunk")
+    test_obj = metered_script()
+    emit = mocker.patch.object(test_obj, "emit_run_metrics")
+
+    if expected_error:
+        with pytest.raises(expected_error):
+            test_obj.run(result)
+    else:
+        assert test_obj.run(result) == result
+    emit.assert_called_once()
+    assert emit.call_args.args == (expected_status,)
+    error = emit.call_args.kwargs["error"]
+    assert (type(error) if error else None) == expected_error
+
+
+def test_emit_run_metrics_error(test_obj):
+    event = test_obj.emit_run_metrics("failed", error=ValueError("kvstore unavailable"))
+    assert event["error"] == "ValueError: kvstore unavailable"
+    assert "error" not in test_obj.emit_run_metrics("completed")
@@ -0,0 +1,378 @@
+## -*- coding: utf-8 -*-
+## Tests running the scripts with real splunklib and solnlib clients against the local splunkd stand-in,
+## see tests/benchmarks/splunkd.py
+import json
+import os
+import types
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+import pytest
+import solnlib.splunk_rest_client
+import splunklib.client
+from splunklib.binding import HTTPError
+
+import tests
+from tests.benchmarks import synthetic
+from tests.benchmarks.kvstore import BenchService
+from tests.benchmarks.splunkd import SplunkdStandIn
+
+import input_module_oversight
+import oversight_utils
+from expire_inventory import InventoryExpirator
+from oversight_utils import OversightScript, PooledHTTPHandler
+from update_inventory import InventoryUpdater
+
+APP_SETTINGS = {
+    "additional_parameters": {
+        "primary_id_field": synthetic.ID_FIELD,
+        "primary_mv_id_field": synthetic.MV_ID_FIELD,
+        "last_inventoried_fieldname": synthetic.LAST_INVENTORIED_FIELD,
+        "first_inventoried_fieldname": synthetic.FIRST_INVENTORIED_FIELD,
+        "aggregated_lookup_name": "hosts_lookup",
+        "aggregated_collection_name": "hosts_collection",
+        "time_format": oversight_utils.DEFAULT_TIME_FORMAT,
+    },
+    "logging": {"loglevel": "DEBUG"},
+    "asset_groups": {
+        "asset_group_1_name": "default",
+        "asset_group_1_max_age": "30",
+        "asset_group_2_name": "servers",
+        "asset_group_2_max_age": "7",
+    },
+}
+ASSET_GROUPS = {"default": 30, "servers": 7}
+
+
+@pytest.fixture(scope="function")
+def standin(tmp_path, monkeypatch):
+    """a started SplunkdStandIn which splunklib.client.connect() and solnlib's ConfManager reach, with
+    small kvstore limits so every collection read and write spans several requests"""
+    os.makedirs(os.path.join(str(tmp_path), "var", "log", "splunk"))
+    os.makedirs(os.path.join(str(tmp_path), "var", "run"))
+    monkeypatch.setenv("SPLUNK_HOME", str(tmp_path))
+    monkeypatch.setattr(oversight_utils, "APP_SETTINGS_SNAPSHOT", {})
+
+    service = BenchService(max_rows_per_query=7, max_documents_per_batch_save=4)
+    service.confs["ta_oversight_settings"] = json.loads(json.dumps(APP_SETTINGS))
+    server = SplunkdStandIn(service).start()
+    connect = splunklib.client.connect
+    monkeypatch.setattr(
+        splunklib.client,
+        "connect",
+        lambda **kwargs: connect(
+            **dict(kwargs, scheme="http", host=server.host, port=server.port)
+        ),
+    )
+    monkeypatch.setattr(
+        solnlib.splunk_rest_client, "get_splunkd_access_info", server.get_access_info
+    )
+    yield server
+    server.stop()
+
+
+def make_documents(count):
+    return [{"_key": "{:03d}".format(i), "ip": "10.0.0.{}".format(i)} for i in range(count)]
+
+
+def test_standin_rejects_unauthenticated(standin):
+    url = "http://{}:{}/services/configs/conf-limits/kvstore".format(
+        standin.host, standin.port
+    )
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(url)
+    assert error.value.code == 401
+
+
+def test_setup(standin):
+    test_obj = OversightScript()
+
+    # methods under test
+    app_settings = test_obj.load_app_settings("token")
+    test_obj.setup(standin.connect(), app_settings)
+
+    assert test_obj.kvstore_max_rows == 7
+    assert test_obj.kvstore_max_batch == 4
+    assert isinstance(test_obj.service.http.handler, PooledHTTPHandler)
+    assert test_obj.LAST_INVENTORIED_FIELD == synthetic.LAST_INVENTORIED_FIELD
+    # app settings are read from the conf endpoint, through solnlib
+    assert app_settings["servers"] == 7
+    assert standin.service.requests[("configs/conf-ta_oversight_settings", "get")] == 1
+
+
+def test_iter_kvstore_records(standin):
+    standin.service.load_collection("hosts_collection", make_documents(16))
+    test_obj = OversightScript()
+    test_obj.setup(standin.connect(), test_obj.load_app_settings("token"))
+
+    # method under test
+    records = list(test_obj.iter_kvstore_records("hosts_collection"))
+
+    assert records == make_documents(16)
+    # pages of max_rows_per_query, the last one short
+    assert standin.service.requests[("hosts_collection", "query")] == 3
+    # a collection which can't be read fails the run rather than looking empty
+    with pytest.raises(KeyError):
+        list(test_obj.iter_kvstore_records("missing_collection"))
+    # pages are never larger than the server returns
+    assert len(list(test_obj.iter_kvstore_records("hosts_collection", page_size=10))) == 16
+
+
+def test_flush_cached_writes(standin):
+    standin.service.load_collection("hosts_collection")
+    test_obj = OversightScript()
+    test_obj.setup(standin.connect(), test_obj.load_app_settings("token"))
+    collection_data = test_obj.service.kvstore["hosts_collection"].data
+    with pytest.raises(HTTPError) as error:
+        collection_data.batch_save(*make_documents(5))
+    assert error.value.status == 400
+    test_obj.write_cache = {"hosts_collection": make_documents(10)}
+
+    # method under test
+    written = test_obj.flush_cached_writes("hosts_collection", force=True)
+
+    assert written == 10
+    assert standin.service.requests[("hosts_collection", "batch_save")] == 3
+    assert collection_data.query() == make_documents(7)
+
+
+def test_get_input_settings(standin):
+    standin.service.inputs.add("one", {"id_field": "ip", "asset_group": "servers"})
+    test_obj = OversightScript()
+    test_obj.setup(standin.connect(), test_obj.load_app_settings("token"))
+
+    # method under test
+    settings = test_obj.get_input_settings("one")
+
+    assert settings["id_field"] == "ip"
+    assert settings["asset_group"] == "servers"
+    assert test_obj.get_input_settings("missing") is None
+
+
+def load_inventory(service, assets, source_count):
+    """load the aggregated, mv_key index and source collections and the inputs of the sources"""
+    service.load_collection("hosts_collection", synthetic.make_aggregated_records(assets))
+    service.load_collection("hosts_collection" + OversightScript.MVKEY_INDEX_SUFFIX)
+    for number, source in enumerate(synthetic.get_source_names(source_count)):
+        service.load_collection(
+            source + "_collection", synthetic.make_source_records(assets, source)
+        )
+        service.inputs.add(
+            source,
+            {
+                "id_field": synthetic.ID_FIELD,
+                "mv_id_field": synthetic.MV_ID_FIELD,
+                "asset_group": list(ASSET_GROUPS)[number],
+                "aggregation_fields": ",".join(synthetic.AGGREGATION_FIELDS),
+            },
+        )
+
+
+def make_update_payload(assets, source, now):
+    """@returns (update_inventory alert action payload, number of rows in its results file)"""
+    results_file = os.path.join(os.environ["SPLUNK_HOME"], "results.csv.gz")
+    row_count = synthetic.write_results_file(results_file, assets, source, now)
+    payload = {
+        "session_key": "token",
+        "results_file": results_file,
+        "configuration": {"source_name": source},
+    }
+    return payload, row_count
+
+
+def test_update_inventory_single_valued(standin):
+    """records streamed in whole batches: the last partial batch must be written too"""
+    now = datetime.today().replace(second=0, microsecond=0)
+    assets = synthetic.make_assets(
+        6, ASSET_GROUPS, now, multi_homed_ratio=0, source_count=1, expired_fraction=0, seed=2
+    )
+    load_inventory(standin.service, assets, 1)
+    standin.service.kvstore["hosts_collection"].data.delete()
+    payload, row_count = make_update_payload(assets, "source_0", now)
+    test_obj = InventoryUpdater()
+
+    # method under test
+    assert test_obj.update_inventory(payload)
+
+    records = standin.service.kvstore["hosts_collection"].data.documents
+    assert row_count == 6
+    assert sorted(records) == sorted(i["addresses"][0] for i in assets)
+    assert all(records[key]["source_0_" + synthetic.LAST_INVENTORIED_FIELD] for key in records)
+    assert test_obj.write_cache["hosts_collection"] == []
+
+
+def test_update_and_expire_inventory(standin):
+    now = datetime.today().replace(second=0, microsecond=0)
+    assets = synthetic.make_assets(
+        30, ASSET_GROUPS, now, multi_homed_ratio=0.3, source_count=2, expired_fraction=0.2, seed=1
+    )
+    service = standin.service
+    load_inventory(service, assets, 2)
+    payload, row_count = make_update_payload(assets, "source_0", now)
+
+    # methods under test
+    assert InventoryUpdater().update_inventory(payload)
+    assert InventoryExpirator().expire_inventory(
+        {"session_key": "token", "configuration": {}}
+    )
+
+    records = service.kvstore["hosts_collection"].data.documents
+    reported = [
+        i for i in assets if not i["stale"] and "source_0" in i["sources"]
+    ]
+    assert row_count == sum(len(i["addresses"]) for i in reported)
+    for asset in reported:
+        for ip in asset["addresses"]:
+            assert records[ip]["source_0_" + synthetic.LAST_INVENTORIED_FIELD]
+            assert records[ip]["expired"] == "false"
+    for asset in assets:
+        if asset["stale"]:
+            for ip in asset["addresses"]:
+                assert records[ip]["expired"] != "false"
+    # every read and write went through splunklib, within the limits
+    assert service.requests[("hosts_collection", "query")] > 1
+    assert service.requests[("hosts_collection", "batch_save")] > 1
+
+
+def make_host_record(ip, last_inventoried, expired="false", epoch=True):
+    record = {
+        "_key": ip,
+        synthetic.ID_FIELD: ip,
+        synthetic.MV_ID_FIELD: [ip],
+        synthetic.LAST_INVENTORIED_FIELD: last_inventoried.strftime(
+            oversight_utils.DEFAULT_TIME_FORMAT
+        ),
+        "expired": expired,
+        "asset_group": "servers",
+    }
+    if epoch:
+        record[synthetic.LAST_INVENTORIED_FIELD + "_epoch"] = oversight_utils.datetime_to_epoch(
+            last_inventoried
+        )
+    return record
+
+
+@pytest.mark.parametrize("full_scan", [False, True])
+def test_expire_inventory_writes(standin, full_scan):
+    """the candidate queries and the full scan leave expired and unchanged records alone"""
+    now = datetime.today().replace(second=0, microsecond=0)
+    records = [
+        make_host_record("10.0.0.1", now - timedelta(days=60), expired="2020-01-01 00:00"),
+        make_host_record("10.0.0.2", now - timedelta(days=1), epoch=False),
+        make_host_record("10.0.0.3", now - timedelta(days=30)),
+    ]
+    standin.service.load_collection("hosts_collection", json.loads(json.dumps(records)))
+    test_obj = InventoryExpirator()
+    if full_scan:
+        test_obj.EXPIRY_FULL_SCAN_MIN_KEYS = 0
+
+    # method under test
+    assert test_obj.expire_inventory({"session_key": "token", "configuration": {}})
+
+    documents = standin.service.kvstore["hosts_collection"].data.documents
+    assert documents["10.0.0.1"] == records[0]
+    assert documents["10.0.0.2"] == records[1]
+    assert documents["10.0.0.3"]["expired"] != "false"
+    assert standin.service.requests[("hosts_collection", "batch_save")] == 1
+
+
+INPUT_ARGUMENTS = [
+    "source_expression",
+    "id_field",
+    "id_field_rename",
+    "mv_id_field",
+    "source_fields",
+    "enrichment_expression",
+    "enrichment_fields",
+    "source_filter",
+    "inventory_filter",
+    "inventory_source",
+    "aggregation_fields",
+    "replicate",
+    "cron",
+]
+
+
+def make_scheme():
+    scheme = tests.mock_scheme()
+    scheme.arguments = [tests.mock_arg(i) for i in INPUT_ARGUMENTS]
+    return scheme
+
+
+def make_input(name, **kwargs):
+    """an oversight input stanza as in the input definition stream_events() receives"""
+    params = {
+        "source_expression": "index=main",
+        "id_field": synthetic.ID_FIELD,
+        "source_fields": "os",
+        "inventory_source": "1",
+        "replicate": "0",
+        "cron": "0 1 * * *",
+    }
+    params.update(kwargs)
+    return "oversight://" + name, params
+
+
+def test_reconcile(standin):
+    standin.service.confs["transforms"] = {}
+    standin.service.confs["macros"] = {}
+    inputs = dict(
+        [make_input("one", aggregation_fields="os"), make_input("two", replicate="1")]
+    )
+    modinput = types.SimpleNamespace(
+        service=standin.connect(), get_scheme=make_scheme
+    )
+    definition = types.SimpleNamespace(inputs=inputs)
+
+    # method under test
+    input_module_oversight.stream_events(modinput, definition, None)
+
+    service = modinput.service
+    assert sorted(i.name for i in service.kvstore.list()) == [
+        "hosts_collection",
+        "hosts_collection_mvkey_index",
+        "one_collection",
+        "two_collection",
+    ]
+    assert service.kvstore["two_collection"].content["replicate"] == "true"
+    assert service.confs["transforms"]["one_lookup"].content["collection"] == (
+        "one_collection"
+    )
+    savedsearch = service.saved_searches["one_hosts"].content
+    assert savedsearch["action.update_inventory.param.source_name"] == "one"
+
+    metrics = read_metrics_events()
+    assert metrics[-1]["status"] == "completed"
+    assert "error" not in metrics[-1]
+
+    # a second run reads the objects it wrote and has nothing to write
+    writes = standin.service.get_counts("post")[0]
+    assert writes >= 13
+    input_module_oversight.stream_events(modinput, definition, None)
+    assert standin.service.get_counts("post")[0] == writes
+
+
+def read_metrics_events():
+    path = os.path.join(
+        os.environ["SPLUNK_HOME"], "var", "log", "splunk", oversight_utils.METRICS_LOG_FILENAME
+    )
+    with open(path) as metrics_file:
+        return [json.loads(line) for line in metrics_file]
+
+
+def test_reconcile_failed(standin, monkeypatch):
+    """a failed run emits its metrics event too"""
+    monkeypatch.delitem(standin.service.confs, "macros", raising=False)
+    modinput = types.SimpleNamespace(service=standin.connect(), get_scheme=make_scheme)
+    definition = types.SimpleNamespace(inputs=dict([make_input("one")]))
+
+    # method under test
+    with pytest.raises(Exception) as error:
+        input_module_oversight.stream_events(modinput, definition, None)
+
+    metrics = read_metrics_events()
+    assert len(metrics) == 1
+    assert metrics[0]["script"] == "input_module_oversight"
+    assert metrics[0]["status"] == "failed"
+    assert metrics[0]["error"].startswith(type(error.value).__name__ + ": ")
@@ -134,6 +134,21 @@ test_data = [
         },
     ),
     ("%Y-%m-%d", {}, {}, {}),  # case all input null
+    (  # existing epoch fields are compared instead of the strings
+        "%Y-%m-%d",
+        {
+            "first_seen": "20/01/2021",
+            "first_seen_epoch": oversight_utils.datetime_to_epoch(datetime(2021, 1, 20)),
+            "test_last_seen": "30/04/2021",
+            "test_last_seen_epoch": oversight_utils.datetime_to_epoch(
+                datetime(2021, 4, 30)
+            ),
+            "last_seen": "05/05/2021",
+            "last_seen_epoch": oversight_utils.datetime_to_epoch(datetime(2021, 5, 5)),
+        },
+        {"last_seen": "2021-05-01"},
+        {"test_last_seen": "2021-05-01"},
+    ),
 ]
 
 
@@ -285,6 +300,43 @@ def test_get_base_fields(test_obj):
     assert output == expected_output
 
 
+test_data = [
+    (None, None, ["_key", "ip", "test_last_seen", "last_seen", "first_seen", "ips", "expired"]),
+    (
+        "ip_addresses",
+        ["os", "mac"],
+        [
+            "_key",
+            "ip",
+            "test_last_seen",
+            "last_seen",
+            "first_seen",
+            "ips",
+            "ip_addresses",
+            "expired",
+            "__mv_ip_addresses",
+            "os",
+            "__mv_os",
+            "mac",
+            "__mv_mac",
+        ],
+    ),
+]
+
+
+@pytest.mark.parametrize("mv_id_field, aggregation_fields, expected_output", test_data)
+def test_get_input_fieldnames(test_obj, mv_id_field, aggregation_fields, expected_output):
+    test_obj.id_field = "ip"
+    test_obj.mv_id_field = mv_id_field
+    test_obj.mv_key_field = "__mv_" + mv_id_field if mv_id_field else []
+    test_obj.aggregation_fields = aggregation_fields
+    test_obj.last_checkin_source_field = "test_last_seen"
+
+    output = test_obj.get_input_fieldnames(test_obj.get_base_fields())
+    assert sorted(output) == sorted(expected_output)
+    assert len(output) == len(set(output))
+
+
 test_data = [
     (  # test non-mv with no prior aggregated data
         {
@@ -504,6 +556,15 @@ def test_aggregate_event(
     output_event, output_key = test_obj.aggregate_event(
         input_event, output_event, output_key
     )
+    # epoch seconds of the expected timestamps, in the local timezone
+    expected_output_event = dict(expected_output_event)
+    for field in ["last_seen", "first_seen", output_timestamp_fieldname]:
+        if expected_output_event.get(field):
+            expected_output_event[field + "_epoch"] = oversight_utils.datetime_to_epoch(
+                oversight_utils.parse_timestring(
+                    expected_output_event[field], test_obj.TIME_FORMAT
+                )
+            )
     if not output_event == expected_output_event:
         print("input_event:")
         pp(input_event)
@@ -541,6 +602,7 @@ test_data = [
         {
             "write_cache": {},
             "kvstore_max_batch": 3,
+            "kvstore_max_rows": 50000,
             "mv_key_field": [],
             "mv_id_field": None,
             "id_field": "ip",
@@ -553,6 +615,9 @@ test_data = [
             "LAST_INVENTORIED_FIELD": "last_seen",
             "EXPIRATION_EXPRESSION": None,
             "aggregation_cache": {},
+            "purge_queue": {},
+            "modified_cache_keys": set(),
+            "conf_write_counts": {"applied": 0, "skipped": 0},
             "params": {},
             "VISIBLE_KEY_FIELD": "ip",
             "VISIBLE_MVKEY_FIELD": None,
@@ -585,6 +650,7 @@ test_data = [
         {
             "write_cache": {},
             "kvstore_max_batch": 3,
+            "kvstore_max_rows": 50000,
             "mv_key_field": [],
             "mv_id_field": None,
             "id_field": "renamed_ip",
@@ -597,6 +663,9 @@ test_data = [
             "LAST_INVENTORIED_FIELD": "last_seen",
             "EXPIRATION_EXPRESSION": None,
             "aggregation_cache": {},
+            "purge_queue": {},
+            "modified_cache_keys": set(),
+            "conf_write_counts": {"applied": 0, "skipped": 0},
             "params": {},
             "VISIBLE_KEY_FIELD": "ip",
             "VISIBLE_MVKEY_FIELD": None,
@@ -626,6 +695,7 @@ def test_setup_attributes(test_obj, app_settings, input_settings, expected_attri
     del obj_locals["service"]
     del obj_locals["aggregated_collection"]
     del obj_locals["logger"]
+    del obj_locals["metrics"]
 
     print(obj_locals)
     if not obj_locals == expected_attribute_values:
@@ -649,13 +719,7 @@ test_data = [
             },
             "logging": {"loglevel": "ERROR"},
         },
-        {
-            "asset_group": None,
-            "aggregation_fields": None,
-            "id_field_rename": None,
-            "id_field": "ip",
-            "mv_id_field": None,
-        },
+        None,  # no input settings were found for it
         "test",
     ),
     (  # case loglevel not definied anywhere
@@ -730,7 +794,7 @@ test_data = [
 
 
 @pytest.mark.parametrize(
-    "payload, app_settings, input_definition_name, input_settings", test_data
+    "payload, app_settings, input_settings, input_definition_name", test_data
 )
 def test_setup_attributes_with_exceptions(
     payload, app_settings, input_settings, input_definition_name, test_obj
@@ -856,11 +920,18 @@ def test_initialize_output_event(
     test_obj.mv_key_field = []
     assert test_obj.validate_input_event(input_event)
 
+    original_base_fields = copy.deepcopy(base_fields)
     output_event, output_key = test_obj.initialize_output_event(
         input_event, base_fields
     )
     assert output_key == expected_output_key
 
+    # the returned record is independent of the cache and base_fields
+    output_key[test_obj.VISIBLE_MVKEY_FIELD].append("isolation")
+    assert test_obj.aggregation_cache == collection_cache
+    assert base_fields == original_base_fields
+    output_key[test_obj.VISIBLE_MVKEY_FIELD].pop()
+
     if not output_event == expected_output_event:
         print("output_event:")
         pp(output_event)
@@ -927,3 +998,83 @@ def test_identify_records_with_outdated_mvkeys(
         records_to_review, phase_one_records
     )
     assert output == expected_output
+
+
+test_data = [
+    (  # nothing linked
+        {"1": {"_key": "1", "ips": ["1"]}},
+        {"2": {"_key": "2", "ips": ["2"]}},
+        [],
+        [],
+        {"2": ["2"]},
+        {},
+        {},
+    ),
+    (  # incoming link updates an existing record which is not in the incoming events
+        {"1": {"_key": "1", "ips": ["1"]}, "2": {"_key": "2", "ips": ["2"]}},
+        {"1": {"_key": "1", "ips": ["1", "2"]}},
+        [],
+        [["1", "2"]],
+        {"1": ["1", "2"]},
+        {"2": ["1", "2"]},
+        {},
+    ),
+    (  # transitive: existing A~B, incoming B~C
+        {
+            "1": {"_key": "1", "ips": ["1", "2"]},
+            "2": {"_key": "2", "ips": ["1", "2"]},
+        },
+        {"3": {"_key": "3", "ips": ["2", "3"]}},
+        [],
+        [["1", "2"], ["2", "3"]],
+        {"3": ["1", "2", "3"]},
+        {"1": ["1", "2", "3"], "2": ["1", "2", "3"]},
+        {},
+    ),
+    (  # record already written before it was linked is read back from the kvstore
+        {},
+        {"4": {"_key": "4", "ips": ["3", "4"]}},
+        [{"_key": "3", "ips": ["3"], "os": "linux"}],
+        [["3", "4"]],
+        {"4": ["3", "4"]},
+        {"3": ["3", "4"]},
+        {"3": {"_key": "3", "ips": ["3", "4"], "os": "linux"}},
+    ),
+]
+
+
+@pytest.mark.parametrize(
+    "aggregation_cache, phase_one_records, streamed_records, mvkeys, expected_phase_one_mvkeys, expected_update_mvkeys, expected_update_records",
+    test_data,
+)
+def test_synchronize_mvkeys(
+    test_obj,
+    aggregation_cache,
+    phase_one_records,
+    streamed_records,
+    mvkeys,
+    expected_phase_one_mvkeys,
+    expected_update_mvkeys,
+    expected_update_records,
+):
+    test_obj.VISIBLE_MVKEY_FIELD = "ips"
+    test_obj.aggregation_cache = copy.deepcopy(aggregation_cache)
+    test_obj.service.load_mock_collection(
+        "hosts_collection", copy.deepcopy(streamed_records)
+    )
+    mvkey_index = oversight_utils.MvKeyIndex()
+    for mvkey in mvkeys:
+        mvkey_index.add(mvkey)
+    streamed_keys = {i["_key"] for i in streamed_records}
+
+    # method under test
+    output = test_obj.synchronize_mvkeys(mvkey_index, phase_one_records, streamed_keys)
+
+    assert {k: v["ips"] for k, v in phase_one_records.items()} == expected_phase_one_mvkeys
+    assert {k: v["ips"] for k, v in output.items()} == expected_update_mvkeys
+    for key, record in expected_update_records.items():
+        assert output[key] == record
+    # the cache follows the canonical mvkeys
+    for key, mvkey in expected_update_mvkeys.items():
+        if key in test_obj.aggregation_cache:
+            assert test_obj.aggregation_cache[key]["ips"] == mvkey